@@ -0,0 +1,78 @@
+# Micro-benchmark of the per-resource format and MIME type handling used when
+# generating /data.json and when harvesting. Compares the current functions
+# with the way they used to be written (regular expressions compiled through
+# the re module's cache and a dict literal built on every call).
+#
+# Run it from the CKAN virtualenv, since the modules import CKAN:
+#
+#    python benchmarks/bench_conversion.py [number of resources]
+
+import re, sys, timeit, random
+
+from ckanext.datajson import pod_to_package, package_to_pod
+
+def old_normalize_format(format, raise_on_unknown=False):
+    if format is None:
+        if raise_on_unknown: raise ValueError()
+        return "Unknown"
+    format = format.lower()
+    m = re.match(r"((application|text)/(\S+))(; charset=.*)?", format)
+    if m:
+        if m.group(1) == "text/plain": return "Text"
+        if m.group(1) == "application/zip": return "ZIP"
+        if m.group(1) == "application/vnd.ms-excel": return "XLS"
+        if m.group(1) == "application/x-msaccess": return "Access"
+        if raise_on_unknown: raise ValueError()
+        return "Other"
+    if format == "text": return "Text"
+    if raise_on_unknown and "?" in format: raise ValueError()
+    return format.upper()
+
+def old_extension_to_mime_type(file_ext):
+    if file_ext is None: return "application/unknown"
+    if file_ext is "Other": return "application/unknown"
+    ext = {
+        "csv": "text/csv",
+        "xls": "application/vnd.ms-excel",
+        "xml": "application/xml",
+        "rdf": "application/rdf+xml",
+        "json": "application/json",
+        "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        "text": "text/plain",
+        "feed": "application/rss+xml",
+    }
+    return ext.get(file_ext.lower(), "application/unknown")
+
+def old_clean_mimetype(mimetype):
+    return re.sub(r"[,\s].*", "", mimetype)
+
+def new_clean_mimetype(mimetype):
+    return package_to_pod.MIME_TYPE_PARAMETERS_REGEX.sub("", mimetype)
+
+FORMATS = ["text/csv", "application/zip", "text/plain; charset=utf-8", "application/json",
+    "CSV", "XLS", "xml", "api", "application/vnd.ms-excel", "Query Tool", None]
+
+def make_resources(n):
+    random.seed(0)
+    return [(random.choice(FORMATS), random.choice(["text/csv", "application/json, text/plain"])) for i in xrange(n)]
+
+def run(resources, normalize_format, extension_to_mime_type, clean_mimetype):
+    for format, mimetype in resources:
+        f = normalize_format(format)
+        extension_to_mime_type(f)
+        clean_mimetype(mimetype)
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    resources = make_resources(n)
+    for label, funcs in (
+        ("before", (old_normalize_format, old_extension_to_mime_type, old_clean_mimetype)),
+        ("after", (pod_to_package.normalize_format, package_to_pod.extension_to_mime_type, new_clean_mimetype)),
+        ):
+        best = min(timeit.repeat(lambda : run(resources, *funcs), number=1, repeat=5))
+        print "%-6s %.3f microseconds per resource" % (label, best / n * 1e6)
+    print "normalize_format cache:", pod_to_package.classify_format.cache_info()
+    print "extension_to_mime_type cache:", package_to_pod.extension_to_mime_type.cache_info()
+
+if __name__ == "__main__":
+    main()
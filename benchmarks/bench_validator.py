@@ -0,0 +1,71 @@
+# Benchmark of the data.json validator on a made-up catalog, in datasets per
+# second. To compare with another version of the validator, give the path to
+# a copy of its validator.py, e.g. one saved with
+#
+#    git show <commit>:ckanext/datajson/validator.py > /tmp/old_validator.py
+#
+# and run it from the CKAN virtualenv:
+#
+#    python benchmarks/bench_validator.py [number of datasets] [/tmp/old_validator.py]
+#
+# The OMB bureau codes are loaded before timing starts, so the first run may
+# download them.
+
+import sys, imp, random, timeit
+
+from ckanext.datajson import validator, validation_primitives
+
+SRC_URL = "http://www.example.gov/data.json"
+
+def make_dataset(i):
+    # A dataset with the usual mix of problems: mostly valid, with the same
+    # few mistakes repeated throughout, as in real catalogs.
+    dataset = {
+        "title": "Dataset number %d" % i,
+        "description": "A description of the dataset that is long enough to pass.",
+        "keyword": ["health", "statistics"],
+        "bureauCode": [random.choice(["009:38", "009:15", "009:bad", "999:99"])],
+        "programCode": ["009:000"],
+        "modified": random.choice(["2014-01-01", "2014-01-01T12:00:00Z", "January 2014"]),
+        "publisher": "Department of Examples",
+        "contactPoint": "Jane Doe",
+        "mbox": random.choice(["jane.doe@example.gov", "john.doe@example.gov", "not an address"]),
+        "identifier": "dataset-%d" % random.randint(0, i + 100), # some duplicates
+        "accessLevel": random.choice(["public", "public", "restricted public"]),
+        "accessURL": "http://www.example.gov/data/%d.csv" % i,
+        "format": random.choice(["text/csv", "csv", "application/vnd.ms-excel"]),
+        "distribution": [
+            { "accessURL": "http://www.example.gov/data/%d.csv" % i, "format": "text/csv" },
+            { "accessURL": "http://www.example.gov/data/%d.json" % i, "format": "application/json" },
+        ],
+        "temporal": "2010-01-01/2013-12-31",
+        "language": ["en-US"],
+        "references": ["http://www.example.gov/docs"],
+        "accrualPeriodicity": random.choice(["Annual", "Sometimes"]),
+    }
+    if random.random() < 0.1:
+        del dataset["temporal"]
+    if random.random() < 0.05:
+        dataset["description"] = None
+    return dataset
+
+def make_catalog(n):
+    random.seed(0)
+    return [make_dataset(i) for i in xrange(n)]
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    versions = [("current", validator)]
+    if len(sys.argv) > 2:
+        versions.insert(0, ("other", imp.load_source("other_validator", sys.argv[2])))
+
+    catalog = make_catalog(n)
+    for label, module in versions:
+        module.get_omb_bureau_codes()
+        best = min(timeit.repeat(lambda : module.do_validation(catalog, SRC_URL, []), number=1, repeat=5))
+        print "%-8s %8.0f datasets per second" % (label, n / best)
+    for name, info in sorted(validation_primitives.cache_info().items()):
+        print "%s cache:" % name, info
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import os, glob, gzip, tempfile, fcntl
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+import logging
+log = logging.getLogger(__name__)
+
+# Pre-generated copies of the catalog output. For each output format we keep
+# the plain file and gzip (and, if the brotli module is installed, brotli)
+# compressed copies of it on disk, named after the catalog version (ETag) they
+# were generated for. They are generated the first time a version is requested
+# and then served as-is until the catalog changes, so that both generating and
+# compressing the output happen once per version rather than once per request.
+# Only one process generates a format's artifacts at a time (the others wait
+# for it), and the previous version is kept around for requests that chose it
+# just before the catalog changed.
+
+CHUNK_SIZE = 65536
+
+def artifact_prefix(format, compact):
+    return "%s.%s" % (format, "compact" if compact else "indent")
+
+def artifact_path(directory, format, compact, etag):
+    return os.path.join(directory, "%s.%s" % (artifact_prefix(format, compact), etag.strip('"')))
+
+ENCODING_EXTENSIONS = { None: "", "gzip": ".gz", "br": ".br" }
+
+def open_artifact(directory, format, compact, etag, encoding, make_chunks):
+    # Returns an open file with this catalog version's artifact in the given
+    # encoding (see choose_encoding), generating it (by calling make_chunks) if
+    # it doesn't exist yet.
+    path = artifact_path(directory, format, compact, etag) + ENCODING_EXTENSIONS[encoding]
+    try:
+        return open(path, "rb")
+    except IOError:
+        pass
+    generate_artifact(directory, format, compact, etag, path, make_chunks)
+    try:
+        return open(path, "rb")
+    except IOError:
+        # Removed again already, which means the catalog changed twice while
+        # we were waiting. Have another go without waiting for the lock.
+        generate_artifact(directory, format, compact, etag, path, make_chunks, force=True)
+        return open(path, "rb")
+
+def generate_artifact(directory, format, compact, etag, path, make_chunks, force=False):
+    # Writes the artifact for a catalog version unless, once we have the lock,
+    # another process turns out to have just written it.
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(os.path.join(directory, ".%s.lock" % artifact_prefix(format, compact)), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if force or not os.path.exists(path):
+                plain_path = artifact_path(directory, format, compact, etag)
+                write_artifact(directory, plain_path, make_chunks())
+                remove_old_artifacts(directory, format, compact, plain_path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def write_artifact(directory, path, chunks):
+    # Write all of the variants at once to temporary files and then move them
+    # into place. The plain file goes last since its presence is what tells
+    # other processes that the artifact is complete.
+    def temp():
+        fd, name = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        return os.fdopen(fd, "wb"), name
+
+    plain, plain_name = temp()
+    gz_file, gz_name = temp()
+    gz = gzip.GzipFile(filename="", mode="wb", compresslevel=9, fileobj=gz_file, mtime=0)
+    if brotli:
+        br, br_name = temp()
+        br_compressor = brotli.Compressor()
+
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, unicode): chunk = chunk.encode("utf8")
+            plain.write(chunk)
+            gz.write(chunk)
+            if brotli: br.write(br_compressor.process(chunk))
+        gz.close()
+        for f in (plain, gz_file):
+            f.close()
+        if brotli:
+            br.write(br_compressor.finish())
+            br.close()
+            os.rename(br_name, path + ".br")
+        os.rename(gz_name, path + ".gz")
+        os.rename(plain_name, path)
+    except:
+        for name in (plain_name, gz_name, br_name if brotli else None):
+            if name and os.path.exists(name): os.unlink(name)
+        raise
+
+    log.debug('wrote catalog artifact %s' % path)
+
+def remove_old_artifacts(directory, format, compact, current_path, keep=1):
+    # Clean up the artifacts for versions of the catalog written before the
+    # current one, except the most recent 'keep' of them. Processes that are
+    # still sending one of them keep their open file.
+    current_mtime = os.stat(current_path).st_mtime
+    older = []
+    for path in glob.glob(os.path.join(directory, artifact_prefix(format, compact) + ".*")):
+        if path.endswith((".gz", ".br")) and os.path.exists(path[:-3]): continue # goes with its plain file
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            continue # another process got to it first
+        if mtime < current_mtime:
+            older.append((mtime, path))
+    older.sort()
+    for mtime, path in (older[:-keep] if keep else older):
+        for variant in (path, path + ".gz", path + ".br"): # the plain file first, since it marks the artifact complete
+            try:
+                os.unlink(variant)
+            except OSError:
+                pass # another process got to it first, or it's not there
+
+def choose_encoding(accept_encoding):
+    # Picks the smallest variant the client will accept. Returns the
+    # Content-Encoding to send (or None for the plain file).
+    accepted = set()
+    for coding in (accept_encoding or "").split(","):
+        coding = coding.split(";")
+        name = coding[0].strip().lower()
+        if any(p.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000") for p in coding[1:]):
+            continue
+        accepted.add(name)
+
+    for encoding in (("br", "gzip") if brotli else ("gzip",)):
+        if encoding in accepted or "*" in accepted:
+            return encoding
+    return None
+
+def encoding_etag(etag, encoding):
+    # Each encoding of a version is a different representation, so it gets its
+    # own ETag.
+    if encoding is None: return etag
+    return '"%s-%s"' % (etag.strip('"'), encoding)
+
+def iter_file(f):
+    # Yields the contents of an open file and closes it at the end.
+    try:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk: break
+            yield chunk
+    finally:
+        f.close()
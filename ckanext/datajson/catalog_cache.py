@@ -0,0 +1,210 @@
+import datetime, json
+
+try:
+    from collections import OrderedDict # 2.7
+except ImportError:
+    from sqlalchemy.util import OrderedDict
+
+from sqlalchemy import types, Column, Table, select, and_, or_, exists
+from sqlalchemy.exc import SQLAlchemyError
+
+from ckan.model.meta import metadata, Session
+
+from package_to_pod import make_datajson_entry
+import package_source
+
+import logging
+log = logging.getLogger(__name__)
+
+# The catalog cache keeps the serialized POD entry of every package that appears
+# in /data.json so that requests don't have to convert the whole site each time.
+# Rows are invalidated (their 'cached' timestamp is cleared) when CKAN notifies
+# us that a package changed and they are regenerated lazily the next time the
+# catalog is read. Rows older than the configured staleness bound are
+# regenerated by the refresh-cache command (e.g. from cron), in case we missed
+# a notification, so that no web request has to regenerate the whole catalog.
+# The command also adds packages that have no row at all (e.g. ones created
+# outside of CKAN). Until the cache has been filled, by rebuild or the command,
+# requests don't use it and convert the packages themselves. Filling it is
+# recorded with a marker row, since the table isn't empty once a package has
+# changed. Only one process refreshes the cache at a time.
+catalog_entry_table = Table('datajson_catalog_entry', metadata,
+    Column('package_id', types.UnicodeText, primary_key=True),
+    Column('package_type', types.UnicodeText),
+    Column('author', types.UnicodeText),
+    Column('revision_timestamp', types.UnicodeText), # for ordering, like current_package_list_with_resources
+    Column('entry', types.UnicodeText), # the entry as JSON
+    Column('cached', types.DateTime), # NULL when the entry has been invalidated
+)
+
+# The package_id of the row that marks the cache as filled. It isn't a package
+# ID and has no package_type, so it is never part of the catalog.
+FILLED_MARKER = u"datajson:filled"
+
+def setup():
+    if not catalog_entry_table.exists():
+        catalog_entry_table.create()
+        log.debug('datajson catalog cache table created')
+
+# Whether the table is known to exist in this process.
+table_ready = False
+
+def ensure_table():
+    # Creates the table if it doesn't exist yet (e.g. the cache was turned on
+    # without running initdb). Returns False, after logging why, if that fails,
+    # in which case the cache can't be used. Once the table has been found it
+    # isn't checked again.
+    global table_ready
+    if not table_ready:
+        try:
+            setup()
+            table_ready = True
+        except SQLAlchemyError:
+            log.exception('the datajson catalog cache table could not be created')
+    return table_ready
+
+def is_usable():
+    # Whether requests can read the catalog from the cache.
+    return ensure_table() and is_filled()
+
+def invalidate_entry(package_id):
+    # Marks the package's entry as needing regeneration. If we haven't seen the
+    # package before (e.g. it was just created), add a placeholder row for it.
+    r = Session.execute(catalog_entry_table.update()
+        .where(catalog_entry_table.c.package_id == package_id)
+        .values(cached=None))
+    if r.rowcount == 0:
+        Session.execute(catalog_entry_table.insert().values(package_id=package_id, cached=None))
+
+def remove_entry(package_id):
+    Session.execute(catalog_entry_table.delete()
+        .where(catalog_entry_table.c.package_id == package_id))
+
+def remove_entries(package_ids):
+    for i in xrange(0, len(package_ids), 500):
+        Session.execute(catalog_entry_table.delete()
+            .where(catalog_entry_table.c.package_id.in_(package_ids[i:i+500])))
+
+# An arbitrary key for the PostgreSQL advisory lock that serializes refreshes.
+REFRESH_LOCK_KEY = 0x646a736e
+
+def lock_for_refresh():
+    # Waits for any other process refreshing the cache to finish, and keeps
+    # others out until this transaction ends. Only PostgreSQL has advisory
+    # locks, so with other databases (e.g. SQLite in tests) nothing is locked.
+    if Session.get_bind().dialect.name == "postgresql":
+        Session.execute("SELECT pg_advisory_xact_lock(%d)" % REFRESH_LOCK_KEY)
+
+def store_entry(pkg, plugin):
+    # Converts a package dict (as returned by package_source) and stores its
+    # entry, updating the package's row or adding one if there isn't one yet.
+    # Packages that aren't public and active don't appear in the catalog, so we
+    # just drop their rows. Callers must hold the refresh lock.
+    if pkg.get("state") != "active" or pkg.get("private"):
+        remove_entry(pkg["id"])
+        return
+    values = dict(
+        package_type=pkg["type"],
+        author=pkg["author"],
+        revision_timestamp=pkg["revision_timestamp"],
+        entry=json.dumps(make_datajson_entry(pkg, plugin)),
+        cached=datetime.datetime.utcnow(),
+        )
+    r = Session.execute(catalog_entry_table.update()
+        .where(catalog_entry_table.c.package_id == pkg["id"])
+        .values(**values))
+    if r.rowcount == 0:
+        Session.execute(catalog_entry_table.insert().values(package_id=pkg["id"], **values))
+
+def refresh_entries(package_ids, plugin):
+    packages = package_source.load_packages(package_ids)
+    for pkg in packages:
+        store_entry(pkg, plugin)
+
+    # packages that no longer exist at all
+    for package_id in set(package_ids) - set(pkg["id"] for pkg in packages):
+        remove_entry(package_id)
+
+def find_stale_entries(max_age=None):
+    stale = catalog_entry_table.c.cached == None
+    if max_age:
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=max_age)
+        stale = or_(stale, catalog_entry_table.c.cached < cutoff)
+    stale = and_(stale, catalog_entry_table.c.package_id != FILLED_MARKER)
+    return [row[0] for row in Session.execute(select([catalog_entry_table.c.package_id], stale))]
+
+def find_missing_entries():
+    # Returns the IDs of the public, active packages that have no row.
+    package = package_source.package
+    q = select([package.c.id], and_(
+        package.c.state == "active",
+        package.c.private == False,
+        ~exists().where(catalog_entry_table.c.package_id == package.c.id)))
+    return [row[0] for row in Session.execute(q)]
+
+def is_filled():
+    return Session.execute(select([catalog_entry_table.c.package_id],
+        catalog_entry_table.c.package_id == FILLED_MARKER)).first() is not None
+
+def mark_filled():
+    # Callers must hold the refresh lock.
+    if not is_filled():
+        Session.execute(catalog_entry_table.insert().values(package_id=FILLED_MARKER, cached=datetime.datetime.utcnow()))
+
+def refresh_stale_entries(plugin, max_age=None, add_missing=False):
+    # Regenerates entries that were invalidated and, if max_age (in seconds) is
+    # given, entries older than that. With add_missing, also adds entries for
+    # packages that have no row, after which the cache counts as filled.
+    # Returns the number of entries refreshed. If another process is already
+    # refreshing, this waits for it and then only does what it left.
+    def find():
+        package_ids = find_stale_entries(max_age)
+        if add_missing:
+            package_ids += find_missing_entries()
+        return package_ids
+    if len(find()) == 0 and (not add_missing or is_filled()): return 0
+    lock_for_refresh()
+    package_ids = find()
+
+    log.debug('refreshing %d stale datajson catalog entries' % len(package_ids))
+    for i in xrange(0, len(package_ids), plugin.page_size):
+        refresh_entries(package_ids[i:i+plugin.page_size], plugin)
+    if add_missing:
+        mark_filled()
+    Session.commit() # also releases the lock
+    return len(package_ids)
+
+def rebuild(plugin, packages):
+    # Throw away the whole cache and convert every package in 'packages' again.
+    lock_for_refresh()
+    Session.execute(catalog_entry_table.delete())
+    count = 0
+    for pkg in packages:
+        store_entry(pkg, plugin)
+        count += 1
+    mark_filled()
+    Session.commit()
+    return count
+
+def iter_catalog(plugin, authors=None):
+    # Yields the catalog entries, in the same order that make_json() produces them,
+    # optionally limited to datasets from a list of authors. Rows are read a page
+    # at a time so that we never hold the whole catalog in memory. Entries
+    # that were invalidated are regenerated first, but old ones and missing
+    # ones are left to the refresh-cache command. Only call this once the cache
+    # has been filled (see is_usable).
+    refresh_stale_entries(plugin)
+
+    where = catalog_entry_table.c.package_type == "dataset"
+    if authors is not None:
+        where = and_(where, catalog_entry_table.c.author.in_(authors))
+    q = select([catalog_entry_table.c.entry], where) \
+        .order_by(catalog_entry_table.c.revision_timestamp.desc(), catalog_entry_table.c.package_id)
+
+    offset = 0
+    while True:
+        rows = Session.execute(q.limit(plugin.page_size).offset(offset)).fetchall()
+        for row in rows:
+            yield json.loads(row[0], object_pairs_hook=OrderedDict)
+        if len(rows) < plugin.page_size: break
+        offset += len(rows)
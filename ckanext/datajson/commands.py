@@ -0,0 +1,148 @@
+from ckan.lib.cli import CkanCommand
+
+class DataJsonCommand(CkanCommand):
+    '''Manages the /data.json catalog
+
+    Usage:
+
+      datajson initdb
+        - Creates the database table that holds the catalog cache
+
+      datajson rebuild
+        - Regenerates every entry in the catalog cache
+
+      datajson refresh-cache
+        - Regenerates the catalog cache entries that were invalidated or are
+          older than ckanext.datajson.cache.max_age, and adds packages that
+          aren't in the cache yet (run it from cron)
+
+      datajson export {directory} [-p {processes}]
+        - Writes the data.json, data.jsonld and data.jsonhhs files (and
+          gzipped copies of them) into the directory, converting packages
+          in parallel. Defaults to one process per CPU.
+
+      datajson prune-harvest-objects [{days}]
+        - Deletes the harvest objects of data.json and CMS Data Navigator
+          sources that have been replaced by newer ones and are older than
+          the given number of days (by default the
+          ckanext.datajson.harvest_object_retention_days setting, or 30)
+
+      datajson refresh-bureau-codes
+        - Downloads the latest list of OMB bureau codes for the validator
+
+      datajson validate {url or file} [-p {processes}]
+        - Validates a data.json file and prints the problems found, with
+          some of the datasets that have each, checking large files in
+          parallel. Defaults to one process per CPU. With -p 1, if ijson is
+          installed, the file is checked as it is read and progress is shown.
+
+    The commands should be run from the ckanext-datajson directory and expect
+    a development.ini file to be present. Most of the time you will
+    specify the config explicitly though::
+
+        paster datajson rebuild --config=../ckan/development.ini
+    '''
+
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = 2
+    min_args = 1
+
+    def __init__(self, name):
+        super(DataJsonCommand, self).__init__(name)
+        self.parser.add_option('-p', '--processes', dest='processes', type='int', default=None,
+            help='Number of processes to use')
+
+    def command(self):
+        self._load_config()
+
+        cmd = self.args[0]
+        if cmd == 'initdb':
+            self.initdb()
+        elif cmd == 'rebuild':
+            self.rebuild()
+        elif cmd == 'refresh-cache':
+            self.refresh_cache()
+        elif cmd == 'export':
+            if len(self.args) != 2:
+                print 'Please specify a directory to write the files to'
+                return
+            self.export(self.args[1])
+        elif cmd == 'prune-harvest-objects':
+            from ckanext.datajson.plugin import DataJsonPlugin
+            from pylons import config
+            if not DataJsonPlugin.harvest_settings_loaded: # only datajson_harvest is enabled
+                DataJsonPlugin.load_harvest_settings(config)
+            days = DataJsonPlugin.harvest_object_retention_days
+            if len(self.args) == 2:
+                try:
+                    days = int(self.args[1])
+                    if days < 0: raise ValueError()
+                except ValueError:
+                    print 'The number of days must be a whole number, e.g.: datajson prune-harvest-objects 30'
+                    return
+            self.prune_harvest_objects(days)
+        elif cmd == 'refresh-bureau-codes':
+            self.refresh_bureau_codes()
+        elif cmd == 'validate':
+            if len(self.args) != 2:
+                print 'Please specify the URL or path of a data.json file'
+                return
+            self.validate(self.args[1])
+        else:
+            print 'Command %s not recognized' % cmd
+
+    def initdb(self):
+        from ckanext.datajson import catalog_cache
+        catalog_cache.setup()
+        print 'Catalog cache table created'
+
+    def rebuild(self):
+        from ckanext.datajson import catalog_cache
+        from ckanext.datajson.plugin import DataJsonPlugin, iter_packages
+        count = catalog_cache.rebuild(DataJsonPlugin, iter_packages(package_type=None))
+        print 'Catalog cache rebuilt with %d packages' % count
+
+    def refresh_cache(self):
+        from ckanext.datajson import catalog_cache
+        from ckanext.datajson.plugin import DataJsonPlugin
+        count = catalog_cache.refresh_stale_entries(DataJsonPlugin, max_age=DataJsonPlugin.cache_max_age, add_missing=True)
+        print 'Refreshed %d catalog cache entries' % count
+
+    def export(self, directory):
+        from ckanext.datajson.export import export_catalog
+        count = export_catalog(directory, processes=self.options.processes)
+        print 'Exported %d datasets to %s' % (count, directory)
+
+    def prune_harvest_objects(self, days):
+        from ckanext.datajson.harvest_retention import prune_harvest_objects
+        count = prune_harvest_objects(days)
+        print 'Deleted %d harvest objects older than %d days' % (count, days)
+
+    def refresh_bureau_codes(self):
+        from ckanext.datajson.validator import refresh_omb_bureau_codes, omb_bureau_codes_path
+        count = refresh_omb_bureau_codes()
+        print 'Saved %d OMB bureau codes to %s' % (count, omb_bureau_codes_path())
+
+    def validate(self, source):
+        import json, urllib, sys
+        from ckanext.datajson import validator
+        f = urllib.urlopen(source)
+        errors = []
+        if self.options.processes == 1 and validator.ijson is not None:
+            # Check the file as it downloads, saying how it's going along the way.
+            def progress(v):
+                print >>sys.stderr, '%d datasets checked, %d kinds of problems so far' % (v.count, len(v.errs.errors))
+            count = validator.validate_stream(f, source, errors, progress=progress, samples=True)
+            print '%d datasets' % count
+        else:
+            doc = json.load(f)
+            validator.do_validation(doc, source, errors, processes=self.options.processes, samples=True)
+            if type(doc) == list:
+                print '%d datasets' % len(doc)
+        for heading, descriptions in errors:
+            print heading
+            for description in descriptions:
+                print '  ' + description.encode('utf8')
+        if len(errors) == 0:
+            print 'No errors'
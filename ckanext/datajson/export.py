@@ -0,0 +1,119 @@
+import os, gzip, tempfile, multiprocessing
+
+from ckan import model
+
+import package_source, json_stream
+from package_to_pod import make_datajson_entry
+from pod_jsonld import dataset_to_jsonld
+from plugin import DataJsonPlugin, HHS_AUTHORS, make_jsonld_header, json_style
+
+import logging
+log = logging.getLogger(__name__)
+
+# Writes the data.json, data.jsonld and data.jsonhhs files to disk outside of
+# a web request. Converting packages to POD entries is the slow part, so it's
+# spread across a pool of processes that each take a page of package IDs. The
+# pool returns the pages in the order they were handed out, so the files come
+# out exactly the same as the web server would send them.
+
+def convert_page(package_ids):
+    # Returns the author and the encoded data.json and JSON-LD entries of each
+    # package, in the order given.
+    indent, separators = json_style()
+    encoder = json_stream.ArrayWriter(indent=indent, separators=separators)
+    ret = []
+    for pkg in package_source.load_packages(package_ids):
+        entry = make_datajson_entry(pkg, DataJsonPlugin)
+        ret.append((pkg["author"], encoder.encode(entry), encoder.encode(dataset_to_jsonld(entry))))
+    model.Session.remove()
+    return ret
+
+class CatalogFile(object):
+    '''
+    An output file, with a gzipped copy for web servers that can send
+    pre-compressed files (e.g. nginx's gzip_static). Both are written to
+    temporary files and renamed into place once complete.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path) or "."
+        fd, self.temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        self.f = os.fdopen(fd, "wb")
+        fd, self.temp_gz_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        self.gz_file = os.fdopen(fd, "wb")
+        self.gz = gzip.GzipFile(filename="", mode="wb", compresslevel=9, fileobj=self.gz_file, mtime=0)
+
+    def write(self, chunk):
+        self.f.write(chunk)
+        self.gz.write(chunk)
+
+    def commit(self):
+        self.gz.close()
+        self.gz_file.close()
+        self.f.close()
+        for temp_path in (self.temp_path, self.temp_gz_path):
+            os.chmod(temp_path, 0644) # mkstemp creates files only we can read
+        os.rename(self.temp_gz_path, self.path + ".gz")
+        os.rename(self.temp_path, self.path)
+
+    def abort(self):
+        for f in (self.gz_file, self.f):
+            f.close()
+        for temp_path in (self.temp_path, self.temp_gz_path):
+            if os.path.exists(temp_path): os.unlink(temp_path)
+
+def export_catalog(directory, processes=None):
+    # Writes the three catalog files into the directory, named like the last
+    # part of their configured paths. Returns the number of datasets written.
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    indent, separators = json_style()
+
+    json_file = CatalogFile(os.path.join(directory, os.path.basename(DataJsonPlugin.route_path)))
+    hhs_file = CatalogFile(os.path.join(directory, os.path.basename(DataJsonPlugin.route_hhs_path)))
+    ld_file = CatalogFile(os.path.join(directory, os.path.basename(DataJsonPlugin.route_ld_path)))
+    files = (json_file, hhs_file, ld_file)
+
+    json_list = json_stream.ArrayWriter(indent=indent, separators=separators)
+    hhs_list = json_stream.ArrayWriter(indent=indent, separators=separators)
+    ld_list = json_stream.ArrayWriter(indent=indent, level=1, separators=separators)
+    ld_file.write(json_stream.json_object_head(make_jsonld_header(), "dcat:dataset", indent=indent, separators=separators))
+
+    hhs_authors = set(HHS_AUTHORS)
+    count = 0
+
+    # Hand out pages of package IDs to the workers. The IDs are queried lazily
+    # in the parent as the workers ask for more work. Forked workers must not
+    # share the parent's database connections, so let go of them before
+    # starting the pool.
+    id_pages = package_source.iter_package_id_pages(DataJsonPlugin.page_size)
+    model.Session.remove()
+    model.meta.engine.dispose()
+    pool = multiprocessing.Pool(processes)
+    try:
+        for page in pool.imap(convert_page, id_pages):
+            for author, entry, ld_entry in page:
+                json_file.write(json_list.item(entry))
+                if author in hhs_authors:
+                    hhs_file.write(hhs_list.item(entry))
+                ld_file.write(ld_list.item(ld_entry))
+                count += 1
+        pool.close()
+    except:
+        pool.terminate()
+        for f in files:
+            f.abort()
+        raise
+    finally:
+        pool.join()
+
+    json_file.write(json_list.close())
+    hhs_file.write(hhs_list.close())
+    ld_file.write(ld_list.close())
+    ld_file.write(json_stream.json_object_tail(indent=indent))
+    for f in files:
+        f.commit()
+
+    log.info('exported %d datasets to %s' % (count, directory))
+    return count
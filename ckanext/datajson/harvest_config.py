@@ -0,0 +1,63 @@
+import hashlib, threading, yaml
+from collections import OrderedDict
+
+from harvest_filter import compile_rules
+
+# Harvest source configurations, parsed once and reused. Harvesting a source
+# consults its configuration for every dataset in both the gather and import
+# stages, and parsing the YAML each time adds up. Parsed configurations are
+# cached by their text, so editing a source's configuration takes effect with
+# the next harvest job.
+
+CACHE_SIZE = 32
+
+cache = OrderedDict()
+cache_lock = threading.Lock()
+
+class HarvestSourceConfig(dict):
+    '''
+    A harvest source's configuration: the dict from its YAML with "filters",
+    "excludes", "defaults" and "overrides" always present as dicts. Since it is
+    shared, it must not be modified.
+    '''
+
+    def __init__(self, text):
+        # Load the harvest source's configuration data. We expect it to be a YAML
+        # string. Unfortunately I went ahead of CKAN on this. The stock CKAN harvester
+        # only allows JSON in the configuration box. My fork is necessary for this
+        # to work: https://github.com/joshdata/ckanext-harvest
+        ret = yaml.load(text)
+        if not isinstance(ret, dict): ret = { }
+
+        # ensure that some expected keys are present and have dictionary values
+        for key in ("filters", "excludes", "defaults", "overrides"):
+            if not isinstance(ret.get(key), dict):
+                ret[key] = { }
+
+        dict.__init__(self, ret)
+        self.text = text
+        self.encoded_text = text.encode("utf8")
+        self.digest = hashlib.sha1(self.encoded_text).hexdigest()
+        self.filter_rules = compile_rules(self["filters"], self["excludes"])
+        self.hash_suffixes = { }
+
+    def hash_suffix(self, harvester_version):
+        # The part of a dataset's source_hash that comes after the dataset's own
+        # JSON (see DatasetHarvesterBase.make_content_hash).
+        suffix = self.hash_suffixes.get(harvester_version)
+        if suffix is None:
+            suffix = "|" + self.encoded_text + "|" + harvester_version
+            self.hash_suffixes[harvester_version] = suffix
+        return suffix
+
+def load(text):
+    # Returns the HarvestSourceConfig for a harvest source's configuration text.
+    text = text or u""
+    with cache_lock:
+        config = cache.pop(text, None)
+        if config is None:
+            config = HarvestSourceConfig(text)
+        cache[text] = config # most recently used goes last
+        while len(cache) > CACHE_SIZE:
+            cache.popitem(last=False)
+        return config
@@ -0,0 +1,142 @@
+import re
+
+import logging
+log = logging.getLogger("harvester")
+
+# The 'filters' and 'excludes' of a harvest source's configuration, compiled
+# once per harvest job rather than re-interpreted for every dataset.
+#
+# A filter maps a data.json field to the values it may have. A dataset passes
+# if its value is one of them, or if its value is a list, if any of the list's
+# items is one of them.
+#
+# An exclude maps a field to values that it must not have. Values surrounded by
+# forward slashes, e.g. "/mypattern/", are regular expressions which exclude a
+# dataset if they match anywhere in the (string form of the) field's value.
+
+class ValueSet(object):
+    '''
+    The values listed for a field in the configuration. Membership is tested with
+    a set when possible, falling back to the list for values that can't be hashed.
+    '''
+
+    def __init__(self, values):
+        self.values = values
+        if isinstance(values, (list, tuple)):
+            self.value_set = frozenset(v for v in values if is_hashable(v))
+        else:
+            self.value_set = None # e.g. a string, whose 'in' means something else
+
+    def __contains__(self, value):
+        if self.value_set is None:
+            return value in self.values
+        try:
+            return value in self.value_set
+        except TypeError: # value can't be hashed, e.g. a dict
+            return value in self.values
+
+    def intersects(self, values):
+        for value in values:
+            if value in self:
+                return True
+        return False
+
+class FilterRule(object):
+    def __init__(self, field, values):
+        self.field = field
+        self.values = ValueSet(values)
+        self.name = 'filters[%s]' % field
+
+    def rejects(self, dataset):
+        value = dataset.get(self.field)
+        if isinstance(value, list):
+            return not self.values.intersects(value)
+        return value not in self.values
+
+class ExcludeRule(object):
+    def __init__(self, field, values):
+        self.field = field
+        self.values = ValueSet(values)
+        self.name = 'excludes[%s]' % field
+
+        # Compile the regular expressions. Those that can be are also combined
+        # into a single alternation so that a value is scanned once for all of
+        # them. Patterns with groups or inline flags would mean something else
+        # inside a larger expression, so those are searched for separately.
+        self.patterns = []
+        combinable = []
+        separate = []
+        for pattern in (values if isinstance(values, (list, tuple)) else []):
+            if not isinstance(pattern, basestring) or not re.match("^/.*/$", pattern): continue
+            regex = re.compile(pattern[1:-1])
+            self.patterns.append((pattern, regex))
+            if regex.groups == 0 and "(?" not in pattern:
+                combinable.append(pattern[1:-1])
+            else:
+                separate.append(regex)
+        if len(combinable) > 1:
+            separate.insert(0, re.compile("|".join("(?:%s)" % p for p in combinable)))
+        elif combinable:
+            separate.insert(0, re.compile(combinable[0]))
+        self.regexes = separate
+
+    def match(self, dataset):
+        # Returns the name of the part of the rule that excludes the dataset, or
+        # None if it doesn't.
+        value = dataset.get(self.field)
+        if value in self.values:
+            return self.name
+        if not self.regexes:
+            return None
+        value = unicode(value)
+        for regex in self.regexes:
+            if regex.search(value):
+                # Only now work out which pattern it was, for the statistics.
+                for pattern, regex in self.patterns:
+                    if regex.search(value):
+                        return '%s %s' % (self.name, pattern)
+        return None
+
+def compile_rules(filters, excludes):
+    # Returns the compiled rules for a HarvestFilter. They can be shared by any
+    # number of filters.
+    return ([FilterRule(k, v) for k, v in sorted(filters.items())],
+            [ExcludeRule(k, v) for k, v in sorted(excludes.items())])
+
+class HarvestFilter(object):
+    '''
+    Decides which datasets in a remote catalog to import, and counts how many
+    datasets each rule eliminated.
+    '''
+
+    def __init__(self, rules):
+        self.filters, self.excludes = rules
+        self.rejections = { }
+
+    def rejects(self, dataset):
+        # Returns the name of the rule that eliminates the dataset, or None if
+        # the dataset should be imported.
+        for rule in self.filters:
+            if rule.rejects(dataset):
+                return self.reject(dataset, rule.name)
+        for rule in self.excludes:
+            name = rule.match(dataset)
+            if name is not None:
+                return self.reject(dataset, name)
+        return None
+
+    def reject(self, dataset, name):
+        log.debug('"%s" eliminated by %s', dataset.get("title"), name)
+        self.rejections[name] = self.rejections.get(name, 0) + 1
+        return name
+
+    def log_rejections(self, url):
+        for name, count in sorted(self.rejections.items()):
+            log.info('%d datasets in %s eliminated by %s' % (count, url, name))
+
+def is_hashable(value):
+    try:
+        hash(value)
+        return True
+    except TypeError:
+        return False
@@ -0,0 +1,51 @@
+import datetime
+
+from ckan import model
+from ckanext.harvest.model import HarvestSource, HarvestObject, HarvestObjectError, HarvestObjectExtra
+from sqlalchemy import and_, exists
+
+import logging
+log = logging.getLogger(__name__)
+
+# Every harvest of a changed dataset leaves a new HarvestObject holding a copy
+# of the dataset's metadata, and the old ones are kept (marked not current)
+# forever. This deletes the old ones past a certain age, but only for sources
+# harvested by this extension's harvesters, leaving other harvesters' history
+# alone.
+
+# The 'name' in the info() of each of our harvesters.
+SOURCE_TYPES = ("datajson", "cms-data-navigator")
+
+def prune_harvest_objects(max_age_days, batch_size=1000):
+    # Deletes HarvestObjects that are no longer current, are done being
+    # imported, and were gathered more than max_age_days ago, along with their
+    # errors and extras. Objects whose package is still waiting for deferred
+    # indexing (see DatasetHarvesterBase.import_stage) are kept until it is
+    # done. Returns the number of HarvestObjects deleted.
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=max_age_days)
+    index_pending = exists().where(and_(
+        HarvestObjectExtra.harvest_object_id == HarvestObject.id,
+        HarvestObjectExtra.key == "datajson_index_pending"))
+    q = model.Session.query(HarvestObject.id) \
+        .join(HarvestSource, HarvestObject.harvest_source_id == HarvestSource.id) \
+        .filter(HarvestSource.type.in_(SOURCE_TYPES)) \
+        .filter(~index_pending) \
+        .filter(HarvestObject.current == False) \
+        .filter(HarvestObject.gathered < cutoff) \
+        .filter((HarvestObject.import_finished != None) | HarvestObject.state.in_(["COMPLETE", "ERROR"]))
+
+    count = 0
+    while True:
+        ids = [row[0] for row in q.limit(batch_size)]
+        if len(ids) == 0: break
+        for table in (HarvestObjectError, HarvestObjectExtra):
+            model.Session.query(table) \
+                .filter(table.harvest_object_id.in_(ids)) \
+                .delete(synchronize_session=False)
+        model.Session.query(HarvestObject) \
+            .filter(HarvestObject.id.in_(ids)) \
+            .delete(synchronize_session=False)
+        model.Session.commit()
+        count += len(ids)
+        log.debug('deleted %d old harvest objects' % count)
+    return count
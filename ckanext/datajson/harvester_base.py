@@ -1,16 +1,26 @@
 from ckan.lib.base import c
 from ckan import model
-from ckan.model import Session, Package
+from ckan.model import Session, Package, PackageExtra
 from ckan.logic import ValidationError, NotFound, get_action
 from ckan.lib.munge import munge_title_to_name
 from ckan.lib.search.index import PackageSearchIndex
+from ckan.lib.search.common import make_connection
 
 from ckanext.harvest.model import HarvestJob, HarvestObject, HarvestGatherError, \
-                                    HarvestObjectError
+                                    HarvestObjectError, HarvestObjectExtra
 from ckanext.harvest.harvesters.base import HarvesterBase
 from plugin import DataJsonPlugin
+from remote_catalog import CatalogSnapshot
+from harvest_filter import HarvestFilter
+from package_names import PackageNameAllocator
+from package_extras import PackageExtras
+import harvest_config, catalog_cache, search_indexing
 
-import uuid, datetime, hashlib, urllib2, json, yaml, re, smtplib
+from pylons import config as ckan_config
+from sqlalchemy import and_, bindparam, exists
+
+import uuid, datetime, hashlib, urllib2, json, yaml, re, smtplib, threading, itertools
+from multiprocessing.pool import ThreadPool
 from smtplib import SMTP
 from email.mime.text import MIMEText
 
@@ -31,6 +41,26 @@ class DatasetHarvesterBase(HarvesterBase):
     #        'description': 'Abstract base class for harvesters that pull in datasets.',
     #    }
 
+    # While import_objects is running, the package names that have been handed
+    # out but perhaps not saved yet, mapped to the GUID of the package they're for.
+    reserved_package_names = None
+    package_name_lock = threading.Lock()
+
+    # With more than one import worker, the number of a job's objects that
+    # import_stage imports together, per worker.
+    import_batch_size_per_worker = 25
+
+    # Harvest job IDs mapped to the remote catalog snapshot that the job's gather
+    # stage is reading, until the gather stage finishes.
+    snapshots_in_progress = { }
+
+    def settings(self):
+        # Returns DataJsonPlugin, whose class attributes hold the harvest
+        # settings, loading them first if the datajson plugin isn't enabled.
+        if not DataJsonPlugin.harvest_settings_loaded:
+            DataJsonPlugin.load_harvest_settings(ckan_config)
+        return DataJsonPlugin
+
     def validate_config(self, config):
         if not config:
             return config
@@ -38,19 +68,9 @@ class DatasetHarvesterBase(HarvesterBase):
         return config
 
     def load_config(self, harvest_source):
-        # Load the harvest source's configuration data. We expect it to be a YAML
-        # string. Unfortunately I went ahead of CKAN on this. The stock CKAN harvester
-        # only allows JSON in the configuration box. My fork is necessary for this
-        # to work: https://github.com/joshdata/ckanext-harvest
-        ret = yaml.load(harvest_source.config)
-        if not isinstance(ret, dict): ret = { }
-
-        # ensure that some expected keys are present and have dictionary values
-        for key in ("filters", "excludes", "defaults", "overrides"):
-            if not isinstance(ret.get(key), dict):
-                ret[key] = { }
-
-        return ret
+        # Returns the harvest source's parsed configuration (a HarvestSourceConfig,
+        # a dict that must not be modified). See harvest_config.
+        return harvest_config.load(harvest_source.config)
 
     def context(self):
         # Reusing the dict across calls to action methods can be dangerous, so
@@ -63,91 +83,126 @@ class DatasetHarvesterBase(HarvesterBase):
     # SUBCLASSES MUST IMPLEMENT
     def load_remote_catalog(self, harvest_job):
         # Loads a remote data catalog. This function must return a JSON-able
-        # list of dicts, each dict a dataset containing an 'identifier' field
-        # with a locally unique identifier string and a 'title' field.
+        # list (or other iterable, such as a generator) of dicts, each dict a
+        # dataset containing an 'identifier' field with a locally unique
+        # identifier string and a 'title' field.
         raise Exception("Not implemented")
 
+    def open_remote_catalog(self, harvest_job, timeout=None):
+        # Opens the harvest source's remote file for load_remote_catalog. If
+        # ckanext.datajson.harvest_snapshot_dir is set, the file is fetched with
+        # a conditional request into a local snapshot, which is opened instead.
+        # Returns None if the file hasn't changed since it was last harvested in
+        # full with the same configuration, in which case there's nothing to do.
+        url = harvest_job.source.url
+        snapshot = self.get_snapshot(harvest_job.source)
+        if snapshot is None:
+            return urllib2.urlopen(url, None, timeout)
+
+        changed = snapshot.fetch(url, timeout)
+        if not changed and snapshot.is_processed(self.make_snapshot_state(harvest_job.source)) \
+            and not self.previous_job_had_errors(harvest_job):
+            log.info('%s has not changed since it was last harvested' % url)
+            return None
+
+        self.snapshots_in_progress[harvest_job.id] = snapshot
+        return snapshot.open()
+
+    def get_snapshot(self, harvest_source):
+        snapshot_dir = self.settings().harvest_snapshot_dir
+        if not snapshot_dir: return None
+        return CatalogSnapshot(snapshot_dir, harvest_source.id)
+
+    def make_snapshot_state(self, harvest_source):
+        # A snapshot that was harvested with a different configuration or version
+        # of the harvester has to be harvested again.
+        return [self.load_config(harvest_source).digest, self.HARVESTER_VERSION]
+
+    def previous_job_had_errors(self, harvest_job):
+        # If some datasets failed last time, don't skip the source even though it
+        # hasn't changed, so that they're tried again.
+        previous_job = model.Session.query(HarvestJob) \
+            .filter(HarvestJob.source_id == harvest_job.source_id) \
+            .filter(HarvestJob.id != harvest_job.id) \
+            .order_by(HarvestJob.created.desc()) \
+            .first()
+        if previous_job is None:
+            return False
+        return model.Session.query(HarvestObject.id) \
+            .filter(HarvestObject.harvest_job_id == previous_job.id) \
+            .filter(HarvestObject.state == "ERROR") \
+            .count() > 0 \
+            or model.Session.query(HarvestGatherError.id) \
+            .filter(HarvestGatherError.harvest_job_id == previous_job.id) \
+            .count() > 0
+
     def gather_stage(self, harvest_job):
         # The gather stage scans a remote resource (like a /data.json file) for
         # a list of datasets to import.
 
         log.debug('In %s gather_stage (%s)' % (repr(self), harvest_job.source.url))
 
+        # Index any packages whose indexing was deferred by the last harvest but
+        # that were never indexed (see import_stage).
+        self.flush_deferred_indexing(harvest_job.source)
+
+        try:
+            object_ids = self.gather_datasets(harvest_job)
+        finally:
+            snapshot = self.snapshots_in_progress.pop(harvest_job.id, None)
+
+        # The snapshot has been harvested, so if it's the same next time the
+        # gather stage can be skipped. (If the gather stage failed, or held off
+        # on deleting datasets, the snapshot isn't here to be marked.)
+        if snapshot is not None:
+            snapshot.mark_processed(self.make_snapshot_state(harvest_job.source))
+
+        return object_ids
+
+    def gather_datasets(self, harvest_job):
+        # Creates HarvestObjects for new and changed datasets in the remote
+        # catalog and deletes packages for datasets that have disappeared from
+        # it. Returns the IDs of the new HarvestObjects.
+
         # Start gathering.
-        source = self.load_remote_catalog(harvest_job)
-        if len(source) == 0: return []
+        # If there's nothing in it, stop now. Don't delete every package!
+        source = iter(self.load_remote_catalog(harvest_job))
+        try:
+            first_dataset = next(source)
+        except StopIteration:
+            return []
+        source = itertools.chain([first_dataset], source)
 
         # Loop through the packages we've already imported from this source
         # and go into their extra fields to get their source_identifier,
         # which corresponds to the remote catalog's 'identifier' field.
         # Make a mapping so we know how to update existing records.
-        existing_datasets = { }
-        for hobj in model.Session.query(HarvestObject).filter_by(source=harvest_job.source, current=True):
-            try:
-                pkg = get_action('package_show')(self.context(), { "id": hobj.package_id })
-            except:
-                # reference is broken
-                continue
-            sid = self.find_extra(pkg, "source_identifier")
-            if sid:
-                existing_datasets[sid] = pkg
+        existing_datasets = self.find_existing_datasets(harvest_job.source)
                     
         # Create HarvestObjects for any records in the remote catalog.
             
         object_ids = []
+        new_objects = [] # (HarvestObject ID, GUID, title)
         seen_datasets = set()
         dataset_count = len(existing_datasets)
         
         config = self.load_config(harvest_job.source)
+        dataset_filter = HarvestFilter(config.filter_rules)
 
 #        dataset_count = 0
         for dataset in source:
             # Create a new HarvestObject for this dataset and save the
             # dataset metdata inside it for later.
 
-            # Check the config's filters to see if we should import this dataset.
-            # For each filter, check that the value specified in the data.json file
-            # is among the permitted values in the filter specification.
-            matched_filters = True
-            for k, v in config["filters"].items():
-                value = dataset.get(k)
-                if isinstance(value, list):
-                    if len(set(value).intersection(set(v))) == 0:
-                        log.info('"%s" eliminated by filters (%s not one of %s, saw %s)' % (dataset["title"], k, v, value))
-                        matched_filters = False
-                else:
-                    if value not in v:
-                        log.info('"%s" eliminated by filters (%s not one of %s, saw %s)' % (dataset["title"], k, v, value))
-                        matched_filters = False
-#                if value not in v:
-#                    log.info('"%s" eliminated by filters (%s not one of %s, saw %s)' % (dataset["title"], k, v, value))
-#                    matched_filters = False
-            if not matched_filters:
+            # Check the config's filters and excludes to see if we should import
+            # this dataset.
+            if dataset_filter.rejects(dataset) is not None:
                 continue
 
-            # Check the config's excludes to see if we should NOT import this dataset.
-            matched_excludes = False
-            for k, v in config["excludes"].items():
-                # See if the value appears exactly in the list.
-                value = dataset.get(k)
-                if value in v:
-                    log.info('"%s" eliminated by excludes (%s matches %s)' % (dataset["title"], k, v))
-                    matched_excludes = True
-
-                # For any regex in the list, see if the regex matches. Specify regexes
-                # by surrounding them in forward slashes, e.g. "/mypattern/". Must turn
-                # the value into a string though,
-                value = unicode(value)
-                for pattern in v:
-                    if not re.match("^/.*/$", pattern): continue
-                    pattern = pattern[1:-1] # strip slashes
-                    if re.search(pattern, value):
-                        log.info('"%s" eliminated by excludes (%s matches %s)' % (dataset["title"], k, pattern))
-                        matched_excludes = True
-            if matched_excludes:
-            	log.warn('"%s" eliminated by excludes' % dataset["title"])
-                continue
-            
+            # Serialize the dataset once. This string is both what gets stored in
+            # the HarvestObject and what the dataset's source_hash is computed from.
+            content = json.dumps(dataset, sort_keys=True) # use sort_keys to preserve field order so hashes of this string are constant from run to run
+
             # Get the package_id of this resource if we've already imported
             # it into our system. Otherwise, assign a brand new GUID to the
             # HarvestObject. I'm not sure what the point is of that.
@@ -161,7 +216,7 @@ class DatasetHarvesterBase(HarvesterBase):
                 # in the package so we can avoid updating datasets that
                 # don't look like they've changed.
                 if pkg.get("state") == "active" \
-                    and self.find_extra(pkg, "source_hash") == self.make_upstream_content_hash(dataset, harvest_job.source):
+                    and self.find_extra(pkg, "source_hash") == self.make_content_hash(content, config):
                     continue
             else:
                 pkg_id = uuid.uuid4().hex
@@ -172,9 +227,20 @@ class DatasetHarvesterBase(HarvesterBase):
             obj = HarvestObject(
                 guid=pkg_id,
                 job=harvest_job,
-                content=json.dumps(dataset, sort_keys=True)) # use sort_keys to preserve field order so hashes of this string are constant from run to run
+                content=content)
             obj.save()
             object_ids.append(obj.id)
+            new_objects.append((obj.id, obj.guid, dataset["title"]))
+
+            # Don't keep the object, and with it the dataset's content, in the
+            # session for the rest of the gather stage.
+            model.Session.expunge(obj)
+
+        dataset_filter.log_rejections(harvest_job.source.url)
+
+        # Name all of the packages now, together, and leave the names for the
+        # import stage.
+        self.store_package_names(new_objects)
 
         # Count packages we plan to remove. If it's too many, we won't actually
         # actually do it.
@@ -185,54 +251,298 @@ class DatasetHarvesterBase(HarvesterBase):
             deletia+=1
 
         log.warn('%d datasets in %s; marked %d for deletion' % (dataset_count, harvest_job.source.url, deletia))
-        if dataset_count > 0 and float(deletia)/float(dataset_count) > 0.1 and DataJsonPlugin.allow_harvester_deletion != "true":
+        settings = self.settings()
+        if dataset_count > 0 and float(deletia)/float(dataset_count) > 0.1 and settings.allow_harvester_deletion != "true":
             log.warn('Too many deleted datasets in %s, skipping deletion' % (harvest_job.source.url))
             package_titles = u"The following datasets have been dropped from this feed, but since there are so many I'm going to hold off on actually deleting them:\n\n"
             for upstreamid, pkg in existing_datasets.items():
                 if upstreamid in seen_datasets: continue # was just updated
                 if pkg.get("state") == "deleted": continue # already deleted
-                log.warn('%s (%s) would be deleted %s' % (pkg["title"], pkg["id"], DataJsonPlugin.allow_harvester_deletion))
+                log.warn('%s (%s) would be deleted %s' % (pkg["title"], pkg["id"], settings.allow_harvester_deletion))
                 package_titles += pkg["title"] + "\n\n"
             msg = MIMEText(package_titles, _charset='utf-8')
             msg['Subject'] = "Harvested dataset "+harvest_job.source.url+" has too many deletions!"
-            msg['From'] = DataJsonPlugin.error_email_from
-            msg['To'] = DataJsonPlugin.email_to
+            msg['From'] = settings.error_email_from
+            msg['To'] = settings.email_to
             server = smtplib.SMTP('localhost')
-            server.sendmail(DataJsonPlugin.error_email_from, DataJsonPlugin.email_to.split(","), msg.as_string())
+            server.sendmail(settings.error_email_from, settings.email_to.split(","), msg.as_string())
             server.quit()
+
+            # The deletions haven't been done, so don't let the gather stage mark
+            # the snapshot as processed, or they'd never be considered again
+            # while the remote file stays the same.
+            self.snapshots_in_progress.pop(harvest_job.id, None)
             return object_ids
 
  
         # Remove packages no longer in the remote catalog.
+        deleted_packages = []
         for upstreamid, pkg in existing_datasets.items():
             if upstreamid in seen_datasets: continue # was just updated
             if pkg.get("state") == "deleted": continue # already deleted
-            pkg["state"] = "deleted"
-            pkg["name"] = self.make_package_name(pkg["title"], pkg["id"], True) # try to prevent name clash by giving it a "deleted-" name
-#            log.warn('deleting package %s (%s) because it is no longer in %s' % (pkg["name"], pkg["id"], harvest_job.source.url))
-            get_action('package_update')(self.context(), pkg)
+            deleted_packages.append(pkg)
+        self.delete_packages(deleted_packages, harvest_job.source)
             
         return object_ids
 
+    def find_existing_datasets(self, harvest_source):
+        # Returns a dict mapping the source_identifier of each package that is
+        # currently linked to the harvest source to a small package dict with
+        # its id, state, name, title, and source_identifier and source_hash extras.
+        # Rather than calling package_show for each package, this reads just
+        # those fields for all of them in one query.
+        existing_datasets = { }
+        packages = { }
+        q = model.Session.query(HarvestObject.package_id, Package.state, Package.name, Package.title, PackageExtra.key, PackageExtra.value) \
+            .join(Package, Package.id == HarvestObject.package_id) \
+            .outerjoin(PackageExtra, and_(PackageExtra.package_id == Package.id,
+                PackageExtra.key.in_(["source_identifier", "source_hash"]),
+                PackageExtra.state == "active")) \
+            .filter(HarvestObject.harvest_source_id == harvest_source.id) \
+            .filter(HarvestObject.current == True)
+        for package_id, state, name, title, key, value in q:
+            pkg = packages.setdefault(package_id, { "id": package_id, "state": state, "name": name, "title": title, "extras": [] })
+            if key is not None:
+                pkg["extras"].append({ "key": key, "value": value })
+
+        for pkg in packages.values():
+            sid = self.find_extra(pkg, "source_identifier")
+            if sid:
+                existing_datasets[sid] = pkg
+        return existing_datasets
+
+    def delete_packages(self, packages, harvest_source):
+        # Soft-deletes packages (small dicts as returned by find_existing_datasets)
+        # and gives them "deleted-" names to try to prevent name clashes. Rather
+        # than calling package_update for each, which saves and re-indexes the
+        # whole package, this updates the package table directly, the way CKAN's
+        # bulk_update_delete action does, and removes the packages from the search
+        # index in batches with a single commit.
+        if len(packages) == 0: return
+        log.warn('deleting %d packages no longer in %s' % (len(packages), harvest_source.url))
+
+        names = self.make_deleted_package_names(packages)
+        params = [{ "b_id": pkg["id"], "b_name": names[pkg["id"]] } for pkg in packages]
+        values = { "state": "deleted", "name": bindparam("b_name"), "metadata_modified": datetime.datetime.utcnow() }
+        model.Session.execute(model.package_table.update()
+            .where(model.package_table.c.id == bindparam("b_id"))
+            .values(**values), params)
+        model.Session.execute(model.package_revision_table.update()
+            .where(model.package_revision_table.c.id == bindparam("b_id"))
+            .where(model.package_revision_table.c.current == True)
+            .values(**values), params)
+
+        # The database was changed behind CKAN's back, so the catalog cache
+        # doesn't know about it.
+        package_ids = [pkg["id"] for pkg in packages]
+        if self.settings().cache_enabled:
+            catalog_cache.remove_entries(package_ids)
+        model.Session.commit()
+
+        self.unindex_packages(package_ids)
+
+    def make_deleted_package_names(self, packages):
+        # Returns a dict mapping the ID of each package to the name it should get
+        # when it is deleted: "deleted-" and its munged title, unless that name is
+        # taken by another package, in which case it keeps its current name.
+        return PackageNameAllocator().allocate([(pkg["id"], pkg["title"], True) for pkg in packages])
+
+    def unindex_packages(self, package_ids, batch_size=100):
+        # Removes packages from the search index with one delete query per batch
+        # and one commit at the end.
+        conn = make_connection()
+        try:
+            for i in xrange(0, len(package_ids), batch_size):
+                ids = " OR ".join('"%s"' % package_id for package_id in package_ids[i:i+batch_size])
+                conn.delete_query('+entity_type:package +id:(%s) +site_id:"%s"' % (ids, ckan_config.get("ckan.site_id")))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def index_packages(self, package_ids, batch_size=100):
+        # Adds packages to the search index with one add request per batch and
+        # one commit at the end. PackageSearchIndex builds each package's Solr
+        # document, which is collected rather than sent on its own.
+        psi = PackageSearchIndex()
+        conn = make_connection()
+        try:
+            for i in xrange(0, len(package_ids), batch_size):
+                with search_indexing.collecting() as collector:
+                    for package_id in package_ids[i:i+batch_size]:
+                        try:
+                            pkg = get_action('package_show')(dict(self.context(), use_cache=False), { "id": package_id })
+                        except NotFound:
+                            continue
+                        psi.index_package(pkg, defer_commit=True)
+                search_indexing.add_documents(conn, collector.docs)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def claim_objects(self, harvest_object, count):
+        # Claims the HarvestObject and up to count - 1 other objects of its job
+        # that the harvest queue hasn't started on yet, for import_objects, and
+        # returns their IDs. The job's row is locked first so that two import
+        # consumers can't claim the same objects.
+        model.Session.query(HarvestJob.id) \
+            .filter(HarvestJob.id == harvest_object.harvest_job_id) \
+            .with_lockmode("update") \
+            .one()
+        claimed = exists().where(and_(
+            HarvestObjectExtra.harvest_object_id == HarvestObject.id,
+            HarvestObjectExtra.key == "datajson_import_claimed"))
+        others = model.Session.query(HarvestObject.id) \
+            .filter(HarvestObject.harvest_job_id == harvest_object.harvest_job_id) \
+            .filter(HarvestObject.id != harvest_object.id) \
+            .filter(HarvestObject.import_started == None) \
+            .filter(~claimed) \
+            .limit(count - 1)
+        object_ids = [harvest_object.id] + [object_id for (object_id,) in others]
+        for object_id in object_ids:
+            model.Session.add(HarvestObjectExtra(harvest_object_id=object_id, key="datajson_import_claimed", value="true"))
+        model.Session.commit() # releases the lock
+        return object_ids
+
+    def is_claimed(self, harvest_object):
+        return model.Session.query(HarvestObjectExtra.id) \
+            .filter(HarvestObjectExtra.harvest_object_id == harvest_object.id) \
+            .filter(HarvestObjectExtra.key == "datajson_import_claimed") \
+            .first() is not None
+
+    def import_objects(self, object_ids, workers):
+        # Runs import_stage on each of the claimed HarvestObjects using a pool of
+        # threads. Each thread gets its own database session (Session is a
+        # scoped, thread-local session, and import_object removes it when it's
+        # done). The packages were all named by the gather stage, and
+        # make_package_name keeps track of the names so that two threads can't
+        # give the same name to different packages.
+        log.info('importing %d objects with %d workers' % (len(object_ids), workers))
+        self.reserved_package_names = self.find_stored_package_names(object_ids)
+        pool = ThreadPool(workers)
+        try:
+            for _ in pool.imap_unordered(self.import_object, object_ids):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+            self.reserved_package_names = None
+
+    def store_package_names(self, objects):
+        # Chooses the names of the packages for a job's new HarvestObjects, given
+        # as (HarvestObject ID, GUID, title) tuples, all at once, and stores each
+        # in a HarvestObjectExtra for import_stage. (If another package takes one
+        # of the names in the meantime, import_stage chooses a new one.)
+        if len(objects) == 0: return
+        names = PackageNameAllocator().allocate([(guid, title, False) for object_id, guid, title in objects])
+        for object_id, guid, title in objects:
+            model.Session.add(HarvestObjectExtra(harvest_object_id=object_id, key="datajson_package_name", value=names[guid]))
+        model.Session.commit()
+
+    def get_stored_package_name(self, harvest_object):
+        for extra in harvest_object.extras:
+            if extra.key == "datajson_package_name":
+                return extra.value
+        return None
+
+    def get_package_name(self, harvest_object, title):
+        # Returns the name stored for the HarvestObject's package by the gather
+        # stage, unless another package has taken it since (e.g. one from
+        # another source harvested in between), in which case a new one.
+        name = self.get_stored_package_name(harvest_object)
+        if name is not None:
+            taken = model.Session.query(Package.id) \
+                .filter(Package.name == name) \
+                .filter(Package.id != harvest_object.guid) \
+                .first() is not None
+            if not taken:
+                return name
+            log.warn('package name %s was taken before %s was imported' % (name, harvest_object.guid))
+        return self.make_package_name(title, harvest_object.guid, False)
+
+    def find_stored_package_names(self, object_ids):
+        # Returns a dict mapping the names stored for the HarvestObjects to the
+        # GUID of the package each is for.
+        names = { }
+        for i in xrange(0, len(object_ids), 500):
+            q = model.Session.query(HarvestObjectExtra.value, HarvestObject.guid) \
+                .join(HarvestObject, HarvestObjectExtra.harvest_object_id == HarvestObject.id) \
+                .filter(HarvestObjectExtra.key == "datajson_package_name") \
+                .filter(HarvestObject.id.in_(object_ids[i:i+500]))
+            for name, guid in q:
+                names[name] = guid
+        return names
+
+    def import_object(self, object_id):
+        try:
+            harvest_object = HarvestObject.get(object_id)
+            harvest_object.import_started = datetime.datetime.now()
+            if self.import_stage(harvest_object):
+                # Mark it as done so that import_stage skips it when the harvest
+                # queue gets to it.
+                harvest_object.import_finished = datetime.datetime.now()
+                harvest_object.save()
+        except Exception:
+            # Leave the object for the harvest queue to import.
+            log.exception('concurrent import of harvest object %s failed' % object_id)
+            model.Session.rollback()
+        finally:
+            try:
+                model.Session.query(HarvestObjectExtra) \
+                    .filter(HarvestObjectExtra.harvest_object_id == object_id) \
+                    .filter(HarvestObjectExtra.key == "datajson_import_claimed") \
+                    .delete(synchronize_session=False)
+                model.Session.commit()
+            finally:
+                model.Session.remove()
+
     def fetch_stage(self, harvest_object):
         # Nothing to do in this stage because we captured complete
         # dataset metadata from the first request to the remote catalog file.
         return True
 
     # SUBCLASSES MUST IMPLEMENT
-    def set_dataset_info(self, pkg, dataset, harvester_config):
+    def set_dataset_info(self, pkg, dataset, harvester_config, extras):
         # Sets package metadata on 'pkg' using the remote catalog's metadata
         # in 'dataset' and default values as configured in 'harvester_config'.
+        # 'extras' is pkg's extras as a PackageExtras, for setting extras with
+        # set_extra_value.
         raise Exception("Not implemented.")
 
     def import_stage(self, harvest_object):
         # The import stage actually creates the dataset.
         
         log.debug('In %s import_stage' % repr(self))
+
+        if harvest_object.import_finished is not None:
+            # Already imported by import_objects, along with another object.
+            return True
         
         # Get default values.
         harvester_config = self.load_config(harvest_object.source)
 
+        if self.reserved_package_names is None:
+            # Not inside import_objects.
+            if self.is_claimed(harvest_object):
+                # Another import consumer is importing it along with its own
+                # object right now.
+                log.info('harvest object %s is being imported by another batch' % harvest_object.id)
+                return True
+
+            # If the source is configured to import with more than one worker,
+            # import this object together with the next few objects of its job
+            # in parallel. The harvest queue will still call import_stage for
+            # each of them, but it will skip the ones imported here and import
+            # any that failed the usual way.
+            workers = harvester_config.get("import_workers", self.settings().import_workers)
+            if isinstance(workers, int) and workers > 1:
+                object_ids = self.claim_objects(harvest_object, workers * self.import_batch_size_per_worker)
+                self.import_objects(object_ids, workers)
+                model.Session.refresh(harvest_object)
+                if harvest_object.import_finished is not None:
+                    if self.is_deferring_indexing(harvester_config):
+                        self.flush_deferred_indexing_if_job_done(harvest_object)
+                    return True
+
         # Get the metadata that we stored in the HarvestObject's content field.
         dataset = json.loads(harvest_object.content)
 
@@ -245,7 +555,7 @@ class DatasetHarvesterBase(HarvesterBase):
         
         # Assemble basic information about the dataset.
         pkg = {
-            "name": self.make_package_name(dataset["title"], harvest_object.guid, False),
+            "name": self.get_package_name(harvest_object, dataset["title"]),
             "state": "active", # in case was previously deleted
             "owner_org": owner_org,
             "extras": [{
@@ -262,7 +572,7 @@ class DatasetHarvesterBase(HarvesterBase):
                 },
                 {
                 "key": "source_hash",
-                "value": self.make_upstream_content_hash(dataset, harvest_object.source),
+                "value": self.make_content_hash(harvest_object.content, harvester_config),
                 },
                 {
                 "key": "harvest_harvester_version",
@@ -274,17 +584,20 @@ class DatasetHarvesterBase(HarvesterBase):
                 }]
         }
 
+        # Index the package's extras once for all of the steps below.
+        extras = PackageExtras(pkg["extras"])
+
         # Set default values from the harvester configuration. Do this before
         # applying values from the harvest source so that the values can be
         # overridden.
-        self.set_extras(pkg, harvester_config["defaults"])
+        self.set_extras(pkg, harvester_config["defaults"], extras)
         
         # Set specific information about the dataset.
-        self.set_dataset_info(pkg, dataset, harvester_config)
+        self.set_dataset_info(pkg, dataset, harvester_config, extras)
 
         # Set "overrides" values from the harvester configuration, overriding
         # anything found in the harvester source.
-        self.set_extras(pkg, harvester_config["overrides"])
+        self.set_extras(pkg, harvester_config["overrides"], extras)
     
         # Try to update an existing package with the ID set in harvest_object.guid. If that GUID
         # corresponds with an existing package, get its current metadata.
@@ -292,7 +605,52 @@ class DatasetHarvesterBase(HarvesterBase):
             existing_pkg = get_action('package_show')(self.context(), { "id": harvest_object.guid })
         except NotFound:
             existing_pkg = None
-      
+
+        # If indexing is deferred, don't let CKAN index the package as it is
+        # saved either. It'll be indexed just once, with the rest of the job's
+        # packages, at the end.
+        defer_indexing = self.is_deferring_indexing(harvester_config)
+
+        if defer_indexing:
+            with search_indexing.suppressed():
+                pkg = self.save_package(pkg, existing_pkg, harvest_object)
+        else:
+            pkg = self.save_package(pkg, existing_pkg, harvest_object)
+
+        # Flag the other HarvestObjects linking to this package as not current anymore.
+        # This object is left out: it may already be linked to the package (when
+        # it's imported again after a failure), and since the session isn't told
+        # about the UPDATE, setting current back to True below wouldn't be saved.
+        model.Session.query(HarvestObject) \
+            .filter(HarvestObject.package_id == pkg["id"]) \
+            .filter(HarvestObject.current == True) \
+            .filter(HarvestObject.id != harvest_object.id) \
+            .update({ "current": False }, synchronize_session=False)
+
+        # Flag this HarvestObject as the current harvest object
+        harvest_object.package_id = pkg['id']
+        harvest_object.current = True
+        harvest_object.save()
+
+        if defer_indexing:
+            # Rather than indexing the package now (see below), remember that
+            # it needs it and index all of the job's packages together once
+            # the last one has been imported.
+            HarvestObjectExtra(object=harvest_object, key="datajson_index_pending", value="true").save()
+            if self.reserved_package_names is None: # the batch is flushed by the import_stage that ran it
+                self.flush_deferred_indexing_if_job_done(harvest_object)
+            return True
+
+        # Now that the package and the harvest source are associated, re-index the
+        # package so it knows it is part of the harvest source. The CKAN harvester
+        # does this by creating the association before the package is saved by
+        # overriding the GUID creation on a new package. That's too difficult.
+        # So here we end up indexing twice.
+        PackageSearchIndex().index_package(pkg) 
+
+        return True
+
+    def save_package(self, pkg, existing_pkg, harvest_object):
         if existing_pkg:
             # Update the existing metadata with the new information.
             
@@ -316,73 +674,92 @@ class DatasetHarvesterBase(HarvesterBase):
             except:
                 log.error('failed to create package %s from %s' % (pkg["name"], harvest_object.source.url))
                 raise
+        return pkg
+
+    def is_deferring_indexing(self, harvester_config):
+        return harvester_config.get("defer_indexing", self.settings().defer_indexing) is True \
+            and search_indexing.supported
+
+    def flush_deferred_indexing_if_job_done(self, harvest_object):
+        # Flushes the deferred indexing if every other object of the harvest
+        # object's job has been imported (or failed). The job's row is locked
+        # first, so that when the last two objects finish at the same moment,
+        # the second to get the lock sees the first's pending flag. (If the very
+        # last object fails, nothing is flushed now, and the next gather stage
+        # picks up the pieces.)
+        model.Session.query(HarvestJob.id) \
+            .filter(HarvestJob.id == harvest_object.harvest_job_id) \
+            .with_lockmode("update") \
+            .one()
+        index_pending = exists().where(and_(
+            HarvestObjectExtra.harvest_object_id == HarvestObject.id,
+            HarvestObjectExtra.key == "datajson_index_pending"))
+        remaining = model.Session.query(HarvestObject.id) \
+            .filter(HarvestObject.harvest_job_id == harvest_object.harvest_job_id) \
+            .filter(HarvestObject.id != harvest_object.id) \
+            .filter(HarvestObject.import_finished == None) \
+            .filter(HarvestObject.state != "ERROR") \
+            .filter(~index_pending) \
+            .count()
+        if remaining == 0:
+            self.flush_deferred_indexing(harvest_object.source) # commits, releasing the lock
+        else:
+            model.Session.commit()
+
+    def flush_deferred_indexing(self, harvest_source):
+        # Index all of the source's packages that are waiting to be indexed, with
+        # a single Solr commit at the end rather than one per package.
+        pending = model.Session.query(HarvestObjectExtra.id, HarvestObject.package_id) \
+            .join(HarvestObject, HarvestObjectExtra.harvest_object_id == HarvestObject.id) \
+            .filter(HarvestObject.harvest_source_id == harvest_source.id) \
+            .filter(HarvestObjectExtra.key == "datajson_index_pending") \
+            .all()
+        if len(pending) == 0: return
+
+        package_ids = sorted(set(package_id for extra_id, package_id in pending if package_id))
+        log.info('indexing %d packages from %s' % (len(package_ids), harvest_source.url))
+        self.index_packages(package_ids)
+
+        model.Session.query(HarvestObjectExtra) \
+            .filter(HarvestObjectExtra.id.in_([extra_id for extra_id, package_id in pending])) \
+            .delete(synchronize_session=False)
+        model.Session.commit()
 
-        # Flag the other HarvestObjects linking to this package as not current anymore
-        for ob in model.Session.query(HarvestObject).filter_by(package_id=pkg["id"]):
-            ob.current = False
-            ob.save()
-
-        # Flag this HarvestObject as the current harvest object
-        harvest_object.package_id = pkg['id']
-        harvest_object.current = True
-        harvest_object.save()
-
-        # Now that the package and the harvest source are associated, re-index the
-        # package so it knows it is part of the harvest source. The CKAN harvester
-        # does this by creating the association before the package is saved by
-        # overriding the GUID creation on a new package. That's too difficult.
-        # So here we end up indexing twice.
-        PackageSearchIndex().index_package(pkg) 
-
-        return True
-        
     def make_upstream_content_hash(self, datasetdict, harvest_source):
-        return hashlib.sha1(json.dumps(datasetdict, sort_keys=True)
-        	+ "|" + harvest_source.config.encode("utf8") + "|" + self.HARVESTER_VERSION).hexdigest()
+        return self.make_content_hash(json.dumps(datasetdict, sort_keys=True), self.load_config(harvest_source))
+
+    def make_content_hash(self, content, harvester_config):
+        # Hashes a dataset already serialized the way gather_stage stores it in
+        # HarvestObject.content (json.dumps with sort_keys), together with the
+        # source's configuration and the harvester version. The configuration
+        # part is encoded once per configuration rather than once per dataset.
+        if isinstance(content, unicode): content = content.encode("utf8") # as read back from the database
+        return hashlib.sha1(content + harvester_config.hash_suffix(self.HARVESTER_VERSION)).hexdigest()
         
     def find_extra(self, pkg, key):
-        for extra in pkg["extras"]:
-            if extra["key"] == key:
-                return extra["value"]
-        return None
+        # For looking up one extra. To look up several, make a PackageExtras
+        # of the package's extras once instead.
+        return PackageExtras(pkg["extras"]).value(key)
 
     def make_package_name(self, title, exclude_existing_package, for_deletion):
         '''
         Creates a URL friendly name from a title
 
-        If the name already exists, it will add some random characters at the end
+        If the name already exists, it will add some characters at the end
         '''
 
-        name = munge_title_to_name(title).replace('_', '-')
-        if for_deletion: name = "deleted-" + name
-        while '--' in name:
-            name = name.replace('--', '-')
-        name = name[0:90] # max length is 100
-
-        # Is this slug already in use (and if we're updating a package, is it in
-        # use by a different package?).
-        pkg_obj = Session.query(Package).filter(Package.name == name).filter(Package.id != exclude_existing_package).first()
-        if not pkg_obj:
-            # The name is available, so use it. Note that if we're updating an
-            # existing package we will be updating this package's URL, so incoming
-            # links may break.
+        # The gather stage normally names the packages up front (see
+        # store_package_names), so this is for objects gathered without names.
+        with self.package_name_lock:
+            name = PackageNameAllocator(self.reserved_package_names) \
+                .allocate([(exclude_existing_package, title, for_deletion)])[exclude_existing_package]
+            if self.reserved_package_names is not None:
+                self.reserved_package_names[name] = exclude_existing_package
             return name
 
-        if exclude_existing_package:
-            # The name is not available, and we're updating a package. Chances
-            # are the package's name already had some random string attached
-            # to it last time. Prevent spurrious updates to the package's URL
-            # (choosing new random text) by just reusing the existing package's
-            # name.
-            pkg_obj = Session.query(Package).filter(Package.id == exclude_existing_package).first()
-            if pkg_obj: # the package may not exist yet because we may be passed the desired package GUID before a new package is instantiated
-                return pkg_obj.name
-
-        # Append some random text to the URL. Hope that with five character
-        # there will be no collsion.
-        return name + "-" + str(uuid.uuid4())[:5]
-
-    def set_extras(self, package, extras):
+    def set_extras(self, package, extras, index=None):
+        # 'index' is the package's extras as a PackageExtras, if the caller has
+        # one already.
         for k, v in extras.items():
             if k in ("title", "notes", "author", "url"):
                 # these are CKAN package fields
@@ -392,18 +769,22 @@ class DatasetHarvesterBase(HarvesterBase):
                 package["tags"] = [ { "name": munge_title_to_name(t) } for t in v ]
             else:
                 # everything else is an "extra"
-                DatasetHarvesterBase.set_extra(package, k, v)
+                if index is None: index = PackageExtras(package.setdefault("extras", []))
+                DatasetHarvesterBase.set_extra_value(index, k, v)
 
     @staticmethod
     def set_extra(package, key, value):
+        # Indexes the package's extras just for this one. To set several, use
+        # set_extra_value with a PackageExtras made once.
+        DatasetHarvesterBase.set_extra_value(PackageExtras(package.setdefault("extras", [])), key, value)
+
+    @staticmethod
+    def set_extra_value(extras, key, value):
+        # Like set_extra, but given the package's extras as a PackageExtras, for
+        # when setting several at once.
         if value is None: raise ValueError("value cannot be None")
 
         if isinstance(value, list): value = " ".join(value) # for bureauCode, programCode, references
         if value in (True, False): value = str(value).lower() # for dataQuality which is a boolean field, turn into "true" and "false"
  
-        extras = package.setdefault("extras", [])
-        for extra in extras:
-            if extra.get("key") == key:
-                extra["value"] = value
-                return
-        extras.append({ "key": key, "value": value })
+        extras.set(key, value)
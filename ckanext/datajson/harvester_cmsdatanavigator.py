@@ -17,44 +17,50 @@ class CmsDataNavigatorHarvester(DatasetHarvesterBase):
         }
 
     def load_remote_catalog(self, harvest_job):
-        catalog = json.load(urllib2.urlopen(harvest_job.source.url))
+        f = self.open_remote_catalog(harvest_job)
+        if f is None:
+            return [] # unchanged since the last harvest
+        try:
+            catalog = json.load(f)
+        finally:
+            f.close()
         for item in catalog:
             item["identifier"] = item["ID"]
             item["title"] = item["Name"].strip()
         return catalog
         
-    def set_dataset_info(self, package, dataset, harvester_config):
-        extra(package, "Agency", "Department of Health & Human Services")
+    def set_dataset_info(self, package, dataset, harvester_config, extras):
+        extra(extras, "Agency", "Department of Health & Human Services")
         package["author"] = "Centers for Medicare & Medicaid Services"
-        extra(package, "author_id", "http://healthdata.gov/id/agency/cms")
-        extra(package, "Bureau Code", "009:38")
+        extra(extras, "author_id", "http://healthdata.gov/id/agency/cms")
+        extra(extras, "Bureau Code", "009:38")
         package["title"] = dataset["Name"].strip()
         package["notes"] = dataset.get("Description")
         
         package["url"] = dataset.get("Address")
 
         dataset_hd = dataset["HealthData"]
-        extra(package, "Date Released", parsedate(dataset_hd.get("DateReleased")))
-        extra(package, "Date Updated", parsedate(dataset_hd.get("DateUpdated")))
-        extra(package, "Agency Program URL", dataset_hd.get("AgencyProgramURL"))
-        extra(package, "Subject Area 1", "Medicare")
-        extra(package, "Unit of Analysis", dataset_hd.get("UnitOfAnalysis"))
-        extra(package, "Data Dictionary", dataset_hd.get("DataDictionaryURL"))
-        extra(package, "Coverage Period", dataset_hd.get("Coverage Period"))
-        extra(package, "Collection Frequency", dataset_hd.get("Collection Frequency"))
-        extra(package, "Geographic Scope", dataset_hd.get("GeographicScope"))
-        extra(package, "Access Level", "restricted public" if dataset.get("RequiresCustomAccessForms") else "public")
-        #extra(package, "Contact Name", dataset_hd.get("GenericContactName", None) or dataset_hd.get("ContactName")) # 'X or Y' syntax returns Y if X is either None or the empty string
-        #extra(package, "Contact Email", dataset_hd.get("GenericContactEmail", None) or dataset_hd.get("ContactEmail"))
-        extra(package, "License Agreement", dataset_hd.get("DataLicenseAgreementURL"))
+        extra(extras, "Date Released", parsedate(dataset_hd.get("DateReleased")))
+        extra(extras, "Date Updated", parsedate(dataset_hd.get("DateUpdated")))
+        extra(extras, "Agency Program URL", dataset_hd.get("AgencyProgramURL"))
+        extra(extras, "Subject Area 1", "Medicare")
+        extra(extras, "Unit of Analysis", dataset_hd.get("UnitOfAnalysis"))
+        extra(extras, "Data Dictionary", dataset_hd.get("DataDictionaryURL"))
+        extra(extras, "Coverage Period", dataset_hd.get("Coverage Period"))
+        extra(extras, "Collection Frequency", dataset_hd.get("Collection Frequency"))
+        extra(extras, "Geographic Scope", dataset_hd.get("GeographicScope"))
+        extra(extras, "Access Level", "restricted public" if dataset.get("RequiresCustomAccessForms") else "public")
+        #extra(extras, "Contact Name", dataset_hd.get("GenericContactName", None) or dataset_hd.get("ContactName")) # 'X or Y' syntax returns Y if X is either None or the empty string
+        #extra(extras, "Contact Email", dataset_hd.get("GenericContactEmail", None) or dataset_hd.get("ContactEmail"))
+        extra(extras, "License Agreement", dataset_hd.get("DataLicenseAgreementURL"))
         
         from ckan.lib.munge import munge_title_to_name
         package["tags"] = [ { "name": munge_title_to_name(t["Name"]) } for t in dataset.get("Keywords", [])]
         
         
-def extra(package, key, value):
+def extra(extras, key, value):
     if not value: return
-    package.setdefault("extras", []).append({ "key": key, "value": value })
+    DatasetHarvesterBase.set_extra_value(extras, key, value)
     
 def parsedate(msdate):
     if not msdate: return None
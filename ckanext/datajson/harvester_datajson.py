@@ -1,7 +1,14 @@
 from ckanext.datajson.harvester_base import DatasetHarvesterBase
 from ckanext.datajson.harvester_base import log
 
-import urllib2, json
+import urllib2, json, decimal
+
+try:
+    # If ijson is installed, parse remote catalogs incrementally rather than
+    # loading the whole file into memory.
+    import ijson
+except ImportError:
+    ijson = None
 
 class DataJsonHarvester(DatasetHarvesterBase):
     '''
@@ -18,30 +25,79 @@ class DataJsonHarvester(DatasetHarvesterBase):
         }
 
     def load_remote_catalog(self, harvest_job):
-	try:
-	        datasets = json.load(urllib2.urlopen(harvest_job.source.url, None, 90))
-	except urllib2.URLError as e:
-		log.warn('Failed to fetch %s' % harvest_job.source.url)
-		return []
-	except ValueError as e:
-		log.warn('Failed to parse %s' % harvest_job.source.url)
-		return []
+        try:
+            f = self.open_remote_catalog(harvest_job, 90)
+        except (urllib2.URLError, IOError):
+            log.warn('Failed to fetch %s' % harvest_job.source.url)
+            return []
+        if f is None:
+            return [] # unchanged since the last harvest
+
+        if ijson is None:
+            try:
+                datasets = json.load(f)
+            except ValueError:
+                log.warn('Failed to parse %s' % harvest_job.source.url)
+                return []
+            finally:
+                f.close()
+            if not isinstance(datasets, list):
+                log.warn('Failed to parse %s' % harvest_job.source.url)
+                return []
+        else:
+            datasets = self.parse_remote_catalog(f, harvest_job)
+
+        return self.fix_catalog_entry(datasets, harvest_job)
 
+    def parse_remote_catalog(self, f, harvest_job):
+        # Yields the datasets in the top-level array of the file one at a time
+        # as they are parsed, so only one dataset is in memory at a time.
+        datasets = iter(ijson.items(f, "item"))
+        try:
+            try:
+                dataset = next(datasets)
+            except StopIteration:
+                return
+            except Exception:
+                # Not JSON at all, so there's nothing to harvest.
+                log.warn('Failed to parse %s' % harvest_job.source.url)
+                return
+            yield undecimal(dataset)
 
+            # Once we've started there's no going back. An error past this point
+            # must propagate so that the gather stage doesn't mistake a truncated
+            # file for datasets having been removed.
+            for dataset in datasets:
+                yield undecimal(dataset)
+        finally:
+            f.close()
+
+    def fix_catalog_entry(self, datasets, harvest_job):
         # The first dataset should be for the data.json file itself. Check that
         # it is, and if so rewrite the dataset's title because Socrata exports
         # these items all with the same generic name that is confusing when
         # harvesting a bunch from different sources. It should have an accessURL
         # but Socrata fills the URL of these in under webService.
-        if datasets != None and len(datasets) > 0 and (datasets[0].get("accessURL") == harvest_job.source.url
-            or datasets[0].get("webService") == harvest_job.source.url) and \
-            datasets[0].get("title") == "Project Open Data, /data.json file":
-            datasets[0]["title"] = "%s Project Open Data data.json File" % harvest_job.source.title
-
-        return datasets
-        
-    def set_dataset_info(self, pkg, dataset, harvester_config):
+        for i, dataset in enumerate(datasets):
+            if i == 0 and (dataset.get("accessURL") == harvest_job.source.url
+                or dataset.get("webService") == harvest_job.source.url) and \
+                dataset.get("title") == "Project Open Data, /data.json file":
+                dataset["title"] = "%s Project Open Data data.json File" % harvest_job.source.title
+            yield dataset
+
+    def set_dataset_info(self, pkg, dataset, harvester_config, extras):
         from pod_to_package import parse_datajson_entry
-        parse_datajson_entry(dataset, pkg, harvester_config)
-    
+        parse_datajson_entry(dataset, pkg, harvester_config, extras)
 
+def undecimal(value):
+    # ijson parses non-integer numbers as Decimals, which json.dumps can't
+    # serialize. Turn them into floats as json.load would have.
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, dict):
+        for k, v in value.items():
+            value[k] = undecimal(v)
+    elif isinstance(value, list):
+        for i, v in enumerate(value):
+            value[i] = undecimal(v)
+    return value
@@ -0,0 +1,79 @@
+import json
+
+# Incremental JSON output for the catalog endpoints. These produce exactly the
+# same bytes as json.dumps(..., indent=indent, separators=separators) would for
+# the complete structure, but only ever hold one catalog entry in memory at a time.
+
+class ArrayWriter(object):
+    '''
+    Builds the JSON encoding of a list piece by piece from its already-encoded
+    items. 'level' is the nesting depth at which the list appears in the
+    enclosing document.
+    '''
+
+    def __init__(self, indent=2, level=0, separators=None):
+        self.encoder = json.JSONEncoder(indent=indent, separators=separators)
+        if indent is None:
+            self.item_prefix = ""
+            self.close_chunk = "]"
+        else:
+            self.item_prefix = "\n" + " " * (indent * (level + 1))
+            self.close_chunk = "\n" + " " * (indent * level) + "]"
+        self.indent = indent
+        self.empty = True
+
+    def encode(self, item):
+        return self.encoder.encode(item)
+
+    def item(self, encoded_item):
+        # Returns the chunk that adds an item, encoded at the top level (e.g. with
+        # encode()), to the list. Its lines are shifted over to the indentation
+        # level it has inside the list. JSON strings never contain literal
+        # newlines so this can't corrupt any values.
+        if self.indent is not None:
+            encoded_item = encoded_item.replace("\n", self.item_prefix)
+        if self.empty:
+            self.empty = False
+            return "[" + self.item_prefix + encoded_item
+        return self.encoder.item_separator + self.item_prefix + encoded_item
+
+    def close(self):
+        # Returns the chunk that ends the list.
+        if self.empty:
+            return "[]"
+        return self.close_chunk
+
+def iter_json_array(items, indent=2, level=0, separators=None):
+    # Yields the JSON encoding of a list, one item per chunk.
+    writer = ArrayWriter(indent=indent, level=level, separators=separators)
+    for item in items:
+        yield writer.item(writer.encode(item))
+    yield writer.close()
+
+def json_object_head(header, key, indent=2, separators=None):
+    # Returns the start of the JSON encoding of the dict 'header' with one more
+    # key appended at the end, up to where that key's value begins.
+    encoder = json.JSONEncoder(indent=indent, separators=separators)
+    head = encoder.encode(header)
+    if len(header) == 0:
+        head = "{"
+    else:
+        # chop off the closing brace and continue the dict
+        head = head[:-1].rstrip("\n ") + encoder.item_separator
+    if indent is not None:
+        head += "\n" + " " * indent
+    return head + encoder.encode(key) + encoder.key_separator
+
+def json_object_tail(indent=2):
+    # Returns the end of the dict begun by json_object_head.
+    if indent is None:
+        return "}"
+    return "\n}"
+
+def iter_json_object(header, key, items, indent=2, separators=None):
+    # Yields the JSON encoding of the dict 'header' with one more key appended
+    # at the end whose value is the list 'items', which is encoded incrementally.
+    yield json_object_head(header, key, indent=indent, separators=separators)
+    for chunk in iter_json_array(items, indent=indent, level=1, separators=separators):
+        yield chunk
+    yield json_object_tail(indent=indent)
@@ -0,0 +1,80 @@
+import threading
+from collections import namedtuple, Mapping
+
+try:
+    from collections import OrderedDict # 2.7
+except ImportError:
+    from sqlalchemy.util import OrderedDict
+
+# A bounded memo for small pure functions that are called over and over with the
+# same few arguments, like normalizing a resource format. When it fills up, the
+# entry used least recently is dropped, so the values that keep coming up (the
+# common formats, a catalog's few contact emails) stay cached.
+
+class FrozenDict(Mapping):
+    '''
+    A read-only dict, for the lookup tables that memoized functions read. If a
+    table could be changed, answers memoized before the change would be wrong.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        self._items = dict(*args, **kwargs)
+
+    def __getitem__(self, key):
+        return self._items[key]
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        return "FrozenDict(%r)" % self._items
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+def memoize(maxsize=1024):
+    def decorator(func):
+        cache = OrderedDict() # least recently used first
+        lock = threading.Lock()
+        stats = [0, 0] # hits, misses
+
+        def wrapper(*args):
+            try:
+                with lock:
+                    # Move the entry to the end by taking it out and putting it
+                    # back (2.7's OrderedDict has no move_to_end).
+                    value = cache.pop(args)
+                    cache[args] = value
+                    stats[0] += 1
+                    return value
+            except KeyError:
+                pass
+            except TypeError:
+                # unhashable arguments can't be memoized
+                return func(*args)
+
+            value = func(*args)
+            with lock:
+                stats[1] += 1
+                if args not in cache and len(cache) >= maxsize:
+                    cache.popitem(last=False)
+                cache[args] = value
+            return value
+
+        def cache_info():
+            with lock:
+                return CacheInfo(stats[0], stats[1], maxsize, len(cache))
+
+        def cache_clear():
+            with lock:
+                cache.clear()
+                stats[0] = stats[1] = 0
+
+        wrapper.cache_info = cache_info
+        wrapper.cache_clear = cache_clear
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
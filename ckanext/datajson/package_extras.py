@@ -0,0 +1,66 @@
+MISSING = object()
+
+class PackageExtras(object):
+    '''
+    A package's extras (a list of {"key": ..., "value": ...} dicts, as in a
+    package dict) indexed by key, so that looking up or setting many extras
+    doesn't scan the list each time. If a key appears more than once, the
+    first one counts. Setting an extra modifies the list in place.
+    '''
+
+    def __init__(self, extras):
+        self.extras = extras
+        self.index = { }
+        for extra in extras:
+            key = extra.get("key")
+            if key not in self.index:
+                self.index[key] = extra
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def value(self, key, default=None):
+        # Returns the value of an extra as it is stored.
+        extra = self.index.get(key)
+        if extra is None: return default
+        return extra["value"]
+
+    def get(self, key, default=None, datatype=None, raise_if_missing=False):
+        # Retrieves the value of an extras field, cleaned up for data.json output.
+        extra = self.index.get(key)
+        if extra is None:
+            if raise_if_missing: raise ValueError("Missing value for %s.", key)
+            return default
+
+        v = extra["value"]
+        if key == "Access Level" and v == "Public":
+            v = "public"
+        if key == "Data Dictionary" and " " in v:
+            return default
+
+        if datatype == "iso8601":
+            # Hack: If this value is a date, convert Drupal style dates to ISO 8601
+            # dates by replacing the space date/time separator with a T. Also if it
+            # looks like a plain date (midnight time), remove the time component.
+            v = v.replace(" ", "T")
+            v = v.replace("T00:00:00", "")
+
+        return v
+
+    def first(self, keys, default=None, datatype=None):
+        # Returns get() of the first of the keys that has a value, i.e. the same
+        # as nesting calls to get() with each one as the default of the last.
+        for key in keys:
+            v = self.get(key, default=MISSING, datatype=datatype)
+            if v is not MISSING:
+                return v
+        return default
+
+    def set(self, key, value):
+        extra = self.index.get(key)
+        if extra is not None:
+            extra["value"] = value
+        else:
+            extra = { "key": key, "value": value }
+            self.extras.append(extra)
+            self.index[key] = extra
@@ -0,0 +1,105 @@
+from ckan.model import Session, Package
+from ckan.lib.munge import munge_title_to_name
+from sqlalchemy import or_
+
+import uuid
+
+QUERY_BATCH_SIZE = 500
+
+def munge_package_name(title, for_deletion=False):
+    # Creates a URL friendly name from a title.
+    name = munge_title_to_name(title).replace('_', '-')
+    if for_deletion: name = "deleted-" + name
+    while '--' in name:
+        name = name.replace('--', '-')
+    return name[0:90] # max length is 100
+
+def suffixed_names(name, package_id):
+    # Alternatives to a name that is taken. The suffix comes from the package's
+    # ID (harvested packages get random IDs) so the same package gets the same
+    # name no matter what order packages are named in.
+    suffix = package_id.replace("-", "")
+    return [name + "-" + suffix[:n] for n in xrange(5, 10)]
+
+class PackageNameAllocator(object):
+    '''
+    Chooses names for a batch of packages at once. All of the names the packages
+    might get are checked against the package table together, and packages in
+    the batch that want the same name are resolved in order of package ID.
+    '''
+
+    def __init__(self, reserved=None):
+        # 'reserved' maps names that were handed out but maybe not saved yet to
+        # the ID of the package they were handed out for.
+        self.reserved = reserved or { }
+
+    def allocate(self, packages):
+        # 'packages' is a list of (package ID, title, for_deletion) tuples, where
+        # the ID may be for a package that doesn't exist yet. Returns a dict
+        # mapping each package ID to its name.
+        wanted = { }
+        candidates = set()
+        for package_id, title, for_deletion in packages:
+            name = munge_package_name(title, for_deletion)
+            wanted[package_id] = name
+            candidates.add(name)
+            candidates.update(suffixed_names(name, package_id))
+
+        self.owners, self.current_names = self.lookup(sorted(candidates), sorted(wanted))
+
+        names = { }
+        for package_id in sorted(wanted):
+            name = self.choose(wanted[package_id], package_id)
+            self.owners[name] = package_id
+            names[package_id] = name
+        return names
+
+    def lookup(self, names, package_ids):
+        # Returns a dict mapping each of the names that is in use to the ID of the
+        # package using it, and a dict of the current names of the packages that
+        # exist.
+        owners = { }
+        current_names = { }
+        wanted_ids = set(package_ids)
+        for i in xrange(0, max(len(names), len(package_ids)), QUERY_BATCH_SIZE):
+            q = Session.query(Package.id, Package.name).filter(or_(
+                Package.name.in_(names[i:i+QUERY_BATCH_SIZE] or [None]),
+                Package.id.in_(package_ids[i:i+QUERY_BATCH_SIZE] or [None])))
+            for package_id, name in q:
+                owners[name] = package_id
+                if package_id in wanted_ids:
+                    current_names[package_id] = name
+        return owners, current_names
+
+    def in_use(self, name, package_id):
+        # Is the name in use by (or promised to) a package other than this one?
+        for owners in (self.owners, self.reserved):
+            if owners.get(name, package_id) != package_id:
+                return True
+        return False
+
+    def choose(self, name, package_id):
+        if not self.in_use(name, package_id):
+            # The name is available, so use it. Note that if we're updating an
+            # existing package we will be updating this package's URL, so incoming
+            # links may break.
+            return name
+
+        if package_id in self.current_names:
+            # The name is not available, and we're updating a package. Chances
+            # are the package's name already had some suffix attached to it last
+            # time. Prevent spurrious updates to the package's URL by just reusing
+            # the existing package's name.
+            return self.current_names[package_id]
+
+        for suffixed_name in suffixed_names(name, package_id):
+            if not self.in_use(suffixed_name, package_id):
+                return suffixed_name
+
+        # All taken, which is very unlikely. Append some random text instead,
+        # checking each guess individually.
+        while True:
+            random_name = name + "-" + str(uuid.uuid4())[:5]
+            if not self.in_use(random_name, package_id) \
+                and Session.query(Package.id).filter(Package.name == random_name).first() is None:
+                return random_name
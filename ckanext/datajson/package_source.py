@@ -0,0 +1,135 @@
+import json
+
+from sqlalchemy import select, and_, or_, func
+
+from ckan import model
+from ckan.model.meta import Session
+
+# Reads packages straight out of the database a page at a time, in the shape
+# that make_datajson_entry expects (i.e. like current_package_list_with_resources
+# returns them). Filtering happens in the query, and the extras, resources and
+# tags of each page are loaded with one query each rather than once per package.
+
+package = model.package_table
+revision = model.revision_table
+package_extra = model.package_extra_table
+package_tag = model.package_tag_table
+tag = model.tag_table
+resource = model.resource_table
+
+def iter_packages(page_size, package_type="dataset", authors=None):
+    # Yields the public, active packages of the given type (or of any type if
+    # package_type is None), optionally only those by one of 'authors', newest
+    # revision first.
+    for package_ids in iter_package_id_pages(page_size, package_type=package_type, authors=authors):
+        for pkg in load_packages(package_ids):
+            yield pkg
+
+def iter_package_id_pages(page_size, package_type="dataset", authors=None):
+    # Yields lists of up to page_size package IDs, in the order iter_packages
+    # returns the packages.
+    where = [package.c.state == "active", package.c.private == False]
+    if package_type is not None:
+        where.append(package.c.type == package_type)
+    if authors is not None:
+        where.append(package.c.author.in_(authors))
+
+    q = select([package.c.id, revision.c.timestamp],
+            and_(*where),
+            from_obj=package.join(revision, package.c.revision_id == revision.c.id)) \
+        .order_by(revision.c.timestamp.desc(), package.c.id) \
+        .limit(page_size)
+
+    # Page through the results using the sort key of the last row we saw rather
+    # than an offset so that each page costs the same to fetch.
+    last = None
+    while True:
+        page_q = q
+        if last is not None:
+            page_q = q.where(or_(revision.c.timestamp < last[1],
+                and_(revision.c.timestamp == last[1], package.c.id > last[0])))
+        rows = Session.execute(page_q).fetchall()
+        if len(rows) == 0: break
+
+        yield [row[0] for row in rows]
+
+        if len(rows) < page_size: break
+        last = rows[-1]
+
+def load_packages(package_ids):
+    # Returns package dicts for the given package IDs, in the same order. IDs of
+    # packages that don't exist are skipped.
+    if len(package_ids) == 0: return []
+
+    packages = { }
+    for row in Session.execute(select([package, revision.c.timestamp.label("revision_timestamp")],
+            package.c.id.in_(package_ids),
+            from_obj=package.join(revision, package.c.revision_id == revision.c.id))):
+        if row["revision_timestamp"] is None: continue
+        packages[row["id"]] = {
+            "id": row["id"],
+            "name": row["name"],
+            "title": row["title"],
+            "author": row["author"],
+            "notes": row["notes"],
+            "url": row["url"],
+            "type": row["type"],
+            "state": row["state"],
+            "private": row["private"],
+            "owner_org": row["owner_org"],
+            "metadata_modified": row["metadata_modified"].isoformat() if row["metadata_modified"] else None,
+            "revision_timestamp": row["revision_timestamp"].isoformat(),
+            "extras": [],
+            "resources": [],
+            "tags": [],
+        }
+    if len(packages) == 0: return []
+
+    # extras, sorted by key as package_dictize does
+    for row in Session.execute(select([package_extra.c.package_id, package_extra.c.key, package_extra.c.value],
+            and_(package_extra.c.package_id.in_(packages.keys()), package_extra.c.state == "active"))
+            .order_by(package_extra.c.key)):
+        packages[row[0]]["extras"].append({ "key": row[1], "value": row[2] })
+
+    # tags, sorted by name
+    for row in Session.execute(select([package_tag.c.package_id, tag.c.name],
+            and_(package_tag.c.package_id.in_(packages.keys()), package_tag.c.state == "active"),
+            from_obj=package_tag.join(tag, package_tag.c.tag_id == tag.c.id))
+            .order_by(tag.c.name)):
+        packages[row[0]]["tags"].append({ "name": row[1], "display_name": row[1] })
+
+    # resources, in their position order
+    if "package_id" in resource.c:
+        # CKAN 2.3+
+        columns = [resource]
+        from_obj = resource
+        resource_package_id = resource.c.package_id
+    else:
+        columns = [model.resource_group_table.c.package_id, resource]
+        from_obj = resource.join(model.resource_group_table,
+            resource.c.resource_group_id == model.resource_group_table.c.id)
+        resource_package_id = model.resource_group_table.c.package_id
+    for row in Session.execute(select(columns,
+            and_(resource_package_id.in_(packages.keys()), resource.c.state == "active"),
+            from_obj=from_obj)
+            .order_by(resource.c.position)):
+        r = json.loads(row["extras"]) if row["extras"] else { }
+        r.update({
+            "id": row["id"],
+            "url": row["url"],
+            "format": row["format"],
+            "mimetype": row["mimetype"],
+            "name": row["name"],
+            "description": row["description"],
+            "position": row["position"],
+        })
+        packages[row["package_id"]]["resources"].append(r)
+
+    return [packages[package_id] for package_id in package_ids if package_id in packages]
+
+def catalog_version():
+    # Returns the time of the most recent change to any package and the number of
+    # packages. Any edit to a package, including deleting it or making it private,
+    # updates its metadata_modified, so between them these change whenever the
+    # catalog output might change.
+    return Session.execute(select([func.max(package.c.metadata_modified), func.count(package.c.id)])).first()
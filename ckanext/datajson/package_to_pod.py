@@ -1,15 +1,19 @@
 import re
 import sys
-import validator
-from validator import URL_REGEX
-from validator import email_validator
+from validation_primitives import is_url, is_email
 from pprint import pprint
+from package_extras import PackageExtras
+from collections import namedtuple
+from memo import memoize, FrozenDict
 
 try:
     from collections import OrderedDict # 2.7
 except ImportError:
     from sqlalchemy.util import OrderedDict
 
+KEYWORD_SEPARATOR_REGEX = re.compile(r"\s*,\s*")
+MIME_TYPE_PARAMETERS_REGEX = re.compile(r"[,\s].*") # everything after the MIME type itself
+
 def get_facet_fields():
     # Return fields that we'd like to add to default CKAN faceting. This really has
     # nothing to do with exporting data.json but it's probably a common consideration.
@@ -19,42 +23,37 @@ def get_facet_fields():
     return facets
 
 def make_datajson_entry(package, plugin):
+    extras = PackageExtras(package["extras"])
+
     # keywords
     keywords = [t["display_name"] for t in package["tags"]]
     if len(keywords) == 0 and plugin.default_keywords is not None:
-        keywords = re.split("\s*,\s*", plugin.default_keywords)
+        keywords = KEYWORD_SEPARATOR_REGEX.split(plugin.default_keywords)
 
     # Make a default program code value when a bureau code is none. The
     # departmental component of a bureau code plus ":000" means
     # "Primary Program Not Available".
     defaultProgramCode = None
-    if extra(package, "Bureau Code"):
-        defaultProgramCode = [bcode.split(":")[0] + ":000" for bcode in extra(package, "Bureau Code").split(" ")]
+    if extras.get("Bureau Code"):
+        defaultProgramCode = [bcode.split(":")[0] + ":000" for bcode in extras.get("Bureau Code").split(" ")]
  
 #    f1=open('/tmp/testfile', 'a+')
 
-    if package["url"] != None and not URL_REGEX.match(package["url"]):
+    if package["url"] != None and not is_url(package["url"]):
         package["url"] = None
-    for r in package["resources"]:
-        if r["url"] != None and not URL_REGEX.match(r["url"]):
-            r["url"] = None
-        if r["mimetype"] != None:
-            r["mimetype"] = re.sub(r"[,\s].*", "", r["mimetype"])
-        # r.get doesn't get this right, so logic it here
-        if r["mimetype"] == None:
-            r["mimetype"] = extension_to_mime_type(r["format"])
+    resources = classify_resources(package)
 
 
     # The 'modified' field needs to be populated somehow, try all the date
     # fields we can think of.
-    modified = extra(package, "Date Updated", datatype="iso8601", default=extra(package, "Date Released", datatype="iso8601", default=extra(package, "harvest_last_updated", datatype="iso8601", default=extra(package, "Coverage Period Start", datatype="iso8601", default=package["revision_timestamp"]))))
+    modified = extras.first(("Date Updated", "Date Released", "harvest_last_updated", "Coverage Period Start"), datatype="iso8601", default=package["revision_timestamp"])
 
-    access_url = get_primary_resource(package).get("url", package['url'])
-    mbox = extra(package, "Contact Email", default=plugin.default_mbox)
-    if not email_validator(mbox):
+    access_url = resources.primary.get("url", package['url'])
+    mbox = extras.get("Contact Email", default=plugin.default_mbox)
+    if not is_email(mbox):
         mbox = plugin.default_mbox
 
-    language = extra(package, "Language")
+    language = extras.get("Language")
     if isinstance(language, basestring):
         language = [language]
     if package["notes"] == None or package["notes"] == "":
@@ -77,29 +76,29 @@ def make_datajson_entry(package, plugin):
         ("keyword", keywords),
         ("modified", modified),
         ("publisher", package["author"]),
-        ("bureauCode", extra(package, "Bureau Code").split(" ") if extra(package, "Bureau Code") else None),
-        ("programCode", extra(package, "Program Code").split(" ") if extra(package, "Program Code") else defaultProgramCode),
-        ("contactPoint", extra(package, "Contact Name", default=plugin.default_contactpoint)),
+        ("bureauCode", extras.get("Bureau Code").split(" ") if extras.get("Bureau Code") else None),
+        ("programCode", extras.get("Program Code").split(" ") if extras.get("Program Code") else defaultProgramCode),
+        ("contactPoint", extras.get("Contact Name", default=plugin.default_contactpoint)),
         ("mbox", mbox),
         ("identifier", package["id"]),
-        ("accessLevel", extra(package, "Access Level", default="public")),
-        ("accessLevelComment", extra(package, "Access Level Comment")),
-        ("dataDictionary", extra(package, "Data Dictionary")),
+        ("accessLevel", extras.get("Access Level", default="public")),
+        ("accessLevelComment", extras.get("Access Level Comment")),
+        ("dataDictionary", extras.get("Data Dictionary")),
         ("accessURL", access_url),
-        ("webService", get_api_resource(package).get("url", None)),
-        ("format", extension_to_mime_type(get_primary_resource(package).get("format", None)) ),
-        ("license", extra(package, "License Agreement")),
-        ("spatial", extra(package, "Geographic Scope")),
-        ("temporal", build_temporal(package)),
-        ("issued", extra(package, "Date Released", datatype="iso8601")),
-        ("accrualPeriodicity", extra(package, "Publish Frequency")),
+        ("webService", resources.api.get("url", None)),
+        ("format", extension_to_mime_type(resources.primary.get("format", None)) ),
+        ("license", extras.get("License Agreement")),
+        ("spatial", extras.get("Geographic Scope")),
+        ("temporal", build_temporal(package, extras)),
+        ("issued", extras.get("Date Released", datatype="iso8601")),
+        ("accrualPeriodicity", extras.get("Publish Frequency")),
         ("language", language),
-        ("PrimaryITInvestmentUII", extra(package, "PrimaryITInvestmentUII")),
-        ("dataQuality", extra(package, "Data Quality Met", default="true") == "true"),
-        ("theme", [s for s in (extra(package, "Subject Area 1"), extra(package, "Subject Area 2"), extra(package, "Subject Area 3")) if s != None]),
-        ("references", [s for s in extra(package, "Technical Documentation", default="").split(" ") if s != ""]),
+        ("PrimaryITInvestmentUII", extras.get("PrimaryITInvestmentUII")),
+        ("dataQuality", extras.get("Data Quality Met", default="true") == "true"),
+        ("theme", [s for s in (extras.get("Subject Area 1"), extras.get("Subject Area 2"), extras.get("Subject Area 3")) if s != None]),
+        ("references", [s for s in extras.get("Technical Documentation", default="").split(" ") if s != ""]),
         ("landingPage", package["url"]),
-        ("systemOfRecords", extra(package, "System Of Records")),
+        ("systemOfRecords", extras.get("System Of Records")),
         ("distribution",
             [
                 OrderedDict([
@@ -107,13 +106,12 @@ def make_datajson_entry(package, plugin):
                    ("accessURL", r["url"]),
                    ("format", r.get("mimetype", extension_to_mime_type(r["format"]))),
                 ])
-                for r in package["resources"]
-                if r["format"].lower() not in ("api", "query tool", "widget") and r["url"] != None
+                for r in resources.distribution
             ]),
     ]
 
     # Special case to help validation.
-    if extra(package, "Catalog Type") == "State Catalog":
+    if extras.get("Catalog Type") == "State Catalog":
         ret.append( ("_is_federal_dataset", False) )
 
     # GSA doesn't like null values and empty lists so remove those now.
@@ -124,25 +122,64 @@ def make_datajson_entry(package, plugin):
     return OrderedDict(ret)
     
 def extra(package, key, default=None, datatype=None, raise_if_missing=False):
-    # Retrieves the value of an extras field.
-    for extra in package["extras"]:
-        if extra["key"] == key:
-            v = extra["value"]
-            if key == "Access Level" and v == "Public":
-                v = "public"
-            if key == "Data Dictionary" and " " in v:
-                return default
-
-            if datatype == "iso8601":
-                # Hack: If this value is a date, convert Drupal style dates to ISO 8601
-                # dates by replacing the space date/time separator with a T. Also if it
-                # looks like a plain date (midnight time), remove the time component.
-                v = v.replace(" ", "T")
-                v = v.replace("T00:00:00", "")
-
-            return v
-    if raise_if_missing: raise ValueError("Missing value for %s.", key)
-    return default
+    # Retrieves the value of an extras field. When getting more than one, make a
+    # PackageExtras once and use it instead.
+    return PackageExtras(package["extras"]).get(key, default=default, datatype=datatype, raise_if_missing=raise_if_missing)
+
+# Resource formats in order of preference for the primary resource, and the
+# formats of resources that aren't the data itself.
+PRIMARY_FORMATS = ("csv", "xls", "xml", "text", "zip", "rdf")
+PRIMARY_FORMAT_RANK = dict((f, i) for i, f in enumerate(PRIMARY_FORMATS))
+NON_DATA_FORMATS = frozenset(("api", "query tool", "widget"))
+
+# The resources of a package picked out for its data.json entry: the primary
+# resource and the API resource (each {} if there isn't one, as returned by
+# get_primary_resource and get_api_resource), and the resources listed in the
+# distribution.
+ResourceSelection = namedtuple("ResourceSelection", ["primary", "api", "distribution"])
+
+def classify_resources(package):
+    # Cleans up the URL and mimetype of each of the package's resources and
+    # returns a ResourceSelection, all in one pass over the resources.
+    flagged_primary = None
+    best_primary = None
+    best_rank = None
+    any_data = None
+    api = None
+    distribution = []
+    for r in package["resources"]:
+        if r["url"] != None and not is_url(r["url"]):
+            r["url"] = None
+        if r["mimetype"] != None:
+            r["mimetype"] = MIME_TYPE_PARAMETERS_REGEX.sub("", r["mimetype"])
+        # r.get doesn't get this right, so logic it here
+        if r["mimetype"] == None:
+            r["mimetype"] = extension_to_mime_type(r["format"])
+
+        # If this came from a harvested data.json file, we marked the resource
+        # that came from the top-level accessURL as 'is_primary_distribution'.
+        if flagged_primary is None and r.get("is_primary_distribution") == 'true':
+            flagged_primary = r
+
+        # Otherwise we prefer certain formats over others, and the first of
+        # those formats over later ones.
+        format = r["format"].lower()
+        rank = PRIMARY_FORMAT_RANK.get(format)
+        if rank is not None and (best_rank is None or rank < best_rank):
+            best_primary, best_rank = r, rank
+
+        if format in NON_DATA_FORMATS:
+            if api is None and format == "api":
+                api = r
+        else:
+            if any_data is None:
+                any_data = r
+            if r["url"] != None:
+                distribution.append(r)
+
+    for primary in (flagged_primary, best_primary, any_data, { }):
+        if primary is not None: break
+    return ResourceSelection(primary, api if api is not None else { }, distribution)
 
 def get_best_resource(package, acceptable_formats, unacceptable_formats=None):
     resources = list(r for r in package["resources"] if r["format"].lower() in acceptable_formats)
@@ -173,32 +210,34 @@ def get_api_resource(package):
     # Return info about an API resource.
     return get_best_resource(package, ("api",))
 
-def build_temporal(package):
+def build_temporal(package, extras=None):
     # Build one dataset entry of the data.json file.
+    if extras is None: extras = PackageExtras(package["extras"])
     try:
         # we ask extra() to raise if either the start or end date is missing since we can't
         # form a valid value in that case
         return \
-              extra(package, "Coverage Period Start", datatype="iso8601", raise_if_missing=True) \
+              extras.get("Coverage Period Start", datatype="iso8601", raise_if_missing=True) \
             + "/" \
-            + extra(package, "Coverage Period End", datatype="iso8601", raise_if_missing=True)
+            + extras.get("Coverage Period End", datatype="iso8601", raise_if_missing=True)
     except ValueError:
         return None
 
+EXTENSION_MIME_TYPES = FrozenDict({
+    "csv": "text/csv",
+    "xls": "application/vnd.ms-excel",
+    "xml": "application/xml",
+    "rdf": "application/rdf+xml",
+    "json": "application/json",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "text": "text/plain",
+    "feed": "application/rss+xml",
+})
+
+@memoize(maxsize=1024)
 def extension_to_mime_type(file_ext):
 #    if file_ext is None: return None
 #    if file_ext is "Other": return None
     if file_ext is None: return "application/unknown"
-    if file_ext is "Other": return "application/unknown"
-    ext = {
-        "csv": "text/csv",
-        "xls": "application/vnd.ms-excel",
-        "xml": "application/xml",
-        "rdf": "application/rdf+xml",
-        "json": "application/json",
-        "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        "text": "text/plain",
-        "feed": "application/rss+xml",
-    }
-    return ext.get(file_ext.lower(), "application/unknown")
-    
+    if file_ext == "Other": return "application/unknown"
+    return EXTENSION_MIME_TYPES.get(file_ext.lower(), "application/unknown")
@@ -2,7 +2,8 @@ import ckan.plugins as p
 
 from ckan.lib.base import BaseController, render, c
 from pylons import request, response
-import json, re
+import json, re, os, hashlib, calendar
+from email.utils import formatdate
 
 try:
     from collections import OrderedDict # 2.7
@@ -11,13 +12,48 @@ except ImportError:
 
 import ckan.model
 
+import logging
+log = logging.getLogger(__name__)
+
 from package_to_pod import make_datajson_entry, get_facet_fields
 from pod_jsonld import dataset_to_jsonld
+import catalog_cache, json_stream, package_source, artifacts
+
+# The publishers whose datasets appear in the /data.jsonhhs output.
+HHS_AUTHORS = ["Administration for Children and Families", "Administration for Community Living", "Agency for Healthcare Research and Quality", "Centers for Disease Control and Prevention", "Centers for Medicare & Medicaid Services", "Department of Health & Human Services", "Health Resources and Services Administration", "Indian Health Service", "National Cancer Institute", "National Institute on Drug Abuse", "National Institutes of Health", "National Library of Medicine", "Substance Abuse & Mental Health Services Administration", "U.S. Food and Drug Administration"]
 
 class DataJsonPlugin(p.SingletonPlugin):
     p.implements(p.interfaces.IConfigurer)
+    p.implements(p.interfaces.IConfigurable)
     p.implements(p.interfaces.IRoutes, inherit=True)
     p.implements(p.interfaces.IFacets)
+    p.implements(p.interfaces.IDomainObjectModification, inherit=True)
+
+    # The settings that the harvesters use too, with their defaults. The
+    # datajson_harvest plugin can be enabled without this one, in which case
+    # update_config never runs, so the harvesters call load_harvest_settings
+    # themselves if it hasn't been (see DatasetHarvesterBase.settings).
+    harvest_settings_loaded = False
+    error_email_from = None
+    email_to = None
+    allow_harvester_deletion = True
+    import_workers = 1
+    defer_indexing = False
+    harvest_snapshot_dir = None
+    harvest_object_retention_days = 30
+    cache_enabled = False
+
+    @classmethod
+    def load_harvest_settings(cls, config):
+        cls.error_email_from = config.get("error_email_from")
+        cls.email_to = config.get("email_to")
+        cls.allow_harvester_deletion = config.get("ckanext.datajson.allow_harvester_deletion", True)
+        cls.import_workers = p.toolkit.asint(config.get("ckanext.datajson.import_workers", 1))
+        cls.defer_indexing = p.toolkit.asbool(config.get("ckanext.datajson.defer_indexing", False))
+        cls.harvest_snapshot_dir = config.get("ckanext.datajson.harvest_snapshot_dir")
+        cls.harvest_object_retention_days = p.toolkit.asint(config.get("ckanext.datajson.harvest_object_retention_days", 30))
+        cls.cache_enabled = p.toolkit.asbool(config.get("ckanext.datajson.cache", False))
+        cls.harvest_settings_loaded = True
 
     # IConfigurer
     
@@ -31,17 +67,29 @@ class DataJsonPlugin(p.SingletonPlugin):
         DataJsonPlugin.ld_id = config.get("ckanext.datajsonld.id", config.get("ckan.site_url"))
         DataJsonPlugin.ld_title = config.get("ckan.site_title", "Catalog")
         DataJsonPlugin.site_url = config.get("ckan.site_url")
-        DataJsonPlugin.error_email_from = config.get("error_email_from")
-        DataJsonPlugin.allow_harvester_deletion = config.get("ckanext.datajson.allow_harvester_deletion", True)
-        DataJsonPlugin.email_to = config.get("email_to")
+        DataJsonPlugin.load_harvest_settings(config)
+        DataJsonPlugin.bureau_codes_file = config.get("ckanext.datajson.bureau_codes_file")
         DataJsonPlugin.default_contactpoint = config.get("ckanext.datajson.default_contactpoint")
         DataJsonPlugin.default_mbox = config.get("ckanext.datajson.default_mbox")
         DataJsonPlugin.default_keywords = config.get("ckanext.datajson.default_keywords")
+        DataJsonPlugin.cache_max_age = p.toolkit.asint(config.get("ckanext.datajson.cache.max_age", 86400)) # seconds, 0 for no bound
+        DataJsonPlugin.streaming = p.toolkit.asbool(config.get("ckanext.datajson.streaming", False))
+        DataJsonPlugin.page_size = p.toolkit.asint(config.get("ckanext.datajson.page_size", 500))
+        DataJsonPlugin.compact = p.toolkit.asbool(config.get("ckanext.datajson.compact", False))
+        DataJsonPlugin.artifact_dir = config.get("ckanext.datajson.artifact_dir")
 
         # Adds our local templates directory. It's smart. It knows it's
         # relative to the path of *this* file. Wow.
         p.toolkit.add_template_directory(config, "templates")
 
+    # IConfigurable
+
+    def configure(self, config):
+        # Called once the database is set up, unlike update_config. Creates the
+        # catalog cache's table if the cache is on but initdb wasn't run.
+        if DataJsonPlugin.cache_enabled:
+            catalog_cache.ensure_table()
+
     # IRoutes
 
     def before_map(self, m):
@@ -75,6 +123,21 @@ class DataJsonPlugin(p.SingletonPlugin):
     def organization_facets(self, facets_dict, organization_type, package_type):
         return facets_dict
 
+    # IDomainObjectModification
+
+    def notify(self, entity, operation):
+        # Keep the catalog cache up to date as packages change. We only mark
+        # the entry as invalid here and let the next catalog request regenerate
+        # it, so that saving a package stays fast.
+        if not DataJsonPlugin.cache_enabled or not isinstance(entity, ckan.model.Package):
+            return
+        if not catalog_cache.ensure_table():
+            return # already logged; the cache isn't used without its table
+        if operation == ckan.model.domain_object.DomainObjectOperation.deleted:
+            catalog_cache.remove_entry(entity.id)
+        else:
+            catalog_cache.invalidate_entry(entity.id)
+
 class DataJsonController(BaseController):
     def generate_output(self, format):
         # set content type (charset required or pylons throws an error)
@@ -83,34 +146,39 @@ class DataJsonController(BaseController):
         # allow caching of response (e.g. by Apache)
         del response.headers["Cache-Control"]
         del response.headers["Pragma"]
-        
-        # output
-        if format == 'json-hhs':
-            data = make_json_hhs()
-        else:
-            data = make_json()
-        
-        if format == 'json-ld':
-            # Convert this to JSON-LD.
-            data = OrderedDict([
-                ("@context", OrderedDict([
-                    ("rdfs", "http://www.w3.org/2000/01/rdf-schema#"),
-                    ("dcterms", "http://purl.org/dc/terms/"),
-                    ("dcat", "http://www.w3.org/ns/dcat#"),
-                    ("foaf", "http://xmlns.com/foaf/0.1/"),
-                    ("pod", "http://project-open-data.github.io/schema/2013-09-20_1.0#"),
-                    ])
-                ),
-                ("@id", DataJsonPlugin.ld_id),
-                ("@type", "dcat:Catalog"),
-                ("dcterms:title", DataJsonPlugin.ld_title),
-                ("rdfs:label", DataJsonPlugin.ld_title),
-                ("foaf:homepage", DataJsonPlugin.site_url),
-                ("dcat:dataset", [dataset_to_jsonld(d) for d in data]),
-            ])
-            
-        return p.toolkit.literal(json.dumps(data, indent=2))
 
+        # Tell clients what version of the catalog this is, and if they already
+        # have it, stop before doing any work to generate it.
+        version, last_modified = catalog_version(format)
+        etag = version
+        encoding = None
+        if DataJsonPlugin.artifact_dir:
+            # The pre-generated files come pre-compressed.
+            response.headers["Vary"] = "Accept-Encoding"
+            encoding = artifacts.choose_encoding(request.headers.get("Accept-Encoding"))
+            etag = artifacts.encoding_etag(version, encoding)
+        response.headers["ETag"] = etag
+        if last_modified is not None:
+            response.headers["Last-Modified"] = formatdate(last_modified, usegmt=True)
+        if is_not_modified(etag, last_modified):
+            response.status_int = 304
+            return ""
+
+        if DataJsonPlugin.artifact_dir:
+            # Send the pre-generated (and possibly pre-compressed) file for this
+            # version of the catalog, generating it first if needed.
+            f = artifacts.open_artifact(DataJsonPlugin.artifact_dir, format, DataJsonPlugin.compact, version, encoding,
+                lambda : make_output(format))
+            if encoding:
+                response.headers["Content-Encoding"] = encoding
+            response.headers["Content-Length"] = str(os.fstat(f.fileno()).st_size)
+            return artifacts.iter_file(f)
+
+        chunks = make_output(format)
+        if DataJsonPlugin.streaming:
+            # Send the response body as it is generated.
+            return stream_output(chunks)
+        return p.toolkit.literal("".join(chunks))
 
     def generate_json(self):
         return self.generate_output('json')
@@ -128,8 +196,29 @@ class DataJsonController(BaseController):
             c.number_of_records = None
             c.errors = []
             
+            import validator
+            if validator.ijson is not None:
+                # Validate the file as it is downloaded so that very large files
+                # don't have to be loaded into memory all at once.
+                import urllib2
+                try:
+                    f = urllib2.urlopen(c.source_url)
+                except (urllib2.URLError, IOError) as e:
+                    c.errors.append(("Error Loading File", ["The address could not be loaded: " + unicode(e)]))
+                else:
+                    try:
+                        c.number_of_records = validator.validate_stream(f, c.source_url, c.errors)
+                    except IOError as e:
+                        c.errors.append(("Error Loading File", ["The address could not be loaded: " + unicode(e)]))
+                    except Exception as e:
+                        c.errors.append(("Internal Error", ["Something bad happened: " + unicode(e)]))
+                    finally:
+                        f.close()
+                if len(c.errors) == 0:
+                    c.errors.append(("No Errors", ["Great job!"]))
+                return render('datajsonvalidator.html')
+
             import urllib, json
-            from validator import do_validation
             body = None
             try:
                 body = json.load(urllib.urlopen(c.source_url))
@@ -142,7 +231,7 @@ class DataJsonController(BaseController):
                 
             if body:
                 try:
-                    do_validation(body, c.source_url, c.errors)
+                    validator.do_validation(body, c.source_url, c.errors)
                     if type(body) == list:
                         c.number_of_records = len(body)
                 except Exception as e:
@@ -166,13 +255,100 @@ class DataJsonController(BaseController):
 
         return render('html_rendition.html')
 
+def make_jsonld_header():
+    # The JSON-LD catalog wrapper, not including its "dcat:dataset" list.
+    return OrderedDict([
+        ("@context", OrderedDict([
+            ("rdfs", "http://www.w3.org/2000/01/rdf-schema#"),
+            ("dcterms", "http://purl.org/dc/terms/"),
+            ("dcat", "http://www.w3.org/ns/dcat#"),
+            ("foaf", "http://xmlns.com/foaf/0.1/"),
+            ("pod", "http://project-open-data.github.io/schema/2013-09-20_1.0#"),
+            ])
+        ),
+        ("@id", DataJsonPlugin.ld_id),
+        ("@type", "dcat:Catalog"),
+        ("dcterms:title", DataJsonPlugin.ld_title),
+        ("rdfs:label", DataJsonPlugin.ld_title),
+        ("foaf:homepage", DataJsonPlugin.site_url),
+    ])
+
+def catalog_version(format):
+    # Returns an ETag and a Last-Modified time (as a Unix timestamp, or None for
+    # an empty site) for the given output format. The ETag also covers the
+    # settings that affect the output. It's made from the full metadata_modified
+    # time, microseconds included, so that two changes within the same second
+    # give different ETags even though Last-Modified can't tell them apart.
+    modified, count = package_source.catalog_version()
+    last_modified = None
+    if modified is not None:
+        last_modified = calendar.timegm(modified.utctimetuple())
+        modified = modified.isoformat()
+    h = hashlib.sha1()
+    for v in (format, DataJsonPlugin.compact, modified, count, DataJsonPlugin.site_url, DataJsonPlugin.ld_id, DataJsonPlugin.ld_title,
+        DataJsonPlugin.default_contactpoint, DataJsonPlugin.default_mbox, DataJsonPlugin.default_keywords):
+        h.update(unicode(v).encode("utf8") + "|")
+    return '"%s"' % h.hexdigest(), last_modified
+
+def is_not_modified(etag, last_modified):
+    # Checks the request's conditional headers. If-None-Match takes precedence
+    # over If-Modified-Since when both are given.
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match:
+        tags = [t.strip() for t in if_none_match.split(",")]
+        return "*" in tags or etag in tags or ("W/" + etag) in tags
+    if last_modified is not None and request.if_modified_since:
+        return last_modified <= calendar.timegm(request.if_modified_since.utctimetuple())
+    return False
+
+def json_style():
+    # Returns the indent and separators arguments for json.dumps.
+    if DataJsonPlugin.compact:
+        return None, (",", ":")
+    return 2, None
+
+def make_output(format):
+    # Returns an iterator over chunks of the response body. The chunks join up
+    # to exactly what json.dumps(..., indent=2) of the whole catalog would give,
+    # or in compact mode the same without any whitespace.
+    indent, separators = json_style()
+
+    if format == 'json-hhs':
+        entries = iter_catalog(HHS_AUTHORS)
+    else:
+        entries = iter_catalog()
+
+    if format == 'json-ld':
+        # Convert this to JSON-LD.
+        return json_stream.iter_json_object(make_jsonld_header(), "dcat:dataset",
+            (dataset_to_jsonld(d) for d in entries), indent=indent, separators=separators)
+
+    return json_stream.iter_json_array(entries, indent=indent, separators=separators)
+
+def stream_output(chunks):
+    # The response body is generated after the controller has returned and CKAN
+    # has cleaned up the request's database session, so clean up after ourselves too.
+    try:
+        for chunk in chunks:
+            yield chunk
+    finally:
+        ckan.model.Session.remove()
+
+def iter_packages(package_type="dataset", authors=None):
+    # Yields the current public packages, fetching them from the database a page at a time.
+    return package_source.iter_packages(DataJsonPlugin.page_size, package_type=package_type, authors=authors)
+
+def iter_catalog(authors=None):
+    # Yields the data.json entries, optionally only for datasets by certain authors.
+    if DataJsonPlugin.cache_enabled:
+        if catalog_cache.is_usable():
+            return catalog_cache.iter_catalog(DataJsonPlugin, authors=authors)
+        log.debug('the datajson catalog cache has not been filled yet, so it is not used')
+    return (make_datajson_entry(pkg, DataJsonPlugin) for pkg in iter_packages(authors=authors))
+
 def make_json_hhs():
-    packages = p.toolkit.get_action("current_package_list_with_resources")(None, {})
-    return [make_datajson_entry(pkg, DataJsonPlugin) for pkg in packages if pkg["type"] == "dataset" and pkg["author"] in ["Administration for Children and Families", "Administration for Community Living", "Agency for Healthcare Research and Quality", "Centers for Disease Control and Prevention", "Centers for Medicare & Medicaid Services", "Department of Health & Human Services", "Health Resources and Services Administration", "Indian Health Service", "National Cancer Institute", "National Institute on Drug Abuse", "National Institutes of Health", "National Library of Medicine", "Substance Abuse & Mental Health Services Administration", "U.S. Food and Drug Administration"] ]
+    return list(iter_catalog(HHS_AUTHORS))
 
 def make_json():
     # Build the data.json file.
-    packages = p.toolkit.get_action("current_package_list_with_resources")(None, {})
-    return [make_datajson_entry(pkg, DataJsonPlugin) for pkg in packages if pkg["type"] == "dataset"]
-    
-
+    return list(iter_catalog())
@@ -3,10 +3,13 @@ from ckan.lib.munge import munge_title_to_name
 import re
 
 from ckanext.datajson.harvester_base import DatasetHarvesterBase
+from ckanext.datajson.package_extras import PackageExtras
+from ckanext.datajson.memo import memoize, FrozenDict
 
-def parse_datajson_entry(datajson, package, harvester_config):
+def parse_datajson_entry(datajson, package, harvester_config, extras=None):
 	# Notes:
 	# * the data.json field "identifier" is handled by the harvester
+	# * extras is the package's extras as a PackageExtras, if the caller has one
 
 	package["title"] = datajson.get("title", package.get("title"))
 	package["notes"] = datajson.get("description", package.get("notes"))
@@ -25,35 +28,36 @@ def parse_datajson_entry(datajson, package, harvester_config):
 		package["tags"] = [ { "name": munge_title_to_name(t) } for t in
 			datajson.get("keyword") if t.strip() != ""]
 
-	extra(package, "Group Name", datajson, "__not__in_pod__schema") # i.e. dataset grouping string from HHS schema
-	extra(package, "Date Updated", datajson, "modified")
-	extra(package, "Agency", datajson, "__not__in_pod__schema") # i.e. federal department: not in data.json spec but required by the HHS metadata schema
-	extra(package, "author_id", datajson, "__not__in_pod__schema") # i.e. URI for agency: not in data.json spec but in HHS metadata schema
-	extra(package, "Bureau Code", datajson, "bureauCode")
-	extra(package, "Program Code", datajson, "programCode")
-	extra(package, "Agency Program URL", datajson, "__not__in_pod__schema") # i.e. URL for agency program
-	extra(package, "Contact Name", datajson, "contactPoint") # not in HHS schema
-	extra(package, "Contact Email", datajson, "mbox") # not in HHS schema
-	extra(package, "Access Level", datajson, "accessLevel") # not in HHS schema
-	extra(package, "Access Level Comment", datajson, "accessLevelComment") # not in HHS schema
-	extra(package, "Data Dictionary", datajson, "dataDictionary")
+	if extras is None: extras = PackageExtras(package.setdefault("extras", []))
+	extra(extras, "Group Name", datajson, "__not__in_pod__schema") # i.e. dataset grouping string from HHS schema
+	extra(extras, "Date Updated", datajson, "modified")
+	extra(extras, "Agency", datajson, "__not__in_pod__schema") # i.e. federal department: not in data.json spec but required by the HHS metadata schema
+	extra(extras, "author_id", datajson, "__not__in_pod__schema") # i.e. URI for agency: not in data.json spec but in HHS metadata schema
+	extra(extras, "Bureau Code", datajson, "bureauCode")
+	extra(extras, "Program Code", datajson, "programCode")
+	extra(extras, "Agency Program URL", datajson, "__not__in_pod__schema") # i.e. URL for agency program
+	extra(extras, "Contact Name", datajson, "contactPoint") # not in HHS schema
+	extra(extras, "Contact Email", datajson, "mbox") # not in HHS schema
+	extra(extras, "Access Level", datajson, "accessLevel") # not in HHS schema
+	extra(extras, "Access Level Comment", datajson, "accessLevelComment") # not in HHS schema
+	extra(extras, "Data Dictionary", datajson, "dataDictionary")
 	# accessURL is handled with the distributions below
 	# webService is handled with the distributions below
-	extra(package, "Format", datajson, "format") # not in HHS schema
-	extra(package, "License Agreement", datajson, "license")
-	extra(package, "Geographic Scope", datajson, "spatial")
-	extra(package, "Temporal", datajson, "temporal") # HHS uses Coverage Period (FY) Start/End
-	extra(package, "Date Released", datajson, "issued")
-	extra(package, "Publish Frequency", datajson, "accrualPeriodicity") # not in HHS schema but in POD schema
-	extra(package, "Language", datajson, "language") # not in HHS schema
-	extra(package, "Granularity", datajson, "granularity") # not in HHS schema
-	extra(package, "Data Quality Met", datajson, "dataQuality") # not in HHS schema
-	extra(package, "Subject Area 1", datajson, "theme")
-	extra(package, "Subject Area 2", datajson, "__not__in_pod__schema")
-	extra(package, "Subject Area 2", datajson, "__not__in_pod__schema")
-	extra(package, "Technical Documentation", datajson, "references")
-	extra(package, "PrimaryITInvestmentUII", datajson, "PrimaryITInvestmentUII") # not in HHS schema
-	extra(package, "System Of Records", datajson, "systemOfRecords") # not in HHS schema
+	extra(extras, "Format", datajson, "format") # not in HHS schema
+	extra(extras, "License Agreement", datajson, "license")
+	extra(extras, "Geographic Scope", datajson, "spatial")
+	extra(extras, "Temporal", datajson, "temporal") # HHS uses Coverage Period (FY) Start/End
+	extra(extras, "Date Released", datajson, "issued")
+	extra(extras, "Publish Frequency", datajson, "accrualPeriodicity") # not in HHS schema but in POD schema
+	extra(extras, "Language", datajson, "language") # not in HHS schema
+	extra(extras, "Granularity", datajson, "granularity") # not in HHS schema
+	extra(extras, "Data Quality Met", datajson, "dataQuality") # not in HHS schema
+	extra(extras, "Subject Area 1", datajson, "theme")
+	extra(extras, "Subject Area 2", datajson, "__not__in_pod__schema")
+	extra(extras, "Subject Area 2", datajson, "__not__in_pod__schema")
+	extra(extras, "Technical Documentation", datajson, "references")
+	extra(extras, "PrimaryITInvestmentUII", datajson, "PrimaryITInvestmentUII") # not in HHS schema
+	extra(extras, "System Of Records", datajson, "systemOfRecords") # not in HHS schema
 
 	# In HHS schema but not in POD schema:
 	# License Agreement Required, Collection Frequency, Unit of Analysis, Collection Instrument
@@ -119,25 +123,40 @@ def parse_datajson_entry(datajson, package, harvester_config):
 		for d in datajson.get("distribution"):
 			add_resource(d.get("accessURL"), d.get("format"), socrata_formats=d.get("formats"), is_primary=(d.get("accessURL")==datajson.get("accessURL")))
 	
-def extra(package, ckan_key, datajson, datajson_fieldname):
+def extra(extras, ckan_key, datajson, datajson_fieldname):
 	value = datajson.get(datajson_fieldname)
 	if not value: return
-	DatasetHarvesterBase.set_extra(package, ckan_key, value)
+	DatasetHarvesterBase.set_extra_value(extras, ckan_key, value)
 	
+# e.g. "text/csv; charset=utf-8"
+MIME_TYPE_REGEX = re.compile(r"((application|text)/(\S+))(; charset=.*)?")
+
+# MIME types that Socrata gives as formats, mapped to our formats.
+MIME_TYPE_FORMATS = FrozenDict({
+	"text/plain": "Text",
+	"application/zip": "ZIP",
+	"application/vnd.ms-excel": "XLS",
+	"application/x-msaccess": "Access",
+})
+
 def normalize_format(format, raise_on_unknown=False):
 	# Format should be a file extension. But sometimes Socrata outputs a MIME type.
+	format, unknown = classify_format(format)
+	if raise_on_unknown and unknown: raise ValueError() # caught & ignored by caller
+	return format
+
+@memoize(maxsize=1024)
+def classify_format(format):
+	# Returns the normalized format and whether it is one that normalize_format
+	# should reject when raise_on_unknown is set. There are only so many formats
+	# in the wild, so the answers are memoized.
 	if format is None:
-		if raise_on_unknown: raise ValueError()
-		return "Unknown"
+		return "Unknown", True
 	format = format.lower()
-	m = re.match(r"((application|text)/(\S+))(; charset=.*)?", format)
+	m = MIME_TYPE_REGEX.match(format)
 	if m:
-		if m.group(1) == "text/plain": return "Text"
-		if m.group(1) == "application/zip": return "ZIP"
-		if m.group(1) == "application/vnd.ms-excel": return "XLS"
-		if m.group(1) == "application/x-msaccess": return "Access"
-		if raise_on_unknown: raise ValueError() # caught & ignored by caller
-		return "Other"
-	if format == "text": return "Text"
-	if raise_on_unknown and "?" in format: raise ValueError() # weird value we should try to filter out; exception is caught & ignored by caller
-	return format.upper() # hope it's one of our formats by converting to upprecase
+		if m.group(1) in MIME_TYPE_FORMATS: return MIME_TYPE_FORMATS[m.group(1)], False
+		return "Other", True
+	if format == "text": return "Text", False
+	# weird values with a "?" are unknown, so we should try to filter them out
+	return format.upper(), "?" in format # hope it's one of our formats by converting to upprecase
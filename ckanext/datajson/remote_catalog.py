@@ -0,0 +1,89 @@
+import os, json, hashlib, tempfile, urllib2
+
+import logging
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 65536
+
+class CatalogSnapshot(object):
+    '''
+    The last copy we downloaded of a harvest source's remote catalog, kept on
+    disk along with the ETag and Last-Modified headers it came with (so we can
+    make conditional requests for it next time), a digest of its contents, and
+    a note of the harvester settings it was last harvested with.
+    '''
+
+    def __init__(self, directory, source_id):
+        self.directory = directory
+        self.path = os.path.join(directory, source_id + ".json")
+        self.meta_path = self.path + ".meta"
+        try:
+            with open(self.meta_path) as f:
+                self.meta = json.load(f)
+        except (IOError, ValueError):
+            self.meta = { }
+
+    def fetch(self, url, timeout=None):
+        # Brings the snapshot up to date with the remote file. Returns True if the
+        # remote file's contents changed since the last time, False if not.
+        request = urllib2.Request(url)
+        have_snapshot = os.path.exists(self.path)
+        if have_snapshot:
+            if self.meta.get("etag"):
+                request.add_header("If-None-Match", self.meta["etag"])
+            if self.meta.get("last_modified"):
+                request.add_header("If-Modified-Since", self.meta["last_modified"])
+
+        try:
+            response = urllib2.urlopen(request, None, timeout)
+        except urllib2.HTTPError as e:
+            if e.code == 304 and have_snapshot:
+                log.debug('%s not modified' % url)
+                return False
+            raise
+
+        # Download the file to a temporary file, computing its digest as we go,
+        # and then replace the snapshot with it.
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        digest = hashlib.sha1()
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while True:
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk: break
+                    digest.update(chunk)
+                    f.write(chunk)
+            os.rename(temp_path, self.path)
+        except:
+            if os.path.exists(temp_path): os.unlink(temp_path)
+            raise
+        finally:
+            response.close()
+
+        changed = not have_snapshot or digest.hexdigest() != self.meta.get("digest")
+        self.meta["etag"] = response.info().getheader("ETag")
+        self.meta["last_modified"] = response.info().getheader("Last-Modified")
+        self.meta["digest"] = digest.hexdigest()
+        if changed:
+            self.meta["processed"] = None
+        self.save_meta()
+        return changed
+
+    def open(self):
+        return open(self.path, "rb")
+
+    def is_processed(self, state):
+        # Has the current snapshot been harvested completely with these settings?
+        return self.meta.get("processed") == state
+
+    def mark_processed(self, state):
+        self.meta["processed"] = state
+        self.save_meta()
+
+    def save_meta(self):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.meta, f)
+        os.rename(temp_path, self.meta_path)
@@ -0,0 +1,108 @@
+import threading
+import logging
+from contextlib import contextmanager
+
+from ckan import model
+import ckan.lib.search as search
+
+log = logging.getLogger("datajson.search_indexing")
+
+# CKAN sends a package to Solr every time it is saved, from the search plugin's
+# IDomainObjectModification notify method. While a thread is inside suppressed(),
+# packages saved by that thread are skipped there, so that the harvester can
+# index them itself later, in bulk. Other threads (e.g. web requests) aren't
+# affected, and deletions are always passed through.
+#
+# Both hooks below wrap a CKAN attribute. If this version of CKAN doesn't have
+# it, that's logged and the harvester falls back to CKAN's own indexing.
+
+state = threading.local()
+
+def install():
+    # Wraps the search plugin's notify method, once. Returns False if this
+    # version of CKAN doesn't have the plugin, in which case nothing can be
+    # suppressed.
+    cls = getattr(search, "SynchronousSearchPlugin", None)
+    if cls is None or not callable(getattr(cls, "notify", None)):
+        log.warn("ckan.lib.search.SynchronousSearchPlugin.notify was not found; "
+            "harvested packages will be indexed as they are saved")
+        return False
+    if getattr(cls.notify, "datajson_wrapped", False):
+        return True
+    original_notify = cls.notify
+    def notify(self, entity, operation):
+        if getattr(state, "suppressed", 0) and isinstance(entity, model.Package) \
+            and operation != model.domain_object.DomainObjectOperation.deleted:
+            return
+        return original_notify(self, entity, operation)
+    notify.datajson_wrapped = True
+    cls.notify = notify
+    return True
+
+supported = install()
+
+@contextmanager
+def suppressed():
+    # Skips CKAN's indexing of packages saved by this thread within the block.
+    state.suppressed = getattr(state, "suppressed", 0) + 1
+    try:
+        yield
+    finally:
+        state.suppressed -= 1
+
+class DocumentCollector(object):
+    # Stands in for the Solr connection that PackageSearchIndex.index_package
+    # opens, keeping the documents instead of sending them. Has the methods
+    # index_package calls with both solrpy (add_many) and pysolr (add).
+    def __init__(self):
+        self.docs = []
+    def add_many(self, docs, **kwargs):
+        self.docs.extend(docs)
+    def add(self, docs, **kwargs):
+        self.docs.extend(docs)
+    def commit(self, **kwargs):
+        pass
+    def close(self):
+        pass
+
+def install_collector():
+    # Wraps the make_connection that CKAN's search index module calls, once, so
+    # that a thread inside collecting() gets a DocumentCollector from it.
+    index = getattr(search, "index", None)
+    if index is None or not callable(getattr(index, "make_connection", None)):
+        log.warn("ckan.lib.search.index.make_connection was not found; "
+            "packages will be sent to Solr one at a time")
+        return False
+    if getattr(index.make_connection, "datajson_wrapped", False):
+        return True
+    original_make_connection = index.make_connection
+    def make_connection(*args, **kwargs):
+        collector = getattr(state, "collector", None)
+        if collector is not None:
+            return collector
+        return original_make_connection(*args, **kwargs)
+    make_connection.datajson_wrapped = True
+    index.make_connection = make_connection
+    return True
+
+can_collect = install_collector()
+
+@contextmanager
+def collecting():
+    # Within the block, documents that this thread's index_package calls would
+    # send to Solr are kept in the yielded collector's docs list instead.
+    collector = DocumentCollector()
+    state.collector = collector
+    try:
+        yield collector
+    finally:
+        state.collector = None
+
+def add_documents(conn, docs):
+    # Sends documents to Solr without committing them.
+    if not docs:
+        return
+    if hasattr(conn, "add_many"):
+        conn.add_many(docs, _commit=False) # solrpy
+    else:
+        conn.add(docs=docs, commit=False) # pysolr
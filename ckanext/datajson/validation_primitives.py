@@ -0,0 +1,41 @@
+import re
+
+import lepl.apps.rfc3696
+
+from memo import memoize
+
+# The checks of individual values that both the validator and the data.json
+# exporter make on every dataset. Catalogs repeat the same contact emails,
+# dates and URLs many times over, and the email check in particular is slow,
+# so the answers are memoized (see memo.memoize). Each function's cache_info()
+# reports its hits and misses.
+
+# from the iso8601 package, plus ^ and $ on the edges
+ISO8601_REGEX = re.compile(r"^([0-9]{4})(-([0-9]{1,2})(-([0-9]{1,2})"
+    r"((T)([0-9]{2}):([0-9]{2})(:([0-9]{2})(\.([0-9]+))?)?"
+    r"(Z|(([-+])([0-9]{2}):([0-9]{2})))?)?)?)?$")
+
+URL_REGEX = re.compile(
+        r'^(?:http|ftp)s?://' # http:// or https:// or ftp:// or ftps://
+        r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|' #domain...
+        r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})' # ...or ip
+        r'(?::\d+)?' # optional port
+        r'(?:/?|[/?]\S+)$', re.IGNORECASE)
+
+email_validator = lepl.apps.rfc3696.Email()
+
+@memoize(maxsize=4096)
+def is_url(value):
+    return URL_REGEX.match(value) is not None
+
+@memoize(maxsize=1024)
+def is_iso8601(value):
+    return ISO8601_REGEX.match(value) is not None
+
+@memoize(maxsize=1024)
+def is_email(value):
+    return bool(email_validator(value))
+
+def cache_info():
+    # Returns the CacheInfo of each of the memoized checks, by name.
+    return dict((f.__name__, f.cache_info()) for f in (is_url, is_iso8601, is_email))
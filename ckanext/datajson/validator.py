@@ -1,16 +1,6 @@
 import re
 
-# from the iso8601 package, plus ^ and $ on the edges
-ISO8601_REGEX = re.compile(r"^([0-9]{4})(-([0-9]{1,2})(-([0-9]{1,2})"
-    r"((T)([0-9]{2}):([0-9]{2})(:([0-9]{2})(\.([0-9]+))?)?"
-    r"(Z|(([-+])([0-9]{2}):([0-9]{2})))?)?)?)?$")
-
-URL_REGEX = re.compile(
-        r'^(?:http|ftp)s?://' # http:// or https:// or ftp:// or ftps://
-        r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|' #domain...
-        r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})' # ...or ip
-        r'(?::\d+)?' # optional port
-        r'(?:/?|[/?]\S+)$', re.IGNORECASE)
+from validation_primitives import ISO8601_REGEX, URL_REGEX, email_validator, is_url, is_iso8601, is_email
 
 ACCRUAL_PERIODICITY_VALUES = ("Annual", "Bimonthly", "Semiweekly", "Daily", "Biweekly", "Semiannual", "Biennial", "Triennial", "Three times a week", "Three times a month", "Continuously updated", "Monthly", "Quarterly", "Semimonthly", "Three times a year", "Weekly", "Completely irregular")
 
@@ -19,259 +9,344 @@ LANGUAGE_REGEX = re.compile("^[A-Za-z]{2}(-[A-Za-z]{2})?$")
 COMMON_MIMETYPES = ("application/zip", "application/vnd.ms-excel", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "text/csv", "application/xml", "application/rdf+xml", "application/json", "text/plain", "application/rss+xml")
 MIMETYPE_REGEX = re.compile("^(application|text)/([a-z\-\.\+]+)(;.*)?$")
 
-import lepl.apps.rfc3696
-email_validator = lepl.apps.rfc3696.Email()
+try:
+    # If ijson is installed, large files can be validated as they are parsed.
+    import ijson
+except ImportError:
+    ijson = None
 
-# load the OMB bureau codes on first load of this module
-import urllib, csv
-omb_burueau_codes = set()
-for row in csv.DictReader(urllib.urlopen("https://raw.github.com/seanherron/OMB-Agency-Bureau-and-Treasury-Codes/master/omb-agency-bureau-treasury-codes.csv")):
-    omb_burueau_codes.add(row["OMB Agency Code"] + ":" + row["OMB Bureau Code"])
+# The OMB bureau codes are loaded the first time they're needed from a copy of
+# the list saved on disk, which is downloaded if it isn't there yet (or can't
+# be read). Use refresh_omb_bureau_codes (or "paster datajson
+# refresh-bureau-codes") to get the latest list.
+import urllib2, csv, os, tempfile, threading, itertools, multiprocessing, time, StringIO, bisect
+import logging
+log = logging.getLogger(__name__)
+
+OMB_BUREAU_CODES_URL = "https://raw.github.com/seanherron/OMB-Agency-Bureau-and-Treasury-Codes/master/omb-agency-bureau-treasury-codes.csv"
+OMB_BUREAU_CODES_RETRY_INTERVAL = 300 # seconds to wait before trying again after a failure
+
+# What goes wrong when the list can't be downloaded or isn't what we expect
+# (e.g. an error page instead of the CSV file).
+OMB_BUREAU_CODES_ERRORS = (IOError, csv.Error, KeyError, TypeError, ValueError)
+
+omb_burueau_codes = None # a frozenset once loaded
+omb_bureau_codes_lock = threading.Lock()
+omb_bureau_codes_retry_at = 0 # when loading the list may next be tried
+
+def get_omb_bureau_codes():
+    # Returns the set of valid "agency:bureau" codes, or None if the list isn't
+    # available (we're offline and have never downloaded it). Once loaded the
+    # set is shared by everything in the process.
+    global omb_burueau_codes, omb_bureau_codes_retry_at
+    if omb_burueau_codes is None and time.time() >= omb_bureau_codes_retry_at:
+        with omb_bureau_codes_lock:
+            if omb_burueau_codes is None and time.time() >= omb_bureau_codes_retry_at:
+                try:
+                    omb_burueau_codes = load_omb_bureau_codes(omb_bureau_codes_path())
+                except OMB_BUREAU_CODES_ERRORS as e:
+                    # Don't try again for a while. Until then, bureau codes
+                    # aren't checked against the list (and the validation
+                    # report says so).
+                    log.warn('OMB bureau codes are not available: %s' % e)
+                    omb_bureau_codes_retry_at = time.time() + OMB_BUREAU_CODES_RETRY_INTERVAL
+    return omb_burueau_codes
+
+def load_omb_bureau_codes(path):
+    # Reads the saved copy of the list, or downloads it if there isn't one or
+    # it's unreadable.
+    if os.path.exists(path):
+        try:
+            with open(path) as f:
+                return parse_omb_bureau_codes(f)
+        except OMB_BUREAU_CODES_ERRORS as e:
+            log.warn('The saved OMB bureau codes in %s could not be read, downloading them again: %s' % (path, e))
+    return download_omb_bureau_codes(path)
+
+def refresh_omb_bureau_codes():
+    # Downloads the latest list, replacing the copy on disk, and returns the
+    # number of codes in it.
+    global omb_burueau_codes, omb_bureau_codes_retry_at
+    codes = download_omb_bureau_codes(omb_bureau_codes_path())
+    with omb_bureau_codes_lock:
+        omb_burueau_codes = codes
+        omb_bureau_codes_retry_at = 0
+    return len(codes)
+
+def omb_bureau_codes_path():
+    # The copy of the list goes in ckanext.datajson.bureau_codes_file if it's
+    # set, or else in CKAN's storage or cache directory, which only CKAN writes
+    # to (not a shared temporary directory).
+    from plugin import DataJsonPlugin
+    path = getattr(DataJsonPlugin, "bureau_codes_file", None)
+    if path: return path
+    from pylons import config
+    directory = config.get("ckan.storage_path") or config.get("cache_dir") \
+        or os.path.join(os.path.expanduser("~"), ".ckanext-datajson")
+    return os.path.join(directory, "datajson", "omb-bureau-codes.csv")
+
+def download_omb_bureau_codes(path):
+    # Downloads the list and saves it to path, but only if it can be parsed.
+    # Returns the codes.
+    response = urllib2.urlopen(OMB_BUREAU_CODES_URL, None, 30)
+    try:
+        data = response.read()
+    finally:
+        response.close()
+    codes = parse_omb_bureau_codes(StringIO.StringIO(data))
+    directory = os.path.dirname(path) or "."
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.chmod(temp_path, 0644) # mkstemp creates files only we can read
+    os.rename(temp_path, path)
+    return codes
+
+def parse_omb_bureau_codes(f):
+    codes = frozenset(row["OMB Agency Code"] + ":" + row["OMB Bureau Code"] for row in csv.DictReader(f))
+    if len(codes) == 0:
+        raise ValueError("the list of OMB bureau codes is empty")
+    return codes
 
 # main function for validation
-def do_validation(doc, src_url, errors_array):
-    errs = { }
-    
+def do_validation(doc, src_url, errors_array, processes=1, samples=False):
+    # Validates a whole catalog already loaded into memory and appends the
+    # errors to errors_array as (heading, [description, ...]) pairs. With more
+    # than one process (None for one per CPU), large catalogs are validated in
+    # chunks in parallel, with the same result. With samples, each description
+    # names the first few datasets with the problem.
     if type(doc) != list:
-        add_error(errs, 0, "Bad JSON Structure", "The file must be an array at its top level. That means the file starts with an open bracket [ and ends with a close bracket ].")
-    elif len(doc) == 0:
-        add_error(errs, 0, "Catalog Is Empty", "There are no entries in your file.")
+        validator = CatalogValidator(src_url)
+        validator.errs.add(0, "Bad JSON Structure", "The file must be an array at its top level. That means the file starts with an open bracket [ and ends with a close bracket ].")
+    elif processes != 1 and len(doc) > PARALLEL_CHUNK_SIZE:
+        validator = validate_parallel(doc, src_url, processes)
     else:
-        seen_identifiers = set()
-        
-        for i, item in enumerate(doc):
-            # Required
-            
-            # title
-            dataset_name = "dataset %d" % (i+1)
-            if check_string_field(item, "title", 5, dataset_name, errs):
-                dataset_name = '"%s"' % item.get("title", "").strip()
-
-            # No fields should be null or an empty list, according to GSA. After this point we treat nulls as if they were
-            # not present. This check must be after dataset_name is set above.
-            for k, v in item.items():
-                if v is None:
-                    add_error(errs, 2, "File Format Issues", "The '%s' field is set to 'null'. If there is no value, the field must not be present." % k, dataset_name)
-                if isinstance(v, list) and len(v) == 0:
-                    add_error(errs, 2, "File Format Issues", "The '%s' field is an empty list. If there is no value, the field must not be present." % k, dataset_name)
-                
-            # description
-            check_string_field(item, "description", 30, dataset_name, errs)
-                
-            # keyword
-            if isinstance(item.get("keyword"), (str, unicode)):
-                add_error(errs, 5, "Update Your File!", "The 'keyword' field used to be a string but now it must be an array.", dataset_name)
-                
-            elif check_required_field(item, "keyword", list, dataset_name, errs):
-                for kw in item["keyword"]:
-                    if not isinstance(kw, (str, unicode)):
-                        add_error(errs, 5, "Invalid Required Field Value", "Each keyword in the keyword array must be a string", dataset_name)
-                    elif len(kw.strip()) == 0:
-                        add_error(errs, 5, "Invalid Required Field Value", "A keyword in the keyword array was an empty string.", dataset_name)
-                    
-            # bureauCode
-            # (skip if this is known to not be a federal dataset)
-            if item.get("_is_federal_dataset", True) == True and \
-               check_required_field(item, "bureauCode", list, dataset_name, errs):
-                for bc in item["bureauCode"]:
-                    if not isinstance(bc, (str, unicode)):
-                        add_error(errs, 5, "Invalid Required Field Value", "Each bureauCode must be a string", dataset_name)
-                    elif ":" not in bc:
-                        add_error(errs, 5, "Invalid Required Field Value", "The bureau code \"%s\" is invalid. Start with the agency code, then a colon, then the bureau code." % bc, dataset_name)
-                    elif bc not in omb_burueau_codes:
-                        add_error(errs, 5, "Invalid Required Field Value", "The bureau code \"%s\" was not found in our list." % bc, dataset_name)
-                
-            # modified
-            check_date_field(item, "modified", dataset_name, errs)
-            
-            # publisher
-            check_string_field(item, "publisher", 1, dataset_name, errs)
-            
-            # contactPoint
-            check_string_field(item, "contactPoint", 3, dataset_name, errs)
-            
-            # mbox
-            if check_string_field(item, "mbox", 3, dataset_name, errs):
-                if not email_validator(item["mbox"]):
-                    add_error(errs, 5, "Invalid Required Field Value", "The email address \"%s\" is not a valid email address." % item["mbox"], dataset_name)
-            
-            # identifier
-            if check_string_field(item, "identifier", 1, dataset_name, errs):
-                if item["identifier"] in seen_identifiers:
-                    add_error(errs, 5, "Invalid Required Field Value", "The dataset identifier \"%s\" is used more than once." % item["identifier"], dataset_name)
-                seen_identifiers.add(item["identifier"])
-                
-            # programCode
-            # (don't bother reporting a missing programCode if no bureauCode is set)
-            if isinstance(item.get("bureauCode"), list) and check_required_field(item, "programCode", list, dataset_name, errs):
-                for s in item["programCode"]:
-                    if not isinstance(s, (str, unicode)):
-                        add_error(errs, 5, "Invalid Required Field Value", "Each value in the programCode array must be a string", dataset_name)
-                    elif len(s.strip()) == 0:
-                        add_error(errs, 5, "Invalid Required Field Value", "A value in the programCode array was an empty string.", dataset_name)
-                
-            # accessLevel
-            if check_string_field(item, "accessLevel", 0, dataset_name, errs):
-                if item["accessLevel"] not in ("public", "restricted public", "non-public"):
-                    add_error(errs, 5, "Invalid Required Field Value", "The field 'accessLevel' had an invalid value: \"%s\"" % item["accessLevel"], dataset_name)
-                elif item["accessLevel"] == "non-public":
-                    add_error(errs, 1, "Possible Private Data Leakage", "A dataset appears with accessLevel set to \"non-public\".", dataset_name)
-            
-            # Required-If-Applicable
-            
-            # accessLevelComment
-            if item.get("accessLevel") != "public":
-                check_string_field(item, "accessLevelComment", 10, dataset_name, errs)
-            
-            # accessURL & webService
-            if check_url_field(False, item, "accessURL", dataset_name, errs):
-                if item.get("accessURL") and isinstance(item.get("distribution"), list):
-                    # If accessURL and distribution are both given, the accessURL must be one of the distributions.
-                    for d in item["distribution"]:
-                        if d.get("accessURL") == item.get("accessURL"):
-                            break # found
-                    else: # not found
-                        add_error(errs, 20, "Where's the Dataset?", "If a top-level 'accessURL' and 'distribution' are both present, the accessURL must be one of the distributions.", dataset_name)
-
-            check_url_field(False, item, "webService", dataset_name, errs)
-            if item.get("accessLevel") == "public" and item.get("accessURL") is None and item.get("webService") is None:
-                add_error(errs, 20, "Where's the Dataset?", "A public dataset has neither an accessURL nor a webService.", dataset_name)
-
-            # the first entry should be an entry for the catalog itself
-            if i == 0 and item.get("accessURL") != src_url:
-                add_error(errs, 2, "File Format Issues", "The first entry in the data.json file should be for the data.json file itself. Its accessURL should match the URL \"%s\"." % src_url, dataset_name)
-
-            # format
-            if item.get("accessURL") is None:
-                if item.get("format") != None:
-                    add_error(errs, 50, "Invalid Field Value", "Datasets without an 'accessURL' should not have a 'format'.", dataset_name)
-            elif check_string_field(item, "format", -1, dataset_name, errs):
-                check_mime_type(item.get("format"), "format", dataset_name, errs)
-                            
-            # license
-            if item.get("license") is None:
-                add_error(errs, 75, "Check Required-If-Applicable Fields", "Add a 'license' field to datasets. This field is required-if-applicable.", dataset_name)
-            elif not isinstance(item.get("license"), (str, unicode)):
-                add_error(errs, 50, "Invalid Field Value (Optional Fields)", "The field 'license' must be a string value if specified.", dataset_name)
-            
-            # spatial
-            # TODO: There are more requirements than it be a string.
-            if item.get("spatial") is None:
-                add_error(errs, 75, "Check Required-If-Applicable Fields", "Add a 'spatial' field to datasets. This field is required if the dataset is spatial in nature.", dataset_name)
-            elif not isinstance(item.get("spatial"), (str, unicode)):
-                add_error(errs, 50, "Invalid Field Value (Optional Fields)", "The field 'spatial' must be a string value if specified.", dataset_name)
-                
-            # temporal
-            if item.get("temporal") is None:
-                add_error(errs, 75, "Check Required-If-Applicable Fields", "Add a 'temporal' field to datasets. This field is required if the dataset is temporal in nature.", dataset_name)
-            elif not isinstance(item["temporal"], (str, unicode)):
-                add_error(errs, 50, "Invalid Field Value (Optional Fields)", "The field 'temporal' must be a string value if specified.", dataset_name)
-            elif "/" not in item["temporal"]:
-                add_error(errs, 50, "Invalid Field Value (Optional Fields)", "The field 'temporal' must be two dates separated by a forward slash.", dataset_name)
-            else:
-                d1, d2 = item["temporal"].split("/", 1)
-                if not ISO8601_REGEX.match(d1):
-                    add_error(errs, 50, "Invalid Field Value (Optional Fields)", "The field 'temporal' has an invalid start date: %s." % d1, dataset_name)
-                if not ISO8601_REGEX.match(d2):
-                    add_error(errs, 50, "Invalid Field Value (Optional Fields)", "The field 'temporal' has an invalid end date: %s." % d2, dataset_name)
-            
-            # Expanded Fields
-            
-            # theme
-            if item.get("theme") is None:
-                add_error(errs, 90, "Add Suggested Fields to Improve Data Quality", "Add a 'theme' field to datasets.", dataset_name)
-            elif not isinstance(item["theme"], list):
-                add_error(errs, 50, "Invalid Field Value (Optional Fields)", "The field 'theme' must be an array.", dataset_name)
-            else:
-                for s in item["theme"]:
-                    if not isinstance(s, (str, unicode)):
-                        add_error(errs, 50, "Invalid Field Value (Optional Fields)", "Each value in the theme array must be a string", dataset_name)
-                    elif len(s.strip()) == 0:
-                        add_error(errs, 50, "Invalid Field Value (Optional Fields)", "A value in the theme array was an empty string.", dataset_name)
-            
-            # dataDictionary
-            if check_url_field(False, item, "dataDictionary", dataset_name, errs):
-                if item.get("dataDictionary") is None:
-                    add_error(errs, 120, "Add Other Optional Fields (Suggested)", "Add a 'dataDictionary' field to datasets.", dataset_name)
-            
-            # dataQuality
-            if item.get("dataQuality") is None:
-                add_error(errs, 120, "Add Other Optional Fields (Suggested)", "Add a 'dataQuality' field to datasets.", dataset_name)
-            elif not isinstance(item["dataQuality"], bool):
-                add_error(errs, 50, "Invalid Field Value (Optional Fields)", "The field 'theme' must be true or false, as a JSON boolean literal (not the string \"true\" or \"false\").", dataset_name)
-                
-            # distribution
-            if item.get("distribution") is None:
-                pass # not required, and missing just means there's only one access URL and it's in the accessURL field
-            elif not isinstance(item["distribution"], list):
-                add_error(errs, 50, "Invalid Field Value (Optional Fields)", "The field 'distribution' must be an array, if present.", dataset_name)
-            else:
-                if len(item["distribution"]) > 0 and item.get("accessURL") is None:
-                    add_error(errs, 10, "Missing Required Fields", "The 'accessURL' field is missing on a dataset with one or more distributions.", dataset_name)
-                    
-                for j, d in enumerate(item["distribution"]):
-                    resource_name = dataset_name + (" distribution %d" % (j+1))
-                    check_url_field(True, d, "distribution accessURL", resource_name, errs)
-                    if check_string_field(d, "format", 1, resource_name, errs):
-                        check_mime_type(d["format"], "distribution format", resource_name, errs)
-                
-            # accrualPeriodicity
-            if item.get("accrualPeriodicity") is None:
-                add_error(errs, 90, "Add Suggested Fields to Improve Data Quality", "Add a 'accrualPeriodicity' field to datasets.", dataset_name)
-            elif item.get("accrualPeriodicity") not in ACCRUAL_PERIODICITY_VALUES:
-                add_error(errs, 50, "Invalid Field Value (Optional Fields)", "The field 'accrualPeriodicity' had an invalid value.", dataset_name)
-            
-            # landingPage
-            if check_url_field(False, item, "landingPage", dataset_name, errs):
-                if item.get("landingPage") is None:
-                    add_error(errs, 90, "Add Suggested Fields to Improve Data Quality", "Add a 'landingPage' field to datasets.", dataset_name)
-            
-            # language
-            if item.get("language") is None:
-                add_error(errs, 120, "Add Other Optional Fields (Suggested)", "Add a 'language' field to datasets.", dataset_name)
-            elif not isinstance(item["language"], list):
-                add_error(errs, 50, "Invalid Field Value (Optional Fields)", "The field 'language' must be an array, if present.", dataset_name)
-            else:
-                for s in item["language"]:
-                    if not LANGUAGE_REGEX.match(s):
-                        add_error(errs, 50, "Invalid Field Value (Optional Fields)", "The field 'language' had an invalid language: \"%s\"" % s, dataset_name)
-                    
-            # PrimaryITInvestmentUII
-            if item.get("PrimaryITInvestmentUII") is None:
-                add_error(errs, 120, "Add Other Optional Fields (Suggested)", "Add a 'PrimaryITInvestmentUII' field to datasets.", dataset_name)
-            elif not isinstance(item["PrimaryITInvestmentUII"], (str, unicode)):
-                add_error(errs, 50, "Invalid Field Value (Optional Fields)", "The field 'PrimaryITInvestmentUII' must be a string, if present.", dataset_name)
-                
-            # references
-            if item.get("references") is None:
-                add_error(errs, 120, "Add Other Optional Fields (Suggested)", "Add a 'references' field to datasets.", dataset_name)
-            elif not isinstance(item["references"], list):
-                add_error(errs, 50, "Invalid Field Value (Optional Fields)", "The field 'references' must be an array, if present.", dataset_name)
+        validator = CatalogValidator(src_url)
+        validator.validate_items(doc)
+    errors_array.extend(validator.report(samples))
+
+# Validating in parallel: the catalog is split into chunks that are each
+# validated by a CatalogValidator in a worker process, starting from the
+# chunk's offset in the catalog. Apart from duplicate identifiers, which the
+# workers can only check within their own chunk, no check depends on the other
+# datasets, so the chunks' results are merged back together. Each sample
+# location carries its dataset's index in the catalog, so the merged samples
+# are the same first few that validating the catalog in one go would keep.
+PARALLEL_CHUNK_SIZE = 500
+
+def validate_chunk(args):
+    src_url, offset, items = args
+    validator = CatalogValidator(src_url, offset=offset)
+    for item in items:
+        validator.validate_item(item)
+    return validator
+
+def validate_parallel(doc, src_url, processes=None, chunk_size=PARALLEL_CHUNK_SIZE):
+    # Returns a CatalogValidator with the merged results.
+    get_omb_bureau_codes() # load once here rather than in each worker
+    chunks = ((src_url, i, doc[i:i+chunk_size]) for i in xrange(0, len(doc), chunk_size))
+    validator = CatalogValidator(src_url)
+    pool = multiprocessing.Pool(processes)
+    try:
+        for chunk_validator in pool.imap(validate_chunk, chunks):
+            validator.merge(chunk_validator)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    validator.finish()
+    return validator
+
+class NotAnArray(ValueError):
+    pass
+
+def iter_catalog_items(f):
+    # Yields the datasets in a data.json file one at a time as they are parsed
+    # (which requires ijson). Raises NotAnArray if the file isn't an array at
+    # its top level, and ijson's errors if it isn't valid JSON.
+    events = ijson.parse(f)
+    first = next(events, None)
+    if first is None or first[1] != "start_array":
+        raise NotAnArray()
+    for item in ijson.common.items(itertools.chain([first], events), "item"):
+        yield item
+
+def validate_stream(f, src_url, errors_array, progress=None, samples=False):
+    # Validates a data.json file as it is read from the file-like object f,
+    # appending the errors to errors_array exactly as do_validation would.
+    # Returns the number of datasets validated. If the file turns out not to be
+    # valid JSON part way through, the errors found up to that point are kept.
+    # progress is passed on to CatalogValidator.validate_items, and samples to
+    # do_validation.
+    validator = CatalogValidator(src_url)
+    try:
+        validator.validate_items(iter_catalog_items(f), progress=progress)
+    except NotAnArray:
+        validator.errs.add(0, "Bad JSON Structure", "The file must be an array at its top level. That means the file starts with an open bracket [ and ends with a close bracket ].")
+    except ijson.JSONError as e:
+        validator.errs.add(0, "Invalid JSON", "The file does not meet basic JSON syntax requirements: " + unicode(e) + ". Try using JSONLint.com.")
+    errors_array.extend(validator.report(samples))
+    return validator.count
+
+class CatalogValidator(object):
+    '''
+    Validates a catalog one dataset at a time, so that the datasets can come
+    from an incremental parser and never all be in memory at once. For each
+    error only a count and the first max_samples locations are kept, so memory
+    use doesn't grow with the size of the catalog either, except for
+    remembering the identifiers seen so far.
+    '''
+
+    def __init__(self, src_url, max_samples=10, offset=0):
+        # offset is the index in the catalog of the first dataset to be
+        # validated, when validating part of a catalog.
+        self.src_url = src_url
+        self.errs = ValidationErrors(max_samples)
+        self.seen_identifiers = { } # identifier => (index, name) of the first dataset with it
+        self.offset = offset
+        self.count = 0
+        self.bureau_codes = get_omb_bureau_codes() # the same list for the whole catalog, or None
+
+    def validate_items(self, items, progress=None, progress_interval=1000):
+        # Validates each dataset in an iterable. If given, progress is called
+        # with this object every progress_interval datasets, e.g. to show the
+        # report so far.
+        for item in items:
+            self.validate_item(item)
+            if progress and self.count % progress_interval == 0:
+                progress(self)
+        self.finish()
+
+    def validate_item(self, item):
+        self.index = self.offset + self.count
+        self.errs.start_item(self.index)
+        check_dataset(item, self)
+        self.count += 1
+
+    def merge(self, other):
+        # Adds in the results of another CatalogValidator that validated the
+        # datasets that come next in the catalog. Its datasets whose identifiers
+        # were seen before are duplicates it couldn't know about.
+        self.errs.merge(other.errs)
+        for identifier, (index, dataset_name) in sorted(other.seen_identifiers.iteritems(), key=lambda x : x[1]):
+            if identifier in self.seen_identifiers:
+                self.errs.start_item(index)
+                self.errs.add(5, "Invalid Required Field Value", DUPLICATE_IDENTIFIER_ERROR, dataset_name, (identifier,))
             else:
-                for s in item["references"]:
-                    if not URL_REGEX.match(s):
-                        add_error(errs, 50, "Invalid Field Value (Optional Fields)", "The field 'references' had an invalid URL: \"%s\"" % s, dataset_name)
-            
-            # issued
-            if item.get("issued") is None:
-                add_error(errs, 90, "Add Suggested Fields to Improve Data Quality", "Add a 'issued' field to datasets.", dataset_name)
+                self.seen_identifiers[identifier] = (index, dataset_name)
+        self.count += other.count
+
+    def finish(self):
+        # Called when there are no more datasets.
+        if self.count == 0:
+            self.errs.add(0, "Catalog Is Empty", "There are no entries in your file.")
+
+    def report(self, samples=False):
+        # Returns the errors found so far as a list of (heading, [description, ...])
+        # pairs in order of severity. It can be called at any time, including
+        # part way through a catalog. See ValidationErrors.report for samples.
+        return self.errs.report(samples)
+
+
+class ValidationErrors(object):
+    '''
+    The errors found in a catalog, grouped by (severity, heading) and then by
+    description, with where each was found (see ErrorLocations). A description
+    can be given as a format string and its arguments, in which case it isn't
+    formatted until the report is made, since most errors are found over and
+    over.
+    '''
+
+    def __init__(self, max_samples=10):
+        self.max_samples = max_samples
+        self.errors = { } # (severity, heading, description, args) => ErrorLocations
+        self.item_locations = set() # errors already counted for the current item
+        self.index = 0 # the current item's index in the catalog
+
+    def start_item(self, index):
+        self.index = index
+        self.item_locations.clear()
+
+    def add(self, severity, heading, description, context=None, args=None):
+        key = (severity, heading, description, args)
+        locations = self.errors.get(key)
+        if locations is None:
+            locations = self.errors[key] = ErrorLocations(self.max_samples)
+        if context and (key, context) not in self.item_locations:
+            self.item_locations.add((key, context))
+            locations.add(context, self.index)
+
+    def merge(self, other):
+        # Adds in the errors in another ValidationErrors.
+        for key, locations in other.errors.iteritems():
+            if key in self.errors:
+                self.errors[key].merge(locations)
             else:
-                check_date_field(item, "issued", dataset_name, errs)
-            
-            # systemOfRecords
-            # TODO: No details in the schema!
-    
-    # Form the output data.
-    for err_type in sorted(errs):
-        errors_array.append( (
+                self.errors[key] = locations
+
+    def report(self, samples=False):
+        # With samples, each description is followed by the first few places
+        # the error was found.
+        errs = { }
+        for (severity, heading, description, args), locations in self.errors.iteritems():
+            if args is not None:
+                description = description % args
+            formatted = errs.setdefault((severity, heading), { })
+            if description in formatted:
+                # the same message from a different format string
+                combined = ErrorLocations(self.max_samples)
+                combined.merge(formatted[description])
+                combined.merge(locations)
+                locations = combined
+            formatted[description] = locations
+        def describe(description, locations):
+            if locations.count:
+                description += " (%d locations)" % locations.count
+            if samples and locations.samples:
+                description += ", e.g. " + ", ".join(locations.samples)
+            return description
+        return [ (
             err_type[1], # heading
-            [ err_item + (" (%d locations)" % len(errs[err_type][err_item]) if len(errs[err_type][err_item]) else "")
-              for err_item in sorted(errs[err_type], key=lambda x:(-len(errs[err_type][x]), x))
-            ]) )
-    
-def add_error(errs, severity, heading, description, context=None):
-    s = errs.setdefault((severity, heading), { }).setdefault(description, set())
-    if context: s.add(context)
+            [ describe(err_item, errs[err_type][err_item])
+              for err_item in sorted(errs[err_type], key=lambda x:(-errs[err_type][x].count, x))
+            ])
+            for err_type in sorted(errs) ]
+
+class ErrorLocations(object):
+    '''
+    Where an error was found: the number of locations (a location is a
+    dataset, or one of its distributions, counted once each) and the names of
+    the first max_samples in catalog order, whatever order they were added in.
+    '''
+
+    def __init__(self, max_samples=10):
+        self.max_samples = max_samples
+        self.samples = []
+        self.indexes = [] # the catalog index of the dataset of each sample
+        self.count = 0
+
+    def add(self, context, index):
+        self.count += 1
+        self.add_sample(context, index)
+
+    def add_sample(self, context, index):
+        if len(self.samples) >= self.max_samples and (not self.indexes or index >= self.indexes[-1]):
+            return
+        # After any samples from the same dataset, which were found first.
+        i = bisect.bisect_right(self.indexes, index)
+        self.samples.insert(i, context)
+        self.indexes.insert(i, index)
+        del self.samples[self.max_samples:]
+        del self.indexes[self.max_samples:]
+
+    def merge(self, other):
+        self.count += other.count
+        for context, index in zip(other.samples, other.indexes):
+            self.add_sample(context, index)
 
 def nice_type_name(data_type):
     if data_type == (str, unicode) or data_type in (str, unicode):
@@ -281,67 +356,422 @@ def nice_type_name(data_type):
     else:
         return "a " + str(data_type)
 
-def check_required_field(obj, field_name, data_type, dataset_name, errs, display_field_name=None):
-    # checks that a field exists and has the right type
-    if not display_field_name: display_field_name = field_name
-    if field_name not in obj:
-        add_error(errs, 10, "Missing Required Fields", "The '%s' field is missing." % display_field_name, dataset_name)
-        return False
-    elif obj[field_name] is None:
-        add_error(errs, 10, "Missing Required Fields", "The '%s' field is set to null." % display_field_name, dataset_name)
-        return False
-    elif not isinstance(obj[field_name], data_type):
-        add_error(errs, 5, "Invalid Required Field Value", "The '%s' field must be %s but it is %s." % (display_field_name, nice_type_name(data_type), nice_type_name(type(obj[field_name]))), dataset_name)
-        return False
-    elif isinstance(obj[field_name], list) and len(obj[field_name]) == 0:
-        add_error(errs, 10, "Missing Required Fields", "The '%s' field is an empty array." % display_field_name, dataset_name)
-        return False
-    return True
-
-def check_string_field(obj, field_name, min_length, dataset_name, errs):
-    # checks that a required field exists, is typed as a string, and has a minimum length
-    if not check_required_field(obj, field_name, (str, unicode), dataset_name, errs):
-        return False
-    elif len(obj[field_name].strip()) == 0:
-        add_error(errs, 10, "Missing Required Fields", "The '%s' field is present but empty." % field_name, dataset_name)
-        return False
-    elif len(obj[field_name].strip()) <= min_length:
-        add_error(errs, 100, "Are These Okay?", "The '%s' field is very short: \"%s\"" % (field_name, obj[field_name]), dataset_name)
-        return False
-    return True
-    
-def check_date_field(obj, field_name, dataset_name, errs):
-    # checks that a required date field exists and looks like a date
-    if not check_required_field(obj, field_name, (str, unicode), dataset_name, errs):
-        return False
-    elif len(obj[field_name].strip()) == 0:
-        add_error(errs, 10, "Missing Required Fields", "The '%s' field is present but empty." % field_name, dataset_name)
-        return False
-    else:
-        if not ISO8601_REGEX.match(obj[field_name]):
-            add_error(errs, 5, "Invalid Required Field Value", "The '%s' field has an invalid ISO 8601 date or date-time value: \"%s\"." % (field_name, obj[field_name]), dataset_name)
+# Validation rules
+#
+# The POD schema is described by the tables of rules at the end, which are
+# compiled once into a function that checks a dataset. Each rule is a (kind,
+# field, options) tuple, where the kind picks the compiler below and the
+# options are its keyword arguments. Every rule can also take a "when" option,
+# a function of the dataset that says whether the rule applies to it.
+#
+# A compiled rule is a function check(obj, name, add, ctx) that looks up its
+# field once, reports problems by calling add (ValidationErrors.add) with a
+# format string and arguments, and returns whether the field passed, i.e. is
+# present and valid, or is optional and absent. ctx is the CatalogValidator,
+# for the rules that depend on the rest of the catalog.
+#
+# Options named "then" are checks applied to the field's value once it has
+# passed, as functions check(value, obj, name, add, ctx) or (kind, args...)
+# tuples compiled by the value check compilers. "each" is the same but for the
+# elements of an array, with the element check compilers.
+
+MISSING = object()
+STRING_TYPES = (str, unicode)
+
+DUPLICATE_IDENTIFIER_ERROR = "The dataset identifier \"%s\" is used more than once."
+
+def compile_rules(rules):
+    checks = [compile_rule(rule) for rule in rules]
+    def check_all(obj, name, add, ctx):
+        for check in checks:
+            check(obj, name, add, ctx)
+    return check_all
+
+def compile_rule(rule):
+    kind, field, options = rule
+    options = dict(options)
+    when = options.pop("when", None)
+    check = RULE_COMPILERS[kind](field, **options)
+    if when is None:
+        return check
+    def check_when(obj, name, add, ctx):
+        if not when(obj): return False
+        return check(obj, name, add, ctx)
+    return check_when
+
+def compile_checks(specs, compilers):
+    return [spec if callable(spec) else compilers[spec[0]](*spec[1:]) for spec in specs]
+
+def compile_type_check(field, data_type, display_field_name):
+    # Returns a function that takes a required field's value (MISSING if it's
+    # not there) and returns it, or MISSING after reporting why it's missing or
+    # has the wrong type. The rules skip calling it when the value has exactly
+    # the right type.
+    expected_type_name = nice_type_name(data_type)
+    def check_type(v, name, add):
+        if v is MISSING:
+            add(10, "Missing Required Fields", "The '%s' field is missing.", name, (display_field_name,))
+        elif v is None:
+            add(10, "Missing Required Fields", "The '%s' field is set to null.", name, (display_field_name,))
+        elif not isinstance(v, data_type):
+            add(5, "Invalid Required Field Value", "The '%s' field must be %s but it is %s.", name, (display_field_name, expected_type_name, nice_type_name(type(v))))
+        elif isinstance(v, list) and len(v) == 0:
+            add(10, "Missing Required Fields", "The '%s' field is an empty array.", name, (display_field_name,))
+        else:
+            return v
+        return MISSING
+    return check_type
+
+def compile_string_rule(field, min_length, then=()):
+    # A required string with more than min_length characters.
+    check_type = compile_type_check(field, STRING_TYPES, field)
+    then = compile_checks(then, VALUE_CHECK_COMPILERS)
+    def check(obj, name, add, ctx):
+        v = obj.get(field, MISSING)
+        if v.__class__ is not unicode and v.__class__ is not str:
+            v = check_type(v, name, add)
+            if v is MISSING: return False
+        length = len(v.strip())
+        if length == 0:
+            add(10, "Missing Required Fields", "The '%s' field is present but empty.", name, (field,))
             return False
-    return True
-    
-def check_url_field(required, obj, field_name, dataset_name, errs):
-    # checks that a required or optional field, if specified, looks like a URL
-    
-    display_field_name = field_name
-    field_name = field_name.split(" ")[-1] # turn 'distribution accessURL' into 'accessURL', leave other field names unchanged
-    
-    if not required and (field_name not in obj or obj[field_name] is None): return True # not required, so OK
-    if not check_required_field(obj, field_name, (str, unicode), dataset_name, errs, display_field_name=display_field_name): return False # for a non-required field, just checking data type
-    if not URL_REGEX.match(obj[field_name]):
-        add_error(errs, 5, "Invalid Required Field Value", "The '%s' field has an invalid URL: \"%s\"." % (display_field_name, obj[field_name]), dataset_name)
-        return False
-    return True
-
-def check_mime_type(format, field_name, dataset_name, errs):
-    if format.lower() in ("csv", "xls", "xml", "rdf", "json", "xlsx", "text", "api", "feed"):
-        add_error(errs, 5, "Update Your File!", "The '%s' field used to be a file extension but now it must be a MIME type." % field_name, dataset_name)
-    elif not MIMETYPE_REGEX.match(format):
-        add_error(errs, 5, "Invalid Required Field Value", "The '%s' field has an invalid MIME type: \"%s\"." % (field_name, format), dataset_name)
-    elif format.split(";")[0] not in COMMON_MIMETYPES:
-        # if there's an optional parameter like "; charset=UTF-8" chop it off before checking the COMMON_MIMETYPES list
-        add_error(errs, 100, "Are These Okay?", "The '%s' field has an unusual MIME type: \"%s\"" % (field_name, format), dataset_name)
-        
+        if length <= min_length:
+            add(100, "Are These Okay?", "The '%s' field is very short: \"%s\"", name, (field, v))
+            return False
+        if then:
+            for c in then:
+                c(v, obj, name, add, ctx)
+        return True
+    return check
+
+def compile_date_rule(field, suggest=None):
+    # A required ISO 8601 date, or with "suggest", an optional one whose absence
+    # is reported as the given (severity, heading, description).
+    check_type = compile_type_check(field, STRING_TYPES, field)
+    def check(obj, name, add, ctx):
+        v = obj.get(field, MISSING)
+        if v.__class__ is not unicode and v.__class__ is not str:
+            if suggest and (v is MISSING or v is None):
+                add(suggest[0], suggest[1], suggest[2], name)
+                return False
+            v = check_type(v, name, add)
+            if v is MISSING: return False
+        if len(v.strip()) == 0:
+            add(10, "Missing Required Fields", "The '%s' field is present but empty.", name, (field,))
+            return False
+        if not is_iso8601(v):
+            add(5, "Invalid Required Field Value", "The '%s' field has an invalid ISO 8601 date or date-time value: \"%s\".", name, (field, v))
+            return False
+        return True
+    return check
+
+def compile_url_rule(field, required=False, display_field_name=None, suggest=None, then=()):
+    # A URL. An optional one passes when it's absent, after reporting "suggest"
+    # if given.
+    display_field_name = display_field_name or field
+    check_type = compile_type_check(field, STRING_TYPES, display_field_name)
+    then = compile_checks(then, VALUE_CHECK_COMPILERS)
+    def check(obj, name, add, ctx):
+        v = obj.get(field, MISSING)
+        if v.__class__ is not unicode and v.__class__ is not str:
+            if not required and (v is MISSING or v is None):
+                if suggest: add(suggest[0], suggest[1], suggest[2], name)
+                return True
+            v = check_type(v, name, add)
+            if v is MISSING: return False
+        if not is_url(v):
+            add(5, "Invalid Required Field Value", "The '%s' field has an invalid URL: \"%s\".", name, (display_field_name, v))
+            return False
+        if then:
+            for c in then:
+                c(v, obj, name, add, ctx)
+        return True
+    return check
+
+def compile_list_rule(field, each=(), if_string=None):
+    # A required non-empty array. If the field is a string and "if_string" is
+    # given, that error is reported instead.
+    check_type = compile_type_check(field, list, field)
+    each = compile_checks(each, ELEMENT_CHECK_COMPILERS)
+    def check(obj, name, add, ctx):
+        v = obj.get(field, MISSING)
+        if v.__class__ is not list or len(v) == 0:
+            if if_string and isinstance(v, STRING_TYPES):
+                add(if_string[0], if_string[1], if_string[2], name)
+                return False
+            v = check_type(v, name, add)
+            if v is MISSING: return False
+        for c in each:
+            c(v, obj, name, add, ctx)
+        return True
+    return check
+
+def compile_optional_rule(field, data_type=None, suggest=None, type_error=None, each=(), then=()):
+    # An optional field. If it's absent, "suggest" is reported if given. If it
+    # isn't of data_type, type_error is reported as an invalid optional field.
+    then = compile_checks(each, ELEMENT_CHECK_COMPILERS) + compile_checks(then, VALUE_CHECK_COMPILERS)
+    def check(obj, name, add, ctx):
+        v = obj.get(field)
+        if v is None:
+            if suggest: add(suggest[0], suggest[1], suggest[2], name)
+            return True
+        if data_type is not None and not isinstance(v, data_type):
+            add(50, "Invalid Field Value (Optional Fields)", type_error, name)
+            return False
+        if then:
+            for c in then:
+                c(v, obj, name, add, ctx)
+        return True
+    return check
+
+def compile_custom_rule(field, check):
+    # A rule written out as a function check(obj, name, add, ctx).
+    return check
+
+RULE_COMPILERS = {
+    "string": compile_string_rule,
+    "date": compile_date_rule,
+    "url": compile_url_rule,
+    "list": compile_list_rule,
+    "optional": compile_optional_rule,
+    "custom": compile_custom_rule,
+}
+
+# value checks
+
+def compile_enum_check(values, error):
+    # Reports error, with the value if the description has a %s, if the value
+    # isn't one of the values.
+    values = frozenset(values)
+    severity, heading, description = error
+    args = (lambda v : (v,)) if "%s" in description else (lambda v : None)
+    def check(v, obj, name, add, ctx):
+        try:
+            ok = v in values
+        except TypeError: # unhashable
+            ok = False
+        if not ok:
+            add(severity, heading, description, name, args(v))
+    return check
+
+def compile_mime_type_check(display_field_name):
+    file_extensions = frozenset(("csv", "xls", "xml", "rdf", "json", "xlsx", "text", "api", "feed"))
+    common_mimetypes = frozenset(COMMON_MIMETYPES)
+    def check(format, obj, name, add, ctx):
+        if format.lower() in file_extensions:
+            add(5, "Update Your File!", "The '%s' field used to be a file extension but now it must be a MIME type.", name, (display_field_name,))
+        elif not MIMETYPE_REGEX.match(format):
+            add(5, "Invalid Required Field Value", "The '%s' field has an invalid MIME type: \"%s\".", name, (display_field_name, format))
+        elif format.split(";")[0] not in common_mimetypes:
+            # if there's an optional parameter like "; charset=UTF-8" chop it off before checking the COMMON_MIMETYPES list
+            add(100, "Are These Okay?", "The '%s' field has an unusual MIME type: \"%s\"", name, (display_field_name, format))
+    return check
+
+def compile_email_check():
+    def check(v, obj, name, add, ctx):
+        if not is_email(v):
+            add(5, "Invalid Required Field Value", "The email address \"%s\" is not a valid email address.", name, (v,))
+    return check
+
+VALUE_CHECK_COMPILERS = {
+    "enum": compile_enum_check,
+    "mime_type": compile_mime_type_check,
+    "email": compile_email_check,
+}
+
+# element checks
+
+def compile_strings_check(severity, heading, not_a_string, empty):
+    # Each element must be a non-empty string.
+    def check(values, obj, name, add, ctx):
+        for s in values:
+            if not isinstance(s, STRING_TYPES):
+                add(severity, heading, not_a_string, name)
+            elif len(s.strip()) == 0:
+                add(severity, heading, empty, name)
+    return check
+
+def compile_test_check(test, severity, heading, description):
+    # Each element must pass the test, e.g. a regex's match method. The
+    # description gets the element.
+    def check(values, obj, name, add, ctx):
+        for s in values:
+            if not test(s):
+                add(severity, heading, description, name, (s,))
+    return check
+
+ELEMENT_CHECK_COMPILERS = {
+    "strings": compile_strings_check,
+    "test": compile_test_check,
+}
+
+# rules that don't fit the patterns above
+
+def check_bureau_codes(values, obj, name, add, ctx):
+    for bc in values:
+        if not isinstance(bc, STRING_TYPES):
+            add(5, "Invalid Required Field Value", "Each bureauCode must be a string", name)
+        elif ":" not in bc:
+            add(5, "Invalid Required Field Value", "The bureau code \"%s\" is invalid. Start with the agency code, then a colon, then the bureau code.", name, (bc,))
+        elif ctx.bureau_codes is None:
+            add(100, "Bureau Codes Not Checked", "OMB's list of bureau codes could not be loaded, so bureau codes were not checked against it. Try again later.")
+        elif bc not in ctx.bureau_codes:
+            add(5, "Invalid Required Field Value", "The bureau code \"%s\" was not found in our list.", name, (bc,))
+
+def check_unique_identifier(identifier, obj, name, add, ctx):
+    if identifier in ctx.seen_identifiers:
+        add(5, "Invalid Required Field Value", DUPLICATE_IDENTIFIER_ERROR, name, (identifier,))
+    else:
+        ctx.seen_identifiers[identifier] = (ctx.index, name)
+
+def check_access_level(access_level, obj, name, add, ctx):
+    if access_level not in ("public", "restricted public", "non-public"):
+        add(5, "Invalid Required Field Value", "The field 'accessLevel' had an invalid value: \"%s\"", name, (access_level,))
+    elif access_level == "non-public":
+        add(1, "Possible Private Data Leakage", "A dataset appears with accessLevel set to \"non-public\".", name)
+
+def check_access_url_in_distribution(access_url, obj, name, add, ctx):
+    # If accessURL and distribution are both given, the accessURL must be one of the distributions.
+    distribution = obj.get("distribution")
+    if isinstance(distribution, list):
+        for d in distribution:
+            if d.get("accessURL") == access_url:
+                break # found
+        else: # not found
+            add(20, "Where's the Dataset?", "If a top-level 'accessURL' and 'distribution' are both present, the accessURL must be one of the distributions.", name)
+
+def check_public_data_location(obj, name, add, ctx):
+    if obj.get("accessLevel") == "public" and obj.get("accessURL") is None and obj.get("webService") is None:
+        add(20, "Where's the Dataset?", "A public dataset has neither an accessURL nor a webService.", name)
+
+def check_catalog_entry(obj, name, add, ctx):
+    # the first entry should be an entry for the catalog itself
+    if ctx.index == 0 and obj.get("accessURL") != ctx.src_url:
+        add(2, "File Format Issues", "The first entry in the data.json file should be for the data.json file itself. Its accessURL should match the URL \"%s\".", name, (ctx.src_url,))
+
+def check_format_without_access_url(obj, name, add, ctx):
+    if obj.get("accessURL") is None and obj.get("format") != None:
+        add(50, "Invalid Field Value", "Datasets without an 'accessURL' should not have a 'format'.", name)
+
+def check_temporal(temporal, obj, name, add, ctx):
+    if "/" not in temporal:
+        add(50, "Invalid Field Value (Optional Fields)", "The field 'temporal' must be two dates separated by a forward slash.", name)
+    else:
+        d1, d2 = temporal.split("/", 1)
+        if not is_iso8601(d1):
+            add(50, "Invalid Field Value (Optional Fields)", "The field 'temporal' has an invalid start date: %s.", name, (d1,))
+        if not is_iso8601(d2):
+            add(50, "Invalid Field Value (Optional Fields)", "The field 'temporal' has an invalid end date: %s.", name, (d2,))
+
+def check_distributions(distribution, obj, name, add, ctx):
+    if len(distribution) > 0 and obj.get("accessURL") is None:
+        add(10, "Missing Required Fields", "The 'accessURL' field is missing on a dataset with one or more distributions.", name)
+    for j, d in enumerate(distribution):
+        if not isinstance(d, dict):
+            # look the fields up the way the rules did when they were written out
+            d = dict((k, d[k]) for k in ("accessURL", "format") if k in d)
+        check_distribution(d, name + (" distribution %d" % (j+1)), add, ctx)
+
+# the POD schema
+
+DATASET_RULES = [
+    # Required
+
+    # (title is checked first in check_dataset since it names the dataset in the other errors)
+    ("string", "description", { "min_length": 30 }),
+    ("list", "keyword", {
+        "if_string": (5, "Update Your File!", "The 'keyword' field used to be a string but now it must be an array."),
+        "each": [("strings", 5, "Invalid Required Field Value", "Each keyword in the keyword array must be a string", "A keyword in the keyword array was an empty string.")] }),
+    ("list", "bureauCode", {
+        "when": lambda item : item.get("_is_federal_dataset", True) == True, # skip if this is known to not be a federal dataset
+        "each": [check_bureau_codes] }),
+    ("date", "modified", { }),
+    ("string", "publisher", { "min_length": 1 }),
+    ("string", "contactPoint", { "min_length": 3 }),
+    ("string", "mbox", { "min_length": 3, "then": [("email",)] }),
+    ("string", "identifier", { "min_length": 1, "then": [check_unique_identifier] }),
+    ("list", "programCode", {
+        "when": lambda item : isinstance(item.get("bureauCode"), list), # don't bother reporting a missing programCode if no bureauCode is set
+        "each": [("strings", 5, "Invalid Required Field Value", "Each value in the programCode array must be a string", "A value in the programCode array was an empty string.")] }),
+    ("string", "accessLevel", { "min_length": 0, "then": [check_access_level] }),
+
+    # Required-If-Applicable
+
+    ("string", "accessLevelComment", { "min_length": 10, "when": lambda item : item.get("accessLevel") != "public" }),
+    ("url", "accessURL", { "then": [check_access_url_in_distribution] }),
+    ("url", "webService", { }),
+    ("custom", "accessURL", { "check": check_public_data_location }),
+    ("custom", "accessURL", { "check": check_catalog_entry }),
+    ("custom", "format", { "check": check_format_without_access_url }),
+    ("string", "format", { "min_length": -1, "then": [("mime_type", "format")], "when": lambda item : item.get("accessURL") is not None }),
+    ("optional", "license", { "data_type": STRING_TYPES,
+        "suggest": (75, "Check Required-If-Applicable Fields", "Add a 'license' field to datasets. This field is required-if-applicable."),
+        "type_error": "The field 'license' must be a string value if specified." }),
+    # TODO: There are more requirements than it be a string.
+    ("optional", "spatial", { "data_type": STRING_TYPES,
+        "suggest": (75, "Check Required-If-Applicable Fields", "Add a 'spatial' field to datasets. This field is required if the dataset is spatial in nature."),
+        "type_error": "The field 'spatial' must be a string value if specified." }),
+    ("optional", "temporal", { "data_type": STRING_TYPES,
+        "suggest": (75, "Check Required-If-Applicable Fields", "Add a 'temporal' field to datasets. This field is required if the dataset is temporal in nature."),
+        "type_error": "The field 'temporal' must be a string value if specified.",
+        "then": [check_temporal] }),
+
+    # Expanded Fields
+
+    ("optional", "theme", { "data_type": list,
+        "suggest": (90, "Add Suggested Fields to Improve Data Quality", "Add a 'theme' field to datasets."),
+        "type_error": "The field 'theme' must be an array.",
+        "each": [("strings", 50, "Invalid Field Value (Optional Fields)", "Each value in the theme array must be a string", "A value in the theme array was an empty string.")] }),
+    ("url", "dataDictionary", { "suggest": (120, "Add Other Optional Fields (Suggested)", "Add a 'dataDictionary' field to datasets.") }),
+    ("optional", "dataQuality", { "data_type": bool,
+        "suggest": (120, "Add Other Optional Fields (Suggested)", "Add a 'dataQuality' field to datasets."),
+        "type_error": "The field 'theme' must be true or false, as a JSON boolean literal (not the string \"true\" or \"false\")." }),
+    # (distribution is not required, and missing just means there's only one access URL and it's in the accessURL field)
+    ("optional", "distribution", { "data_type": list,
+        "type_error": "The field 'distribution' must be an array, if present.",
+        "then": [check_distributions] }),
+    ("optional", "accrualPeriodicity", {
+        "suggest": (90, "Add Suggested Fields to Improve Data Quality", "Add a 'accrualPeriodicity' field to datasets."),
+        "then": [("enum", ACCRUAL_PERIODICITY_VALUES, (50, "Invalid Field Value (Optional Fields)", "The field 'accrualPeriodicity' had an invalid value."))] }),
+    ("url", "landingPage", { "suggest": (90, "Add Suggested Fields to Improve Data Quality", "Add a 'landingPage' field to datasets.") }),
+    ("optional", "language", { "data_type": list,
+        "suggest": (120, "Add Other Optional Fields (Suggested)", "Add a 'language' field to datasets."),
+        "type_error": "The field 'language' must be an array, if present.",
+        "each": [("test", LANGUAGE_REGEX.match, 50, "Invalid Field Value (Optional Fields)", "The field 'language' had an invalid language: \"%s\"")] }),
+    ("optional", "PrimaryITInvestmentUII", { "data_type": STRING_TYPES,
+        "suggest": (120, "Add Other Optional Fields (Suggested)", "Add a 'PrimaryITInvestmentUII' field to datasets."),
+        "type_error": "The field 'PrimaryITInvestmentUII' must be a string, if present." }),
+    ("optional", "references", { "data_type": list,
+        "suggest": (120, "Add Other Optional Fields (Suggested)", "Add a 'references' field to datasets."),
+        "type_error": "The field 'references' must be an array, if present.",
+        "each": [("test", is_url, 50, "Invalid Field Value (Optional Fields)", "The field 'references' had an invalid URL: \"%s\"")] }),
+    ("date", "issued", { "suggest": (90, "Add Suggested Fields to Improve Data Quality", "Add a 'issued' field to datasets.") }),
+    # TODO: systemOfRecords: No details in the schema!
+]
+
+DISTRIBUTION_RULES = [
+    ("url", "accessURL", { "required": True, "display_field_name": "distribution accessURL" }),
+    ("string", "format", { "min_length": 1, "then": [("mime_type", "distribution format")] }),
+]
+
+check_title = compile_string_rule("title", 5)
+check_dataset_fields = compile_rules(DATASET_RULES)
+check_distribution = compile_rules(DISTRIBUTION_RULES)
+
+def check_dataset(item, ctx):
+    # Validates a dataset, the ctx.index'th (from zero) in the catalog.
+    add = ctx.errs.add
+
+    dataset_name = "dataset %d" % (ctx.index+1)
+    if check_title(item, dataset_name, add, ctx):
+        dataset_name = '"%s"' % item.get("title", "").strip()
+
+    # No fields should be null or an empty list, according to GSA. After this point we treat nulls as if they were
+    # not present. This check must be after dataset_name is set above.
+    for k, v in item.iteritems():
+        if v is None:
+            add(2, "File Format Issues", "The '%s' field is set to 'null'. If there is no value, the field must not be present.", dataset_name, (k,))
+        elif isinstance(v, list) and len(v) == 0:
+            add(2, "File Format Issues", "The '%s' field is an empty list. If there is no value, the field must not be present.", dataset_name, (k,))
+
+    check_dataset_fields(item, dataset_name, add, ctx)
@@ -28,5 +28,8 @@ setup(
 	datajson=ckanext.datajson:DataJsonPlugin
 	datajson_harvest=ckanext.datajson:DataJsonHarvester
 	cmsdatanav_harvest=ckanext.datajson:CmsDataNavigatorHarvester
+
+	[paste.paster_command]
+	datajson=ckanext.datajson.commands:DataJsonCommand
 	""",
 )
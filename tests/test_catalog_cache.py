@@ -0,0 +1,72 @@
+# Tests of how the catalog cache gets filled. These need CKAN's test database,
+# so run them from the CKAN virtualenv with CKAN's test configuration:
+#
+#    nosetests --ckan --with-pylons=../ckan/test-core.ini tests/
+
+from ckan import model
+
+from ckanext.datajson import catalog_cache
+
+class Plugin(object):
+    # The settings that catalog_cache and make_datajson_entry read.
+    page_size = 2
+    default_keywords = None
+    default_mbox = None
+    default_contactpoint = None
+
+def create_package(name):
+    model.repo.new_revision()
+    model.Session.add(model.Package(name=name, title=name.title(), type="dataset"))
+    model.repo.commit_and_remove()
+    return model.Package.by_name(name).id
+
+def catalog_titles():
+    return sorted(entry["title"] for entry in catalog_cache.iter_catalog(Plugin))
+
+class TestCatalogCache(object):
+    def setup(self):
+        model.repo.rebuild_db()
+        catalog_cache.setup()
+
+    def teardown(self):
+        model.Session.remove()
+
+    def test_unfilled_cache_is_not_used(self):
+        for name in ("one", "two", "three"):
+            create_package(name)
+        assert not catalog_cache.is_usable()
+        assert catalog_cache.refresh_stale_entries(Plugin, add_missing=True) == 3
+        assert catalog_cache.is_usable()
+        assert catalog_titles() == ["One", "Three", "Two"]
+
+    def test_package_changed_before_cache_filled(self):
+        # A package saved after the cache was turned on but before it was
+        # filled gets a row, so the table isn't empty, but the cache still
+        # hasn't been filled.
+        for name in ("one", "two", "three"):
+            create_package(name)
+        catalog_cache.invalidate_entry(model.Package.by_name("two").id)
+        model.Session.commit()
+        assert not catalog_cache.is_usable()
+        assert catalog_cache.refresh_stale_entries(Plugin, add_missing=True) == 3
+        assert catalog_titles() == ["One", "Three", "Two"]
+
+    def test_filled_cache_is_not_filled_again(self):
+        create_package("one")
+        catalog_cache.refresh_stale_entries(Plugin, add_missing=True)
+        assert catalog_titles() == ["One"]
+
+        # A package with no row is left for the refresh-cache command once the
+        # cache has been filled.
+        catalog_cache.remove_entry(model.Package.by_name("one").id)
+        model.Session.commit()
+        assert catalog_titles() == []
+        assert catalog_cache.refresh_stale_entries(Plugin, add_missing=True) == 1
+        assert catalog_titles() == ["One"]
+
+    def test_missing_table_is_created(self):
+        catalog_cache.catalog_entry_table.drop()
+        catalog_cache.table_ready = False
+        assert catalog_cache.ensure_table()
+        assert catalog_cache.catalog_entry_table.exists()
+        assert not catalog_cache.is_usable()
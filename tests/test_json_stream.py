@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Tests that the incremental JSON output joins up to exactly what json.dumps
+# gives for the whole structure, which is what the catalog endpoints used to
+# send, indented or compact. Run from the CKAN virtualenv:
+#
+#    nosetests tests/
+
+import json, random
+
+try:
+    from collections import OrderedDict # 2.7
+except ImportError:
+    from sqlalchemy.util import OrderedDict
+
+from ckanext.datajson.json_stream import iter_json_array, iter_json_object
+
+FORMATS = [
+    dict(indent=2),
+    dict(indent=4),
+    dict(indent=None),
+    dict(indent=None, separators=(',', ':')), # compact
+]
+
+def random_value(rnd, depth=0):
+    kind = rnd.randint(0, 3) if depth < 3 else 0
+    if kind == 0:
+        return rnd.choice([1, 2.5, -7, None, True, False, u"x\nyé\"", "", "s"])
+    if kind == 1:
+        return [random_value(rnd, depth+1) for i in range(rnd.randint(0, 3))]
+    return OrderedDict(("k%d" % i, random_value(rnd, depth+1)) for i in range(rnd.randint(0, 3)))
+
+def random_items(rnd):
+    return [random_value(rnd) for i in range(rnd.randint(0, 4))]
+
+def test_array():
+    rnd = random.Random(1)
+    for fmt in FORMATS:
+        for n in range(200):
+            items = random_items(rnd)
+            assert "".join(iter_json_array(iter(items), **fmt)) == json.dumps(items, **fmt), (fmt, items)
+
+def test_object():
+    rnd = random.Random(2)
+    for fmt in FORMATS:
+        for n in range(200):
+            header = OrderedDict(("h%d" % i, random_value(rnd)) for i in range(rnd.randint(0, 3)))
+            items = random_items(rnd)
+            whole = OrderedDict(header)
+            whole["dcat:dataset"] = items
+            assert "".join(iter_json_object(header, "dcat:dataset", iter(items), **fmt)) == json.dumps(whole, **fmt), (fmt, header, items)
+
+def test_catalog():
+    # The shape of a real /data.json and /data.jsonld.
+    entries = [
+        OrderedDict([("title", u"Hospital Admissions — 2013"), ("keyword", ["health", "hospitals"]),
+            ("distribution", [OrderedDict([("accessURL", "http://www.example.gov/a.csv"), ("format", "text/csv")])])]),
+        OrderedDict([("title", "Empty"), ("keyword", []), ("distribution", { })]),
+    ]
+    header = OrderedDict([("@context", OrderedDict([("dcat", "http://www.w3.org/ns/dcat#")])), ("@id", "http://www.example.gov/data.jsonld")])
+    whole = OrderedDict(header)
+    whole["dcat:dataset"] = entries
+    for fmt in FORMATS:
+        assert "".join(iter_json_array(iter(entries), **fmt)) == json.dumps(entries, **fmt)
+        assert "".join(iter_json_object(header, "dcat:dataset", iter(entries), **fmt)) == json.dumps(whole, **fmt)
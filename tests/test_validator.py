@@ -0,0 +1,84 @@
+# Regression tests for the data.json validator: a fixture catalog with a bit
+# of every kind of problem must produce the report in fixtures/catalog-errors.json,
+# which was made with the validator as it was before the rules were rewritten
+# as tables, except that each dataset now counts as a location of its own even
+# when it has the same title as another. Each way of validating a catalog (all
+# at once, in parallel chunks, and as a stream) must give that same report. Run
+# from the CKAN virtualenv:
+#
+#    nosetests tests/
+
+import os, json, StringIO, unittest
+
+from ckanext.datajson import validator
+
+SRC_URL = "http://www.example.gov/data.json"
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+# The report depends on the OMB bureau code list, so use a fixed one rather
+# than whatever is downloaded.
+BUREAU_CODES = frozenset(["009:38", "010:00"])
+
+def setup_module():
+    global saved_bureau_codes
+    saved_bureau_codes = validator.omb_burueau_codes
+    validator.omb_burueau_codes = BUREAU_CODES
+
+def teardown_module():
+    validator.omb_burueau_codes = saved_bureau_codes
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name)) as f:
+        return f.read()
+
+def expected_report():
+    return [ (heading, descriptions) for heading, descriptions in json.loads(load_fixture("catalog-errors.json")) ]
+
+def test_do_validation():
+    errors = []
+    validator.do_validation(json.loads(load_fixture("catalog.json")), SRC_URL, errors)
+    assert errors == expected_report(), errors
+
+def test_parallel():
+    # Chunks small enough that the duplicate identifiers are in different chunks.
+    catalog = json.loads(load_fixture("catalog.json"))
+    report = validator.validate_parallel(catalog, SRC_URL, processes=2, chunk_size=3).report()
+    assert report == expected_report(), report
+
+def test_parallel_samples():
+    # Duplicates of identifiers seen in an earlier chunk are only found when
+    # the chunks are merged, after the duplicates found within the chunks, but
+    # the samples must still be the first few in catalog order.
+    catalog = json.loads(load_fixture("catalog.json")) * 3
+    errors = []
+    validator.do_validation(catalog, SRC_URL, errors, samples=True)
+    report = validator.validate_parallel(catalog, SRC_URL, processes=2, chunk_size=5).report(samples=True)
+    assert report == errors, report
+
+def test_stream():
+    if validator.ijson is None:
+        raise unittest.SkipTest("ijson is not installed")
+    errors = []
+    count = validator.validate_stream(StringIO.StringIO(load_fixture("catalog.json")), SRC_URL, errors)
+    assert count == 8
+    assert errors == expected_report(), errors
+
+def test_samples_are_bounded():
+    # Only the first few locations are kept, but every one is counted.
+    catalog = json.loads(load_fixture("catalog.json"))
+    v = validator.CatalogValidator(SRC_URL, max_samples=2)
+    v.validate_items(catalog)
+    locations = v.errs.errors[(90, "Add Suggested Fields to Improve Data Quality", "Add a 'landingPage' field to datasets.", None)]
+    assert locations.count == 8
+    assert locations.samples == ['"Data Catalog"', '"Hospital Admissions"']
+    assert v.report() == expected_report()
+
+def test_partial_report():
+    catalog = json.loads(load_fixture("catalog.json"))
+    reports = []
+    v = validator.CatalogValidator(SRC_URL)
+    v.validate_items(catalog, progress=lambda v : reports.append((v.count, v.report())), progress_interval=3)
+    assert [count for count, report in reports] == [3, 6]
+    first = validator.CatalogValidator(SRC_URL)
+    first.validate_items(catalog[:3])
+    assert reports[0][1] == first.report()